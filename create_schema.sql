@@ -15,15 +15,28 @@ CREATE TABLE IF NOT EXISTS StashContents (
     W smallint not null,
     H smallint not null
 );
-CREATE INDEX StashContents_StashId ON StashContents (StashId);
+CREATE INDEX IF NOT EXISTS StashContents_StashId ON StashContents (StashId);
 
 CREATE TABLE IF NOT EXISTS Players (
-    PlayerId bigint PRIMARY KEY,
+    PlayerId bigserial PRIMARY KEY,
     AccountName varchar(50) not null,
     League smallint not null,
-    Predictions jsonb
+    Predictions jsonb,
+    PredictionsVersion integer not null default 0
 );
 CREATE UNIQUE INDEX IF NOT EXISTS players_accountname_league ON Players (AccountName, League);
+-- Migrate databases created before PlayerId was generated and predictions were versioned
+ALTER TABLE Players ADD COLUMN IF NOT EXISTS PredictionsVersion integer not null default 0;
+CREATE SEQUENCE IF NOT EXISTS players_playerid_seq OWNED BY Players.PlayerId;
+SELECT setval('players_playerid_seq', COALESCE(MAX(PlayerId), 0) + 1, false) FROM Players;
+ALTER TABLE Players ALTER COLUMN PlayerId SET DEFAULT nextval('players_playerid_seq');
+
+CREATE TABLE IF NOT EXISTS PredictionCache (
+    ModelVersion char(32) not null,
+    Hash uuid not null,
+    Prediction smallint not null
+);
+CREATE UNIQUE INDEX IF NOT EXISTS predictioncache_modelversion_hash ON PredictionCache (ModelVersion, Hash);
 
 CREATE TABLE IF NOT EXISTS BodyItems (
     ItemId char(64) primary key,
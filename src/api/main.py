@@ -1,19 +1,44 @@
+import hashlib
 import json
 import sys
 import os
+import threading
+import time
 from indexer.itemdb import ItemDB
+from util.collections import TTLCache
+from util.db import get_pool
+from util.log_tail import LogFollower, incomplete_character_bytes, skip_continuation_bytes
 
-from flask import Flask, url_for
+from flask import Flask, Response, request, url_for
 app = Flask(__name__)
 
 db_credentials = os.environ['DB_CREDENTIALS']
+db_pool_size = int(os.environ.get('DB_POOL_SIZE', 10))
+
+# get_stats counts all items, so serve the same result for a while
+stats_cache = TTLCache(int(os.environ.get('STATS_TTL', 60)))
+
+log_file = os.environ.get('LOG_FILE', '/home/bschug/log')
+# Bytes of the log sent to streaming clients when they connect
+log_backlog = int(os.environ.get('LOG_BACKLOG', 64 * 1024))
+log_follower = None
+log_follower_lock = threading.Lock()
 
 
 @app.route('/api/v1/stats')
 def stats():
-    itemdb = ItemDB(db_credentials)
-    stats = itemdb.get_stats()
-    return json.dumps(stats)
+    body = stats_cache.get('stats')
+    if body is None:
+        with get_pool(db_credentials, db_pool_size).connection() as dbconn:
+            stats = ItemDB(dbconn=dbconn).get_stats()
+        body = json.dumps(stats)
+        stats_cache.put('stats', body)
+
+    response = Response(body, mimetype='application/json')
+    response.set_etag(hashlib.md5(body.encode('utf-8')).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = max(0, int(stats_cache.expires('stats') - time.time()))
+    return response.make_conditional(request)
 
 
 @app.route('/api/v1/log')
@@ -24,13 +49,54 @@ def print_log_default():
 @app.route('/api/v1/log/<offset>')
 def print_log(offset):
     offset = int(offset)
-    current_size = os.stat('/home/bschug/log').st_size
+    current_size = os.stat(log_file).st_size
     offset = min(max(0, current_size - 1024, offset), current_size)
 
-    with open('/home/bschug/log', 'rb') as fp:
+    with open(log_file, 'rb') as fp:
         fp.seek(offset)
-        data = fp.read(current_size - offset).decode('utf-8')
-        return json.dumps({'data': data, 'offset': current_size})
+        data = fp.read(current_size - offset)
+    # Don't cut UTF-8 characters in half at either end, the next request continues where this one stopped
+    start = skip_continuation_bytes(data[:3])
+    end = len(data) - incomplete_character_bytes(data)
+    return json.dumps({'data': data[start:end].decode('utf-8', errors='replace'), 'offset': offset + end})
+
+
+@app.route('/api/v1/log/stream')
+def stream_log():
+    """
+    Streams the log as server-sent events: first the backlog, then new lines as they are written.
+    Each event's id is the position in the log file where its text ends, so reconnecting clients
+    (Last-Event-ID) continue where they left off, no matter which worker process they reach.
+    """
+    follower = get_log_follower()
+    # Without an id, the client gets the backlog first
+    after = request.headers.get('Last-Event-ID')
+
+    def events(after):
+        while True:
+            position, text = follower.read(after, timeout=15)
+            if len(text) > 0:
+                lines = ''.join('data: {}\n'.format(x) for x in text.split('\n'))
+                yield 'id: {}\n{}\n'.format(position, lines)
+            else:
+                # Comment line, keeps proxies from closing the connection
+                yield ': keep-alive\n\n'
+            after = position
+
+    return Response(events(after), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def get_log_follower():
+    """
+    Returns this process's LogFollower, starting it on first use.
+    All streaming clients share it, so the log is read only once per process.
+    """
+    global log_follower
+    with log_follower_lock:
+        if log_follower is None:
+            log_follower = LogFollower(log_file, backlog=log_backlog).start()
+        return log_follower
 
 
 if __name__ == '__main__':
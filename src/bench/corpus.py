@@ -0,0 +1,183 @@
+import argparse
+import bz2
+import json
+import os
+import random
+
+from constants import itemtype, rarity
+from indexer.poeapi import PoEApi
+
+JEWELLERY = {itemtype.RING, itemtype.AMULET, itemtype.BELT, itemtype.QUIVER}
+ARMOUR = {itemtype.BODY, itemtype.HELMET, itemtype.GLOVES, itemtype.BOOTS, itemtype.SHIELD}
+
+# Mods that the parsers of every type in a group know, as format strings of one value
+RESIST_MODS = ['+{}% to Fire Resistance', '+{}% to Cold Resistance', '+{}% to Lightning Resistance',
+               '+{}% to Chaos Resistance']
+JEWELLERY_MODS = ['+{} to maximum Life']
+ARMOUR_MODS = ['+{} to maximum Life', '+{} to maximum Mana', '+{} to Strength', '+{} to Dexterity',
+               '+{} to Intelligence', '{}% increased Armour', '{}% increased Evasion Rating',
+               '{}% increased Energy Shield', '+{} to maximum Energy Shield', '+{} to Armour',
+               '+{} to Evasion Rating', '{}% increased Stun and Block Recovery']
+WEAPON_MODS = ['{}% increased Physical Damage', '{}% increased Critical Strike Chance',
+               '{}% increased Attack Speed', '+{} to Accuracy Rating', 'Adds 5 to {} Physical Damage',
+               '+{} Life gained on Kill']
+# Known to no parser, so that some items are rejected like in real pages
+UNKNOWN_MOD = '{}% increased Effect of Auras you Cast'
+
+
+def load_pages(path):
+    """
+    Loads recorded public-stash-tabs pages, in change id order.
+    :param path: Directory of recorded pages (*.json or *.json.bz2), or a single page file.
+    :return: List of pages, each as returned by PoEApi.public_stash_tabs
+    """
+    return [load_page(x) for x in page_filenames(path)]
+
+
+def page_filenames(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, x) for x in os.listdir(path)
+                      if x.endswith('.json') or x.endswith('.json.bz2'))
+    return [path]
+
+
+def load_or_generate_pages(path, num_pages, seed=0):
+    """
+    Loads the recorded pages in path, like load_pages. If path is None or a directory without
+    recorded pages (e.g. on a fresh checkout), generates num_pages pages instead (see generate_pages),
+    so that benchmarks can always be run and reproduced.
+    """
+    if path is not None and (not os.path.isdir(path) or len(page_filenames(path)) > 0):
+        return load_pages(path)
+    print("No recorded pages, generating {} pages with seed {}".format(num_pages, seed))
+    return generate_pages(num_pages, seed=seed)
+
+
+def load_page(filename):
+    opener = bz2.open if filename.endswith('.bz2') else open
+    with opener(filename, 'rt', encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+def record_pages(outdir, num_pages, first_id='0', poeapi=None):
+    """
+    Fetches num_pages consecutive pages from the stash tab api and stores them in outdir.
+    Files are numbered so that load_pages returns them in the order they were fetched.
+    :return: next change id after the last recorded page
+    """
+    poeapi = poeapi or PoEApi()
+    os.makedirs(outdir, exist_ok=True)
+    next_change_id = first_id
+    for i in range(num_pages):
+        page = poeapi.public_stash_tabs(next_change_id)
+        filename = os.path.join(outdir, '{:05d}.json.bz2'.format(i))
+        with bz2.open(filename, 'wt', encoding='utf-8') as fp:
+            json.dump(page, fp)
+        print("Recorded {} stashes to {}".format(len(page['stashes']), filename))
+        next_change_id = page['next_change_id']
+    return next_change_id
+
+
+def generate_pages(num_pages, stashes_per_page=50, items_per_stash=24, seed=0):
+    """
+    Generates pages in the format of PoEApi.public_stash_tabs, for benchmarks when there is no recorded corpus.
+    The same arguments always give the same pages. Most items are rares of every item type with mods
+    the parser understands; the rest are other rarities, jewels and rares the parser rejects.
+    """
+    rng = random.Random(seed)
+    basetypes = [(t, x) for t in sorted(itemtype.ALL_TYPES) for x in sorted(itemtype.ALL_TYPES[t])]
+    pages = []
+    for page_num in range(num_pages):
+        stashes = []
+        for stash_num in range(stashes_per_page):
+            stash_id = '{:064x}'.format(rng.getrandbits(256))
+            items = [generate_item(rng, basetypes, i) for i in range(items_per_stash)]
+            stashes.append({
+                'id': stash_id,
+                'public': True,
+                'accountName': 'account{}'.format(rng.randrange(10000)),
+                'lastCharacterName': 'character{}'.format(rng.randrange(10000)),
+                'stash': rng.choice(['~price 1 chaos', '~b/o 1 exa', 'Stash{}'.format(stash_num)]),
+                'stashType': 'PremiumStash',
+                'items': items,
+            })
+        pages.append({'next_change_id': '{}-{}'.format(seed, page_num + 1), 'stashes': stashes})
+    return pages
+
+
+def generate_item(rng, basetypes, position):
+    """
+    :param position: Index of the item in its stash, which decides where the item is placed
+    """
+    item_type, basetype = rng.choice(basetypes)
+    roll = rng.random()
+    if roll < 0.1:
+        frame_type = rng.choice([rarity.NORMAL, rarity.MAGIC, rarity.UNIQUE])
+    else:
+        frame_type = rarity.RARE
+    if roll > 0.97:
+        basetype = rng.choice(['Cobalt Jewel', 'Crimson Jewel', 'Viridian Jewel'])
+
+    if item_type in JEWELLERY:
+        prefixes, properties = JEWELLERY_MODS, []
+    elif item_type in ARMOUR:
+        prefixes = ARMOUR_MODS
+        properties = [
+            {'name': 'Quality', 'values': [['+{}%'.format(rng.randrange(21)), 1]], 'displayMode': 0, 'type': 6},
+            {'name': 'Armour', 'values': [[str(rng.randrange(1, 1000)), 1]], 'displayMode': 0, 'type': 16},
+        ]
+    else:
+        prefixes = WEAPON_MODS
+        low = rng.randrange(5, 50)
+        properties = [
+            {'name': 'Physical Damage', 'values': [['{}-{}'.format(low, low + rng.randrange(1, 100)), 1]],
+             'displayMode': 0, 'type': 9},
+            {'name': 'Critical Strike Chance', 'values': [['{:.2f}%'.format(rng.uniform(5, 7)), 0]],
+             'displayMode': 0, 'type': 12},
+            {'name': 'Attacks per Second', 'values': [['{:.2f}'.format(rng.uniform(1, 1.6)), 0]],
+             'displayMode': 0, 'type': 13},
+        ]
+    mods = rng.sample(prefixes, min(len(prefixes), rng.randrange(1, 4))) + rng.sample(RESIST_MODS, rng.randrange(4))
+    if rng.random() < 0.05:
+        mods.append(UNKNOWN_MOD)
+    num_sockets = rng.randrange(7) if item_type not in JEWELLERY else 0
+
+    item = {
+        'id': '{:064x}'.format(rng.getrandbits(256)),
+        'league': rng.choice(['Standard', 'Hardcore']),
+        'frameType': frame_type,
+        'typeLine': basetype,
+        'name': 'Generated Item' if frame_type == rarity.RARE else '',
+        'ilvl': rng.randrange(1, 87),
+        'identified': True,
+        'corrupted': rng.random() < 0.1,
+        'sockets': [{'group': i // 2, 'attr': rng.choice('SDIG')} for i in range(num_sockets)],
+        'requirements': [{'name': 'Level', 'values': [[str(rng.randrange(1, 81)), 0]], 'displayMode': 0}],
+        'properties': properties,
+        'explicitMods': [x.format(rng.randrange(5, 50)) for x in mods],
+        # Items are laid out in a grid of 2x3 cells, whatever their size
+        'x': position * 2 % 12,
+        'y': position * 2 // 12 * 3,
+        'w': 1 if item_type in JEWELLERY else 2,
+        'h': 1 if item_type in JEWELLERY else 3,
+    }
+    if rng.random() < 0.3:
+        item['note'] = '~price {} chaos'.format(rng.randrange(1, 200))
+    return item
+
+
+def main(args):
+    next_change_id = record_pages(args.outdir, args.pages, args.id)
+    print("Next change id:", next_change_id)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description='Record public stash tab pages for benchmarks')
+    ap.add_argument('outdir')
+    ap.add_argument('--pages', type=int, default=10, help='Number of pages to record')
+    ap.add_argument('--id', default='0', help='Change id of the first page')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
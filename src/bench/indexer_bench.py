@@ -0,0 +1,140 @@
+import argparse
+import json
+import time
+
+import psycopg2.extensions
+
+from bench.corpus import load_or_generate_pages
+from bench.parse_bench import get_commit
+from indexer.indexer import Indexer, STAGES
+from indexer.itemdb import ItemDB
+from indexer.schema import schema_filename
+from util import metrics
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that counts executed statements and affected (or returned) rows.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_statements = 0
+        self.num_rows = 0
+
+    def execute(self, query, vars=None):
+        result = super().execute(query, vars)
+        self.num_statements += 1
+        self.num_rows += max(0, self.rowcount)
+        return result
+
+
+class ReplayApi(object):
+    """
+    Stands in for PoEApi and returns recorded pages in order, without rate limiting.
+    """
+    def __init__(self, pages):
+        self.pages = pages
+        self.next_page = 0
+
+    def public_stash_tabs(self, id=0):
+        with metrics.timer('fetch'):
+            page = self.pages[self.next_page]
+            self.next_page += 1
+            return page
+
+
+class BenchmarkItemDB(ItemDB):
+    """
+    ItemDB that counts the statements it sends to the database.
+    """
+    def __init__(self, db_access_string):
+        super().__init__(db_access_string)
+        self.dbconn.cursor_factory = CountingCursor
+        self.db = self.dbconn.cursor()
+
+
+class BenchmarkIndexer(Indexer):
+    def get_next_stash_update(self):
+        # Same as Indexer, but don't overwrite the next_change_id.txt of a real indexer
+        response = self.poeapi.public_stash_tabs(self.next_change_id)
+        self.next_change_id = response['next_change_id']
+        return response['stashes']
+
+
+def reset_schema(db_access_string):
+    """
+    Drops all tables and recreates them from create_schema.sql.
+    """
+    dbconn = psycopg2.connect(db_access_string)
+    db = dbconn.cursor()
+    db.execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public;')
+    with open(schema_filename(), 'r') as fp:
+        db.execute(fp.read())
+    dbconn.commit()
+    dbconn.close()
+
+
+def run_benchmark(pages, db_access_string):
+    item_db = BenchmarkItemDB(db_access_string)
+    indexer = BenchmarkIndexer(item_db, ReplayApi(pages))
+
+    num_items = sum(len(x['items']) for page in pages for x in page['stashes'])
+    before = metrics.snapshot()
+    start_time = time.perf_counter()
+    for i in range(len(pages)):
+        indexer.process_next_stash_update()
+    seconds = time.perf_counter() - start_time
+    totals = metrics.delta(before, metrics.snapshot())
+
+    return {
+        'commit': get_commit(),
+        'pages': len(pages),
+        'items': num_items,
+        'seconds': seconds,
+        'pages_per_second': len(pages) / seconds,
+        'items_per_second': num_items / seconds,
+        'stages': totals['timers'],
+        'counters': totals['counters'],
+        'statements_per_page': item_db.db.num_statements / len(pages),
+        'rows_per_page': item_db.db.num_rows / len(pages),
+    }
+
+
+def print_results(results):
+    print()
+    print("{pages} pages / {items} items in {seconds:.1f} seconds (commit {commit})".format(**results))
+    print("{pages_per_second:.2f} pages/s, {items_per_second:.0f} items/s".format(**results))
+    print("{statements_per_page:.0f} statements and {rows_per_page:.0f} rows per page".format(**results))
+    for stage in STAGES:
+        seconds = results['stages'].get(stage, 0)
+        print("{:<8} {:>8.2f} s {:>6.1%}".format(stage, seconds, seconds / results['seconds']))
+
+
+def main(args):
+    pages = load_or_generate_pages(args.corpus, args.pages, seed=args.seed)
+    if args.reset:
+        reset_schema(args.db)
+    results = run_benchmark(pages, args.db)
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description='Replay recorded stash pages through Indexer and ItemDB')
+    ap.add_argument('corpus', nargs='?',
+                    help='Directory of recorded pages (see bench.corpus). Pages are generated if it is '
+                         'left out or empty.')
+    ap.add_argument('--pages', type=int, default=20, help='Number of pages to generate')
+    ap.add_argument('--seed', type=int, default=0, help='Seed of the generated pages')
+    ap.add_argument('--db', required=True, help='Credentials of a database used only for benchmarks')
+    ap.add_argument('--reset', default=False, action='store_true',
+                    help='Drop all tables and recreate them from create_schema.sql before the run')
+    ap.add_argument('--output', help='Write results as JSON to this file')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import subprocess
+import time
+from collections import defaultdict
+from contextlib import redirect_stdout
+
+import numpy as np
+
+from bench.corpus import load_or_generate_pages
+from constants import itemtype, rarity
+from indexer import itemdb, itemstats
+from indexer.itemstats import Affix, AffixParser, ItemParserException
+from util import metrics
+
+
+def run_benchmark(pages, repeat=1):
+    """
+    Runs the item parser over all items in the given pages and returns a dict of results:
+    overall preprocess_item throughput, parse_stats latency percentiles per item type
+    and the total time spent in each affix parser.
+    Nothing is printed and no metrics are recorded while the parser is timed.
+    """
+    stashes = [x for page in pages for x in page['stashes']]
+    num_items = sum(len(x['items']) for x in stashes)
+
+    # Overall throughput of the indexer's preprocessing, including items it rejects
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), metrics.disabled():
+        start_time = time.perf_counter()
+        for i in range(repeat):
+            for stash in stashes:
+                for item in stash['items']:
+                    itemdb.preprocess_item(item, stash['id'], verbose=False)
+        preprocess_seconds = time.perf_counter() - start_time
+
+    rare_items = [(x, itemtype.get_item_type(x)) for stash in stashes for x in stash['items']
+                  if x['frameType'] == rarity.RARE]
+    rare_items = [(x, t) for x, t in rare_items if t != itemtype.UNKNOWN]
+
+    latencies = defaultdict(lambda: [])
+    num_rejected = defaultdict(lambda: 0)
+    for i in range(repeat):
+        for item, item_type in rare_items:
+            start_time = time.perf_counter()
+            try:
+                itemstats.parse_stats(item, item_type)
+            except ItemParserException:
+                num_rejected[item_type] += 1
+            latencies[item_type].append(time.perf_counter() - start_time)
+
+    return {
+        'commit': get_commit(),
+        'pages': len(pages),
+        'stashes': len(stashes),
+        'items': num_items,
+        'repeat': repeat,
+        'preprocess': {
+            'seconds': preprocess_seconds,
+            'items_per_second': num_items * repeat / preprocess_seconds if preprocess_seconds > 0 else 0,
+        },
+        'types': {itemtype.get_name(k): summarize_latencies(v, num_rejected[k] // repeat)
+                  for k, v in latencies.items()},
+        'affixes': measure_affixes(rare_items),
+    }
+
+
+def summarize_latencies(latencies, num_rejected):
+    us = np.array(latencies) * 1e6
+    p50, p90, p99 = np.percentile(us, [50, 90, 99])
+    return {
+        'count': len(latencies),
+        'rejected': num_rejected,
+        'items_per_second': len(latencies) / (us.sum() / 1e6) if us.sum() > 0 else 0,
+        'p50_us': p50,
+        'p90_us': p90,
+        'p99_us': p99,
+        'max_us': us.max(),
+    }
+
+
+def measure_affixes(items):
+    """
+    Parses all items once more with every affix parser wrapped in a timer.
+    This is a separate pass because the timers themselves add overhead.
+    Returns a dict of affix name -> calls, matches and total seconds.
+    """
+    timings = defaultdict(lambda: {'calls': 0, 'matches': 0, 'seconds': 0.0})
+    affixes = {k: v for k, v in vars(Affix).items() if isinstance(v, AffixParser)}
+
+    def timed(name, parse):
+        def _timed(mod_text):
+            start_time = time.perf_counter()
+            value = parse(mod_text)
+            timing = timings[name]
+            timing['seconds'] += time.perf_counter() - start_time
+            timing['calls'] += 1
+            if value != 0:
+                timing['matches'] += 1
+            return value
+        return _timed
+
+    originals = {name: affix.parse for name, affix in affixes.items()}
+    for name, affix in affixes.items():
+        affix.parse = timed(name, affix.parse)
+    try:
+        for item, item_type in items:
+            try:
+                itemstats.parse_stats(item, item_type)
+            except ItemParserException:
+                pass
+    finally:
+        for name, affix in affixes.items():
+            affix.parse = originals[name]
+
+    return dict(sorted(timings.items(), key=lambda x: -x[1]['seconds']))
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL) \
+            .decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None, num_affixes=15):
+    print("{items} items in {stashes} stashes on {pages} pages (commit {commit})".format(**results))
+    print("preprocess_item: {:.0f} items/s".format(results['preprocess']['items_per_second']))
+    if baseline is not None:
+        print("    baseline:    {:.0f} items/s ({:+.1%})".format(
+            baseline['preprocess']['items_per_second'],
+            results['preprocess']['items_per_second'] / baseline['preprocess']['items_per_second'] - 1))
+
+    print()
+    print("{:<16} {:>7} {:>8} {:>10} {:>9} {:>9} {:>9}".format(
+        'parse_stats', 'items', 'rejected', 'items/s', 'p50 us', 'p90 us', 'p99 us'))
+    for name, t in sorted(results['types'].items()):
+        print("{:<16} {count:>7} {rejected:>8} {items_per_second:>10.0f} {p50_us:>9.1f} {p90_us:>9.1f} {p99_us:>9.1f}"
+              .format(name, **t))
+
+    print()
+    print("{:<40} {:>9} {:>9} {:>9}".format('affix', 'calls', 'matches', 'ms'))
+    for name, t in list(results['affixes'].items())[:num_affixes]:
+        print("{:<40} {calls:>9} {matches:>9} {:>9.1f}".format(name, t['seconds'] * 1000, **t))
+
+
+def main(args):
+    pages = load_or_generate_pages(args.corpus, args.pages, seed=args.seed)
+    results = run_benchmark(pages, repeat=args.repeat)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+    print_results(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description='Measure item parser throughput on recorded stash pages')
+    ap.add_argument('corpus', nargs='?',
+                    help='Directory of recorded pages (see bench.corpus). Pages are generated if it is '
+                         'left out or empty.')
+    ap.add_argument('--pages', type=int, default=20, help='Number of pages to generate')
+    ap.add_argument('--seed', type=int, default=0, help='Seed of the generated pages')
+    ap.add_argument('--repeat', type=int, default=1, help='Parse the corpus this many times')
+    ap.add_argument('--output', help='Write results as JSON to this file')
+    ap.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
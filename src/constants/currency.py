@@ -137,13 +137,23 @@ def store_exchange_rates(rates, league):
             fp.write('\n')
 
 
-def load_exchange_rates_from_poe_ninja(league):
+def load_exchange_rates_from_poe_ninja(league, date=None):
     """
     Converts the JSON response from poe.ninja into a dictionary of currency id -> value in chaos.
+    :param date: Day (date) of the rates to load. Loads the current rates if not given.
     """
     import requests
+    url = 'http://poe.ninja/api/Data/GetCurrencyOverview?league=' + league
+    if date is not None:
+        url += '&date=' + date.strftime('%Y-%m-%d')
+    return parse_currency_overview(requests.get(url).json())
+
+
+def parse_currency_overview(response):
+    """
+    Converts a poe.ninja currency overview into a dictionary of currency id -> value in chaos.
+    """
     result = dict()
-    response = requests.get('http://poe.ninja/api/Data/GetCurrencyOverview?league=' + league).json()
     for currency_data in response['lines']:
         shortname = full_name_to_short(currency_data['currencyTypeName'])
         if shortname is None:
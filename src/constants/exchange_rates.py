@@ -0,0 +1,162 @@
+import csv
+import datetime
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from constants import currency
+
+NUM_CURRENCIES = max(currency.CURRENCY_ID.values()) + 1
+
+
+class ExchangeRates(object):
+    def __init__(self, dates, rates):
+        """
+        Daily exchange rates of one league, as an array that can convert whole columns at once.
+
+        :param dates: Sorted array of days (datetime64[D])
+        :param rates: Array of shape (len(dates), NUM_CURRENCIES) with the value of each currency
+                      in chaos on each day. Unknown rates are NaN.
+        """
+        self.dates = np.asarray(dates, dtype='datetime64[D]')
+        self.rates = rates
+
+    @staticmethod
+    def from_daily_rates(daily_rates):
+        """
+        :param daily_rates: dict of date -> dict of currency id -> value in chaos
+        """
+        dates = sorted(daily_rates.keys())
+        rates = np.full((len(dates), NUM_CURRENCIES), np.nan)
+        for i, date in enumerate(dates):
+            for currency_id, value in daily_rates[date].items():
+                if 0 <= currency_id < NUM_CURRENCIES:
+                    rates[i, currency_id] = value
+        return ExchangeRates(np.array(dates, dtype='datetime64[D]'), rates)
+
+    @staticmethod
+    def from_rates(rates, date=None):
+        """
+        Wraps a single dict of currency id -> value in chaos, valid on any date.
+        """
+        return ExchangeRates.from_daily_rates({date or datetime.date.today(): rates})
+
+    def __len__(self):
+        return len(self.dates)
+
+    def day_index(self, dates):
+        """
+        Returns the row of the rates for each date. Dates before the first known day use the
+        rates of the first day, dates after the last known day use the latest rates.
+        """
+        days = to_days(dates)
+        return np.clip(np.searchsorted(self.dates, days, side='right') - 1, 0, len(self.dates) - 1)
+
+    def convert(self, price, currency_ids, dates=None):
+        """
+        Converts prices to chaos. Works on single values as well as on whole columns.
+        Prices in unknown currencies become NaN.
+        :param dates: When the prices were paid. If not given, uses the latest rates.
+        """
+        currency_ids = np.asarray(currency_ids, dtype=np.int64)
+        known = (currency_ids >= 0) & (currency_ids < NUM_CURRENCIES)
+        currency_ids = np.where(known, currency_ids, 0)
+        if dates is None:
+            rows = len(self.dates) - 1
+        else:
+            rows = self.day_index(dates)
+        rates = np.where(known, self.rates[rows, currency_ids], np.nan)
+        return price * rates
+
+    def on(self, date=None):
+        """
+        Returns the rates of a single day as a dict of currency id -> value in chaos.
+        """
+        row = len(self.dates) - 1 if date is None else self.day_index([date])[0]
+        return {k: v for k, v in enumerate(self.rates[row]) if not np.isnan(v)}
+
+
+class ExchangeRateService(object):
+    def __init__(self, league, fetch=None, cache_file=None, max_age=3600):
+        """
+        Keeps the daily exchange rates of a league. Days that are over are stored in a
+        CSV cache file and only ever fetched once, today's rates are refetched after max_age seconds.
+
+        :param league: League name, e.g. Standard
+        :param fetch:  Function (league, date) -> dict of currency id -> value in chaos.
+                       date is None for the current rates. Defaults to poe.ninja.
+        :param cache_file: Defaults to exchange_rates/<league>.daily.csv
+        """
+        self.league = league
+        self.fetch = fetch or currency.load_exchange_rates_from_poe_ninja
+        self.cache_file = cache_file or history_cache_file(league)
+        self.max_age = max_age
+        self.daily_rates = load_history(self.cache_file)
+        self.today_rates = None
+        self.today_fetched = 0
+
+    def history(self, since=None):
+        """
+        Returns ExchangeRates for all days from since until today.
+        :param since: First day (date) to include. Defaults to only today.
+        """
+        today = datetime.date.today()
+        missing = []
+        if since is not None:
+            day = since
+            while day < today:
+                if day not in self.daily_rates:
+                    missing.append(day)
+                day += datetime.timedelta(days=1)
+        for day in missing:
+            print("Fetching exchange rates of", day)
+            self.daily_rates[day] = self.fetch(self.league, day)
+        if len(missing) > 0:
+            store_history(self.daily_rates, self.cache_file)
+
+        if self.today_rates is None or time.time() - self.today_fetched > self.max_age:
+            self.today_rates = self.fetch(self.league, None)
+            self.today_fetched = time.time()
+
+        daily_rates = {k: v for k, v in self.daily_rates.items() if since is not None and since <= k}
+        daily_rates[today] = self.today_rates
+        return ExchangeRates.from_daily_rates(daily_rates)
+
+
+def to_days(dates):
+    """
+    Converts dates, datetimes or timestamps (also timezone aware ones) to datetime64[D].
+    """
+    dates = pd.to_datetime(pd.Series(list(dates) if not isinstance(dates, pd.Series) else dates), utc=True)
+    return dates.dt.tz_localize(None).values.astype('datetime64[D]')
+
+
+def history_cache_file(league):
+    basedir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    return os.path.join(basedir, 'exchange_rates', league + '.daily.csv')
+
+
+def load_history(filename):
+    """
+    Loads a CSV file with the columns date, currency name, value in chaos
+    and returns it as a dict of date -> dict of currency id -> value in chaos.
+    """
+    result = dict()
+    if not os.path.exists(filename):
+        return result
+    with open(filename, 'r', newline='') as fp:
+        for date, cname, cvalue in csv.reader(fp):
+            day = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+            result.setdefault(day, dict())[currency.get_id(cname)] = float(cvalue)
+    return result
+
+
+def store_history(daily_rates, filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        for day in sorted(daily_rates.keys()):
+            for cid, value in sorted(daily_rates[day].items()):
+                writer.writerow([day.strftime('%Y-%m-%d'), currency.id_to_shortname(cid), value])
@@ -0,0 +1,78 @@
+import threading
+import traceback
+
+from util import metrics
+
+GG_TAB_NAME = 'GG'
+
+
+def is_gg_tab(stash):
+    """
+    Tabs named 'GG' get an overlay of predictions, see ItemDB.update_gg_tab.
+    """
+    return stash.get('stash') == GG_TAB_NAME and stash.get('accountName') is not None \
+        and len(stash['items']) > 0
+
+
+class GGTabWorker(object):
+    def __init__(self, item_db, predictor):
+        """
+        Scores GG tabs in a background thread and stores the overlay in Players,
+        so the indexer doesn't wait for model inference.
+        If a tab changes again before the worker got to it, only its latest version is scored.
+
+        :param item_db:   ItemDB used only by the worker thread (not the indexer's)
+        :param predictor: Predictor used only by the worker thread
+        """
+        self.item_db = item_db
+        self.predictor = predictor
+        self.pending = dict()
+        self.condition = threading.Condition()
+        self.is_running = False
+        self.thread = None
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name='gg-tabs', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Scores the tabs that are still pending, then stops the worker thread.
+        """
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, stash):
+        """
+        Queues a GG tab for scoring. Must only be called after its items were committed.
+        """
+        with self.condition:
+            self.pending[stash['id']] = stash
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.is_running and len(self.pending) == 0:
+                    self.condition.wait()
+                if len(self.pending) == 0:
+                    return
+                stash_id = next(iter(self.pending))
+                stash = self.pending.pop(stash_id)
+            try:
+                self.process(stash)
+            except Exception:
+                traceback.print_exc()
+                self.item_db.dbconn.rollback()
+
+    def process(self, stash):
+        with metrics.timer('gg_predict'):
+            predictions = self.predictor.predict(stash['id'])
+        with metrics.timer('gg_write'):
+            self.item_db.update_gg_tab(stash, predictions)
+            self.item_db.commit()
+        metrics.count('gg_tabs')
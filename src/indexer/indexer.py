@@ -1,12 +1,29 @@
+import json
+import sys
 import time
 
+from indexer.gg_tabs import is_gg_tab
+from util import metrics
+
+STAGES = ('fetch', 'decode', 'prefilter', 'parse', 'diff', 'write', 'commit')
+
 
 class Indexer(object):
-    def __init__(self, item_db, poeapi, first_id='0'):
+    def __init__(self, item_db, poeapi, first_id='0', metrics_log=None, gg_tab_worker=None):
+        """
+        :param item_db:     ItemDB to write to
+        :param poeapi:      PoEApi to read stash updates from
+        :param first_id:    Change id of the first stash update
+        :param metrics_log: File object that receives one JSON line of timings and counts
+                            per stash update. Defaults to stdout.
+        :param gg_tab_worker: GGTabWorker that precomputes the predictions of GG tabs
+        """
         self.item_db = item_db
         self.poeapi = poeapi
         self.is_running = False
         self.next_change_id = first_id
+        self.metrics_log = metrics_log
+        self.gg_tab_worker = gg_tab_worker
 
     def run(self):
         self.is_running = True
@@ -14,13 +31,12 @@ class Indexer(object):
             self.process_next_stash_update()
 
     def process_next_stash_update(self):
-        print("Requesting next...")
-        start_time = time.time()
+        # The GG tab worker commits through ItemDB too, its time must not count for this page
+        before = metrics.snapshot(current_thread=True)
+        start_time = time.perf_counter()
+        change_id = self.next_change_id
         stashes = self.get_next_stash_update()
-        print("Received {} stashes after {:.1f} seconds".format(
-            len(stashes), time.time() - start_time))
 
-        start_time = time.time()
         total_num_deleted = 0
         total_added = []
         for stash in stashes:
@@ -29,10 +45,36 @@ class Indexer(object):
             total_num_deleted += num_deleted
         self.item_db.add_items(total_added)
         self.item_db.commit()
-        print("Processed {} items in {:.2f} seconds".format(
-            len(total_added), time.time() - start_time))
-        print("Sold: ", total_num_deleted)
-        print("Total Items: ", self.item_db.count())
+
+        if self.gg_tab_worker is not None:
+            for stash in filter(is_gg_tab, stashes):
+                self.gg_tab_worker.submit(stash)
+
+        elapsed = time.perf_counter() - start_time
+        metrics.count('pages')
+        metrics.count('stashes_seen', len(stashes))
+        metrics.count('items_added', len(total_added))
+        metrics.observe('page_seconds', elapsed)
+        page = metrics.delta(before, metrics.snapshot(current_thread=True))
+        for stage in STAGES:
+            metrics.observe('page_{}_seconds'.format(stage), page['timers'].get(stage, 0))
+        self.log_page(change_id, elapsed, page)
+
+    def log_page(self, change_id, elapsed, page):
+        """
+        Writes the timings and counts of one stash update as a single JSON line.
+        """
+        line = {
+            'time': time.time(),
+            'change_id': change_id,
+            'next_change_id': self.next_change_id,
+            'seconds': round(elapsed, 4),
+            'timers': {k: round(v, 4) for k, v in page['timers'].items()},
+            'counters': page['counters'],
+        }
+        fp = self.metrics_log or sys.stdout
+        fp.write(json.dumps(line) + '\n')
+        fp.flush()
 
     def get_next_stash_update(self):
         """
@@ -40,7 +82,6 @@ class Indexer(object):
         """
         response = self.poeapi.public_stash_tabs(self.next_change_id)
         self.next_change_id = response['next_change_id']
-        print(self.next_change_id)
         store_next_change_id(self.next_change_id)
         return response['stashes']
 
@@ -1,4 +1,3 @@
-import hashlib
 from collections import defaultdict
 import json
 import re
@@ -7,16 +6,20 @@ import psycopg2
 from psycopg2.extras import Json
 from blessings import Terminal
 
-from indexer.itemstats import ItemBannedException, ItemParserException
+from indexer.itemstats import ItemBannedException, ItemParserException, hash_item
 from . import itemstats
 from constants import league
 from constants import rarity
 from constants import itemtype
 from constants import currency
+from util import metrics
 
 class ItemDB(object):
-    def __init__(self, db_access_string="dbname='poeria' user='benjamin'"):
-        self.dbconn = psycopg2.connect(db_access_string)
+    def __init__(self, db_access_string="dbname='poeria' user='benjamin'", dbconn=None):
+        """
+        :param dbconn: Use this connection (e.g. from a ConnectionPool) instead of opening one
+        """
+        self.dbconn = dbconn if dbconn is not None else psycopg2.connect(db_access_string)
         self.db = self.dbconn.cursor()
         self.table_columns = dict()
 
@@ -30,37 +33,39 @@ class ItemDB(object):
 
         items = list(filter(is_priced_rare_item, [preprocess_item(x, stash_id, default_price=stash_price) for x in raw_items]))
 
-        previous_stash_content = self.get_stash_content(stash_id)
-        num_sold = self.mark_deleted_items_as_sold(previous_stash_content, stash_id, items)
-        self.reset_seen_date_for_modified_items(previous_stash_content, stash_id, items)
+        with metrics.timer('diff'):
+            previous_stash_content = self.get_stash_content(stash_id)
+            num_sold = self.mark_deleted_items_as_sold(previous_stash_content, stash_id, items)
+            self.reset_seen_date_for_modified_items(previous_stash_content, stash_id, items)
         return items, num_sold
 
     def add_items(self, items):
-        self.add_to_stash(items)
-
-        items_by_type = defaultdict(lambda: [])
-        for item in items:
-            items_by_type[item['type']].append(item)
-
-        self.add_body_items(items_by_type[itemtype.BODY])
-        self.add_helmet_items(items_by_type[itemtype.HELMET])
-        self.add_gloves_items(items_by_type[itemtype.GLOVES])
-        self.add_boots_items(items_by_type[itemtype.BOOTS])
-        self.add_belt_items(items_by_type[itemtype.BELT])
-        self.add_shield_items(items_by_type[itemtype.SHIELD])
-        self.add_ring_items(items_by_type[itemtype.RING])
-        self.add_amulet_items(items_by_type[itemtype.AMULET])
-        self.add_wand_items(items_by_type[itemtype.WAND])
-        self.add_staff_items(items_by_type[itemtype.STAFF])
-        self.add_dagger_items(items_by_type[itemtype.DAGGER])
-        self.add_one_hand_sword_items(items_by_type[itemtype.ONE_HAND_SWORD])
-        self.add_two_hand_sword_items(items_by_type[itemtype.TWO_HAND_SWORD])
-        self.add_one_hand_axe_items(items_by_type[itemtype.ONE_HAND_AXE])
-        self.add_two_hand_axe_items(items_by_type[itemtype.TWO_HAND_AXE])
-        self.add_one_hand_mace_items(items_by_type[itemtype.ONE_HAND_MACE])
-        self.add_two_hand_mace_items(items_by_type[itemtype.TWO_HAND_MACE])
-        self.add_bow_items(items_by_type[itemtype.BOW])
-        self.add_sceptre_items(items_by_type[itemtype.SCEPTRE])
+        with metrics.timer('write'):
+            self.add_to_stash(items)
+
+            items_by_type = defaultdict(lambda: [])
+            for item in items:
+                items_by_type[item['type']].append(item)
+
+            self.add_body_items(items_by_type[itemtype.BODY])
+            self.add_helmet_items(items_by_type[itemtype.HELMET])
+            self.add_gloves_items(items_by_type[itemtype.GLOVES])
+            self.add_boots_items(items_by_type[itemtype.BOOTS])
+            self.add_belt_items(items_by_type[itemtype.BELT])
+            self.add_shield_items(items_by_type[itemtype.SHIELD])
+            self.add_ring_items(items_by_type[itemtype.RING])
+            self.add_amulet_items(items_by_type[itemtype.AMULET])
+            self.add_wand_items(items_by_type[itemtype.WAND])
+            self.add_staff_items(items_by_type[itemtype.STAFF])
+            self.add_dagger_items(items_by_type[itemtype.DAGGER])
+            self.add_one_hand_sword_items(items_by_type[itemtype.ONE_HAND_SWORD])
+            self.add_two_hand_sword_items(items_by_type[itemtype.TWO_HAND_SWORD])
+            self.add_one_hand_axe_items(items_by_type[itemtype.ONE_HAND_AXE])
+            self.add_two_hand_axe_items(items_by_type[itemtype.TWO_HAND_AXE])
+            self.add_one_hand_mace_items(items_by_type[itemtype.ONE_HAND_MACE])
+            self.add_two_hand_mace_items(items_by_type[itemtype.TWO_HAND_MACE])
+            self.add_bow_items(items_by_type[itemtype.BOW])
+            self.add_sceptre_items(items_by_type[itemtype.SCEPTRE])
 
     def mark_deleted_items_as_sold(self, previous_stash_content, stash_id, items):
         """
@@ -70,6 +75,7 @@ class ItemDB(object):
         item_ids = {x['id'] for x in items}
         deleted_items = [x[0] for x in previous_stash_content if x[0] not in item_ids]
         self.mark_as_sold(deleted_items)
+        metrics.count('items_sold', len(deleted_items))
         return len(deleted_items)
 
     def reset_seen_date_for_modified_items(self, previous_stash_content, stash_id, items):
@@ -81,6 +87,7 @@ class ItemDB(object):
         item_hashes = {x['stats']['Hash'] for x in items}
         modified_items = [x[0] for x in previous_stash_content if x[1] not in item_hashes]
         self.reset_seen_date(modified_items)
+        metrics.count('items_modified', len(modified_items))
 
     def get_stash_content(self, stash_id):
         """
@@ -126,7 +133,8 @@ class ItemDB(object):
         ))
 
     def commit(self):
-        self.dbconn.commit()
+        with metrics.timer('commit'):
+            self.dbconn.commit()
 
     def count(self, item_type=None):
         if item_type is None:
@@ -276,7 +284,8 @@ class ItemDB(object):
         Our AHK script will create an overlay for that stash tab.
         If a player has multiple GG tabs, the last updated one is active.
         This method stores item sizes & positions and updates the active stash id
-        for a stash tab named GG.
+        for a stash tab named GG. Every update increments PredictionsVersion, which
+        the api uses as ETag.
         """
         if len(stash['items']) == 0:
             return
@@ -285,9 +294,11 @@ class ItemDB(object):
         print("Updating GG Tab of", stash['accountName'])
 
         self.db.execute("""
-            INSERT INTO Players (AccountName, League, Predictions)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (AccountName, League) DO UPDATE SET Predictions = EXCLUDED.Predictions
+            INSERT INTO Players (AccountName, League, Predictions, PredictionsVersion)
+            VALUES (%s, %s, %s, 1)
+            ON CONFLICT (AccountName, League) DO UPDATE
+            SET Predictions = EXCLUDED.Predictions,
+                PredictionsVersion = Players.PredictionsVersion + 1
         """, (stash['accountName'], league_id, Json(predictions)))
 
     def get_stats(self):
@@ -344,32 +355,43 @@ def get_price(text):
     return value, currency_id
 
 
-def preprocess_item(item, stash_id, default_price=None):
+def preprocess_item(item, stash_id, default_price=None, verbose=True):
+    """
+    Parses the stats of a rare item and adds them to it, along with its type, league, stash and price.
+    Returns None if the item isn't a rare of a known type or can't be parsed.
+    :param verbose: Print items that can't be parsed
+    """
+    metrics.count('items_seen')
     try:
-        if item['frameType'] != rarity.RARE:
-            return None
+        with metrics.timer('prefilter'):
+            if item['frameType'] != rarity.RARE:
+                return None
 
-        item['type'] = itemtype.get_item_type(item)
-        if item['type'] == itemtype.UNKNOWN:
-            return None
+            item['type'] = itemtype.get_item_type(item)
+            if item['type'] == itemtype.UNKNOWN:
+                return None
 
-        item['league_id'] = league.get_id(item['league'])
+            item['league_id'] = league.get_id(item['league'])
 
-        item['stash_id'] = stash_id
-        item_price = get_price(item.get('note', None))
-        item['price'] = item_price if item_price is not None else default_price
+            item['stash_id'] = stash_id
+            item_price = get_price(item.get('note', None))
+            item['price'] = item_price if item_price is not None else default_price
 
-        item['stats'] = itemstats.parse_stats(item, item['type'])
-        item['stats']['ItemId'] = item['id']
-        item['stats']['Hash'] = hash_item(item['stats'])
+        with metrics.timer('parse'):
+            item['stats'] = itemstats.parse_stats(item, item['type'])
+            item['stats']['ItemId'] = item['id']
+            item['stats']['Hash'] = hash_item(item['stats'])
+        metrics.count('items_parsed')
         return item
 
     except ItemBannedException as ex:
         #print("Skipping {ex.item_type} with {ex.mod_text}".format(ex=ex))
-        pass
+        metrics.count('items_rejected')
 
     except ItemParserException as ex:
-        print(Terminal().bold_yellow(ex.msg))
+        metrics.count('items_rejected')
+        if verbose:
+            print(Terminal().bold_yellow(ex.msg))
 
     except Exception as ex:
         print(Terminal().bold_red("Exception while preprocessing item: ", json.dumps(item)))
@@ -385,9 +407,3 @@ def is_priced_rare_item(item):
         return False
     return True
 
-
-def hash_item(item):
-    h = hashlib.md5()
-    h.update(json.dumps(item, sort_keys=True).encode('utf-8'))
-    return h.hexdigest()
-
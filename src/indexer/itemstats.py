@@ -1,8 +1,12 @@
+import hashlib
 import json
 import re
 from collections import defaultdict
 
+import numpy as np
+
 from constants import itemtype
+from indexer import schema
 from util.collections import CaseInsensitiveCounter
 
 
@@ -2057,27 +2061,30 @@ def parse_corrupted(item, stats):
 
 
 def parse_armour_properties(item, stats):
-    stats['Quality'] = read_quality(item)
-    stats['Armour'] = read_int_property('Armour', item)
-    stats['Evasion'] = read_int_property('Evasion Rating', item)
-    stats['EnergyShield'] = read_int_property('Energy Shield', item)
+    properties = read_properties(item)
+    stats['Quality'] = properties.get('Quality', 0)
+    stats['Armour'] = properties.get('Armour', 0)
+    stats['Evasion'] = properties.get('Evasion Rating', 0)
+    stats['EnergyShield'] = properties.get('Energy Shield', 0)
 
 
 def parse_shield_properties(item, stats):
-    stats['Quality'] = read_quality(item)
-    stats['Armour'] = read_int_property('Armour', item)
-    stats['Evasion'] = read_int_property('Evasion Rating', item)
-    stats['EnergyShield'] = read_int_property('Energy Shield', item)
-    stats['Block'] = read_percent_property('Chance to Block', item)
+    properties = read_properties(item)
+    stats['Quality'] = properties.get('Quality', 0)
+    stats['Armour'] = properties.get('Armour', 0)
+    stats['Evasion'] = properties.get('Evasion Rating', 0)
+    stats['EnergyShield'] = properties.get('Energy Shield', 0)
+    stats['Block'] = properties.get('Chance to Block', 0)
 
 
 def parse_weapon_properties(item, stats):
-    stats['Quality'] = read_quality(item)
-    stats['PhysDamage'] = read_range_property('Physical Damage', item)
-    stats['EleDamage'] = read_range_property('Elemental Damage', item)
-    stats['ChaosDamage'] = read_range_property('Chaos Damage', item)
-    stats['AttacksPerSecond'] = read_float_property('Attacks per Second', item)
-    stats['CritChance'] = read_percent_property('Critical Strike Chance', item, scale=100)
+    properties = read_properties(item)
+    stats['Quality'] = properties.get('Quality', 0)
+    stats['PhysDamage'] = properties.get('Physical Damage', 0)
+    stats['EleDamage'] = properties.get('Elemental Damage', 0)
+    stats['ChaosDamage'] = properties.get('Chaos Damage', 0)
+    stats['AttacksPerSecond'] = properties.get('Attacks per Second', 0)
+    stats['CritChance'] = properties.get('Critical Strike Chance', 0)
 
 
 def parse_requirements(item, stats, level_only=False, ignore_others=False):
@@ -2107,56 +2114,85 @@ def parse_requirements(item, stats, level_only=False, ignore_others=False):
         stats['Req' + requirement['name']] = int(requirement['values'][0][0])
 
 
-def read_property(property_name, item, default_value=None):
-    for property in item['properties']:
-        if property['name'] == property_name:
-            return property['values']
-    return default_value
-
+class PropertyDecode(object):
+    """
+    A set of method generators to decode the values of a single item property.
+    The generated functions receive the property's value list as found in the
+    poe api json, e.g. [['+20%', 1]].
+    """
+    @staticmethod
+    def int():
+        return lambda values: int(values[0][0])
 
-def read_int_property(property_name, item, default_value=0):
-    values = read_property(property_name, item)
-    if values is None or len(values) == 0:
-        return default_value
-    return int(values[0][0])
+    @staticmethod
+    def float():
+        return lambda values: float(values[0][0])
 
+    @staticmethod
+    def percent(scale=1):
+        """
+        Returns the percentage (e.g. '6.50%') multiplied by scale, as integer.
+        """
+        return lambda values: int(float(values[0][0][:-1]) * scale)
 
-def read_float_property(property_name, item, default_value=0):
-    values = read_property(property_name, item)
-    if values is None or len(values) == 0:
-        return default_value
-    return float(values[0][0])
+    @staticmethod
+    def quality():
+        """
+        Returns the quality (e.g. '+20%') as integer.
+        """
+        return lambda values: int(values[0][0][1:-1])
 
+    @staticmethod
+    def range(property_name):
+        """
+        Decodes a property that can either be an integer or a range A-B.
+        Returns twice the average, to avoid rounding issues.
+        """
+        return lambda values: PropertyDecode._range(property_name, values)
 
-def read_percent_property(property_name, item, default_value=0, scale=1):
-    values = read_property(property_name, item)
-    if values is None or len(values) == 0:
-        return default_value
-    return int(float(values[0][0][:-1]) * scale)
+    @staticmethod
+    def _range(property_name, values):
+        numbers = values[0][0].split('-')
+        if len(numbers) == 1:
+            return int(numbers[0]) * 2  # must be x2 because this is X-X range
+        elif len(numbers) == 2:
+            return int(numbers[0]) + int(numbers[1])
+        else:
+            raise ItemParserException("Invalid {} range: {}".format(property_name, values[0][0]))
+
+
+PROPERTY_DECODERS = {
+    'Quality': PropertyDecode.quality(),
+    'Armour': PropertyDecode.int(),
+    'Evasion Rating': PropertyDecode.int(),
+    'Energy Shield': PropertyDecode.int(),
+    'Chance to Block': PropertyDecode.percent(),
+    'Physical Damage': PropertyDecode.range('Physical Damage'),
+    'Elemental Damage': PropertyDecode.range('Elemental Damage'),
+    'Chaos Damage': PropertyDecode.range('Chaos Damage'),
+    'Attacks per Second': PropertyDecode.float(),
+    'Critical Strike Chance': PropertyDecode.percent(scale=100),
+}
 
 
-def read_range_property(property_name, item, default_value=0):
+def read_properties(item):
     """
-    Reads a property that can either be an integer or a range A-B.
-    Returns twice the average, to avoid rounding issues.
+    Decodes all known properties of the item in a single pass over its property list.
+    Returns a dict of property name -> decoded value. Properties without a decoder in
+    PROPERTY_DECODERS or without any values are left out, so callers should use a default.
+    If a property appears more than once, the first one wins.
     """
-    values = read_property(property_name, item)
-    if values is None or len(values) == 0:
-        return default_value
-    numbers = values[0][0].split('-')
-    if len(numbers) == 1:
-        return int(numbers[0]) * 2  # must be x2 because this is X-X range
-    elif len(numbers) == 2:
-        return int(numbers[0]) + int(numbers[1])
-    else:
-        raise ItemParserException("Invalid {} range: {}".format(property_name, values[0][0]))
-
-
-def read_quality(item):
-    for property in item['properties']:
-        if property['name'] == 'Quality':
-            return int(property['values'][0][0][1:-1])
-    return 0
+    result = dict()
+    for property in item.get('properties', ()):
+        name = property['name']
+        if name in result:
+            continue
+        decode = PROPERTY_DECODERS.get(name)
+        values = property['values']
+        if decode is None or len(values) == 0:
+            continue
+        result[name] = decode(values)
+    return result
 
 
 PARSERS = {
@@ -2189,6 +2225,85 @@ def parse_stats(item, item_type):
     return stats
 
 
+def hash_item(item):
+    h = hashlib.md5()
+    h.update(json.dumps(item, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+class ItemBlock(object):
+    def __init__(self, item_type, ids, hashes, columns, num_rejected=0):
+        """
+        Parsed stats of many items of the same type, stored column by column.
+
+        :param item_type:    Item type of all items in the block
+        :param ids:          Array of item ids
+        :param hashes:       Array of stat hashes, in the same order as ids
+        :param columns:      Dict of column name -> array, one value per item.
+                             Columns follow the item type's table in create_schema.sql.
+        :param num_rejected: Number of items that were skipped because they couldn't be parsed
+        """
+        self.item_type = item_type
+        self.ids = ids
+        self.hashes = hashes
+        self.columns = columns
+        self.num_rejected = num_rejected
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, column_names):
+        """
+        Returns an iterator over value tuples in the order given by column_names,
+        e.g. for writing the block to a database table.
+        ItemId and Hash can be requested like any other column.
+        Values are plain python ints, bools and floats, which psycopg2 can adapt (numpy scalars it can't).
+        """
+        columns = {k.lower(): v for k, v in self.columns.items()}
+        columns['itemid'] = self.ids
+        columns['hash'] = self.hashes
+        return zip(*[np.asarray(columns[x.lower()]).tolist() for x in column_names])
+
+
+def parse_batch(items, item_type):
+    """
+    Parses a list of raw items (as found in the poe api json) of a single type
+    and returns an ItemBlock with one array per stat column.
+    Items that are banned or can't be parsed are skipped and counted as rejected.
+    """
+    table = schema.get_table(item_type)
+    ids = []
+    hashes = []
+    parsed = []
+    num_rejected = 0
+    for item in items:
+        try:
+            stats = parse_stats(item, item_type)
+        except ItemParserException:
+            num_rejected += 1
+            continue
+        stats['ItemId'] = item['id']
+        stats['Hash'] = hash_item(stats)
+        ids.append(item['id'])
+        hashes.append(stats['Hash'])
+        parsed.append(stats)
+
+    columns = dict()
+    for name, sql_type in table.columns:
+        if name in ('ItemId', 'Hash'):
+            continue
+        dtype = schema.get_dtype(sql_type)
+        values = [x[name] for x in parsed]
+        if np.issubdtype(dtype, np.integer):
+            # Some properties are parsed as floats but stored as integers
+            columns[name] = np.rint(np.array(values, dtype=np.float64)).astype(dtype)
+        else:
+            columns[name] = np.array(values, dtype=dtype)
+
+    return ItemBlock(item_type, np.array(ids, dtype=object), np.array(hashes, dtype=object),
+                     columns, num_rejected)
+
+
 SKILLS = {
     'None': 0,
     'Purity of Fire': 1,
@@ -1,5 +1,10 @@
 import unittest
-from indexer.itemstats import parse_ring
+
+import numpy as np
+import psycopg2.extensions
+
+from constants import itemtype
+from indexer.itemstats import parse_batch, parse_ring, parse_weapon_properties, read_properties
 
 class RingTests(unittest.TestCase):
     def setUp(self):
@@ -92,3 +97,81 @@ class RingTests(unittest.TestCase):
 
         self.item['explicitMods'] = ['3 Life Regenerated per second']
         self.assertEqual(30, parse_ring(self.item)['LifeRegen'])
+
+
+class PropertyTests(unittest.TestCase):
+    def setUp(self):
+        self.item = {
+            'properties': [
+                {'name': 'One Handed Sword', 'values': []},
+                {'name': 'Quality', 'values': [['+14%', 1]]},
+                {'name': 'Physical Damage', 'values': [['20-41', 1]]},
+                {'name': 'Elemental Damage', 'values': [['7-14', 4], ['3', 5]]},
+                {'name': 'Critical Strike Chance', 'values': [['6.50%', 0]]},
+                {'name': 'Attacks per Second', 'values': [['1.55', 1]]},
+            ]
+        }
+
+    def test_read_properties(self):
+        properties = read_properties(self.item)
+        self.assertEqual(14, properties['Quality'])
+        self.assertEqual(61, properties['Physical Damage'])
+        self.assertEqual(21, properties['Elemental Damage'])
+        self.assertEqual(650, properties['Critical Strike Chance'])
+        self.assertEqual(1.55, properties['Attacks per Second'])
+        self.assertNotIn('One Handed Sword', properties)
+
+    def test_weapon_properties(self):
+        stats = {}
+        parse_weapon_properties(self.item, stats)
+        self.assertEqual(14, stats['Quality'])
+        self.assertEqual(61, stats['PhysDamage'])
+        self.assertEqual(0, stats['ChaosDamage'])
+
+    def test_single_value_range(self):
+        self.item['properties'] = [{'name': 'Chaos Damage', 'values': [['12', 7]]}]
+        self.assertEqual(24, read_properties(self.item)['Chaos Damage'])
+
+
+class BatchTests(unittest.TestCase):
+    def make_ring(self, item_id, mods):
+        return {
+            'id': item_id,
+            'corrupted': False,
+            'sockets': [],
+            'explicitMods': mods,
+        }
+
+    def test_parse_batch(self):
+        items = [
+            self.make_ring('a', ['+13 to maximum Life']),
+            self.make_ring('b', ['+40 to Strength']),
+        ]
+        block = parse_batch(items, itemtype.RING)
+        self.assertEqual(2, len(block))
+        self.assertEqual(['a', 'b'], list(block.ids))
+        self.assertEqual([13, 0], list(block.columns['Life']))
+        self.assertEqual([0, 40], list(block.columns['Strength']))
+        self.assertEqual(np.int16, block.columns['Life'].dtype)
+        self.assertEqual(np.bool_, block.columns['Corrupted'].dtype)
+
+    def test_parse_batch_rejects_unknown_mods(self):
+        items = [
+            self.make_ring('a', ['+13 to maximum Life']),
+            self.make_ring('b', ['Something nobody has ever seen']),
+        ]
+        block = parse_batch(items, itemtype.RING)
+        self.assertEqual(1, len(block))
+        self.assertEqual(1, block.num_rejected)
+
+    def test_rows(self):
+        block = parse_batch([self.make_ring('a', ['+13 to maximum Life'])], itemtype.RING)
+        rows = list(block.rows(['ItemId', 'Life']))
+        self.assertEqual([('a', 13)], rows)
+
+    def test_rows_can_be_inserted(self):
+        block = parse_batch([self.make_ring('a', ['+13 to maximum Life'])], itemtype.RING)
+        row = next(block.rows(['ItemId', 'Hash', 'Life', 'Corrupted', 'DoubledInBreach']))
+        # Like cursor.mogrify / execute_values, which adapt every value of a row
+        values = [psycopg2.extensions.adapt(x).getquoted() for x in row]
+        self.assertEqual([b'13', b'false', b'false'], values[2:])
@@ -3,9 +3,11 @@ import cProfile
 import pstats
 import sys
 
+from .gg_tabs import GGTabWorker
 from .indexer import Indexer, load_next_change_id
 from .itemdb import ItemDB
 from .poeapi import PoEApi
+from util import metrics
 
 
 def main(args):
@@ -13,10 +15,21 @@ def main(args):
         pr = cProfile.Profile()
         pr.enable()
 
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+
+    metrics_log = open(args.metrics_log, 'a') if args.metrics_log is not None else None
+
     next_change_id = load_next_change_id() if args.id is None else args.id
     db = ItemDB(args.db)
     api = PoEApi()
-    indexer = Indexer(db, api, next_change_id)
+    gg_tab_worker = None
+    if args.gg_tabs:
+        # Only import the predictor (and its model dependencies) when it is needed
+        from predict.predictor import Predictor
+        gg_tab_worker = GGTabWorker(ItemDB(args.db), Predictor(db_access_string=args.db))
+        gg_tab_worker.start()
+    indexer = Indexer(db, api, next_change_id, metrics_log=metrics_log, gg_tab_worker=gg_tab_worker)
 
     if args.max_updates > 0:
         for i in range(args.max_updates):
@@ -24,6 +37,9 @@ def main(args):
     else:
         indexer.run()
 
+    if gg_tab_worker is not None:
+        gg_tab_worker.stop()
+
     if args.profile:
         pr.disable()
         ps = pstats.Stats(pr, stream=sys.stdout).sort_stats('cumulative')
@@ -36,6 +52,10 @@ def parse_args():
     ap.add_argument('--max-updates', type=int, default=0, help='End program after this many updates')
     ap.add_argument('--profile', default=False, action='store_true')
     ap.add_argument('--db', default="dbname='poeria' user='benjamin'", help='Database credentials')
+    ap.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port')
+    ap.add_argument('--gg-tabs', default=False, action='store_true',
+                    help='Precompute the predictions of tabs named GG in a background thread')
+    ap.add_argument('--metrics-log', help='Append per-update JSON lines to this file instead of stdout')
     return ap.parse_args()
 
 
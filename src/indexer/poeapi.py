@@ -4,6 +4,8 @@ from simplejson import JSONDecodeError
 import requests
 import requests.exceptions
 
+from util import metrics
+
 
 class PoEApi(object):
     def __init__(self, min_seconds_between_requests = 5):
@@ -17,8 +19,10 @@ class PoEApi(object):
         while True:
             try:
                 self.rate_limit()
-                req = requests.get(url, timeout=5)
-                response = req.json()
+                with metrics.timer('fetch'):
+                    req = requests.get(url, timeout=5)
+                with metrics.timer('decode'):
+                    response = req.json()
                 assert 'next_change_id' in response, "Invalid Response: " + req.text
                 return response
             except requests.exceptions.Timeout:
@@ -41,5 +45,6 @@ class PoEApi(object):
         if seconds_since_last_request < self.min_seconds_between_requests:
             wait_time = self.min_seconds_between_requests - seconds_since_last_request
             print("too fast, waiting for", wait_time, "seconds")
-            time.sleep(wait_time)
+            with metrics.timer('rate_limit'):
+                time.sleep(wait_time)
         self.last_request_time = time.time()
@@ -0,0 +1,96 @@
+import os
+import re
+
+import numpy as np
+
+from constants import itemtype
+
+
+class Table(object):
+    def __init__(self, name, columns):
+        """
+        Layout of a single table as defined in create_schema.sql.
+
+        :param name:    Table name, spelled as in the schema file (e.g. OneHandSwordItems)
+        :param columns: List of (column name, sql type) tuples, in schema order
+        """
+        self.name = name
+        self.columns = columns
+
+    def column_names(self):
+        return [x[0] for x in self.columns]
+
+    def column_type(self, column):
+        for name, sql_type in self.columns:
+            if name.lower() == column.lower():
+                return sql_type
+        raise KeyError('{} has no column {}'.format(self.name, column))
+
+    def dtypes(self):
+        """
+        Returns a dict of column name -> numpy dtype.
+        """
+        return {name: get_dtype(sql_type) for name, sql_type in self.columns}
+
+
+# NumPy types used to hold the values of each postgres column type.
+# Anything not listed here (text, char, uuid, ...) is stored as object.
+SQL_DTYPES = {
+    'smallint': np.int16,
+    'integer': np.int32,
+    'bigint': np.int64,
+    'real': np.float32,
+    'bool': np.bool_,
+    'boolean': np.bool_,
+    'timestamp': 'datetime64[us]',
+}
+
+
+def get_dtype(sql_type):
+    """
+    Returns the numpy dtype for the given postgres column type.
+    """
+    return SQL_DTYPES.get(sql_type.split('(')[0].lower(), object)
+
+
+def schema_filename():
+    basedir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    return os.path.join(basedir, 'create_schema.sql')
+
+
+def load_schema(filename=None):
+    """
+    Parses the CREATE TABLE statements of the schema file.
+    Returns a dict of lowercase table name -> Table.
+    """
+    with open(filename or schema_filename(), 'r') as fp:
+        sql = fp.read()
+
+    tables = dict()
+    for match in re.finditer(r'CREATE TABLE IF NOT EXISTS (\w+) \((.*?)\n\)', sql, re.DOTALL):
+        columns = []
+        for line in match.group(2).split('\n'):
+            line = line.strip().rstrip(',')
+            if len(line) == 0:
+                continue
+            name, sql_type = line.split()[:2]
+            columns.append((name, sql_type))
+        tables[match.group(1).lower()] = Table(match.group(1), columns)
+    return tables
+
+
+TABLES = load_schema()
+
+
+def get_table(item_type):
+    """
+    Returns the Table that stores the stats of the given item type.
+    """
+    return TABLES[(itemtype.get_name(item_type) + 'Items').replace('_', '').lower()]
+
+
+def get_columns(item_type):
+    """
+    Returns the column names of the item type's table, in schema order.
+    """
+    return get_table(item_type).column_names()
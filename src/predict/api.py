@@ -1,28 +1,180 @@
+import gc
 import json
+import os
+import threading
 
 import flask
-import psycopg2
 
-from .predictor import Predictor
 from constants import league
+from predict.batcher import BatchTimeoutError, MicroBatcher
+from util.db import get_pool
 
 app = flask.Flask(__name__)
 
-predictor = Predictor()
+db_credentials = os.environ.get('DB_CREDENTIALS', "dbname='poeria' user='benjamin'")
+db_pool_size = int(os.environ.get('DB_POOL_SIZE', 10))
+# Live predictions of concurrent requests are batched for up to this many seconds
+batch_max_wait = float(os.environ.get('BATCH_MAX_WAIT', 0.005))
+batch_max_size = int(os.environ.get('BATCH_MAX_SIZE', 4096))
+# Limits of a single bulk prediction request
+bulk_max_items = int(os.environ.get('BULK_MAX_ITEMS', 10000))
+bulk_max_stashes = int(os.environ.get('BULK_MAX_STASHES', 100))
 
+# With PRELOAD_MODELS=1, all models are loaded when this module is imported. Run with
+# gunicorn --preload, so that happens once before the workers are forked and they all
+# share the same model memory. Otherwise, each worker loads models as they are needed.
+preload_models = os.environ.get('PRELOAD_MODELS') == '1'
 
-@app.route('/api/v1/{account_name}/{league}')
+predictor = None
+batcher = None
+batcher_pid = None
+predictor_lock = threading.Lock()
+
+
+@app.route('/api/v1/<account_name>/<league>')
 def get_predictions(account_name, league):
-    stash_id = get_stash_id(account_name, league)
-    return json.dumps(predictor.predict(stash_id))
+    # The ETag is the version of the stored predictions. If the client already has the
+    # current version, the predictions aren't even loaded from the db.
+    known_versions = [int(x) for x in flask.request.if_none_match.as_set() if x.isdigit()]
+    known_version = max(known_versions) if len(known_versions) > 0 else None
+    row = load_predictions(account_name, league, known_version)
+    if row is None:
+        flask.abort(404)
+
+    version, predictions = row
+    if version == known_version:
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(json.dumps(predictions), mimetype='application/json')
+    response.set_etag(str(version))
+    # Clients may keep the response, but have to revalidate it on every poll
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/v1/stash/<stash_id>/predictions')
+def get_live_predictions(stash_id):
+    """
+    Predicts the current contents of a stash tab, instead of returning what the indexer stored.
+    The items of concurrent requests are predicted together by the MicroBatcher.
+    """
+    predictor, batcher = get_predictor()
+    with get_pool(db_credentials, db_pool_size).connection() as dbconn:
+        predictions = predictor.predict(stash_id, predict_items=batcher.predict_items, dbconn=dbconn)
+    return flask.Response(json.dumps(predictions), mimetype='application/json')
+
+
+@app.route('/api/v1/predictions', methods=['POST'])
+def post_predictions():
+    """
+    Bulk predictions, for tools that would otherwise call the single tab endpoint in a loop.
+    Expects a JSON object with either or both of
+      items:   list of items as found in the stash api json, predicted without any db lookup
+      stashes: list of stash ids, predicted from their current contents
+    Returns {'items': [valuation of each item, in order], 'stashes': {stash id: predictions}}.
+    """
+    request = flask.request.get_json(silent=True)
+    if not isinstance(request, dict):
+        flask.abort(400, 'Expected a JSON object')
+    items = request.get('items', [])
+    stash_ids = request.get('stashes', [])
+    if not isinstance(items, list) or not isinstance(stash_ids, list) \
+            or not all(isinstance(x, str) for x in stash_ids):
+        flask.abort(400, 'items must be a list of items and stashes a list of stash ids')
+    if len(items) > bulk_max_items or len(stash_ids) > bulk_max_stashes:
+        flask.abort(413, 'At most {} items and {} stashes per request'.format(bulk_max_items, bulk_max_stashes))
+
+    predictor, batcher = get_predictor()
+    result = {'items': predictor.predict_raw_items(items, predict_items=batcher.predict_items), 'stashes': {}}
+    if len(stash_ids) > 0:
+        with get_pool(db_credentials, db_pool_size).connection() as dbconn:
+            result['stashes'] = predictor.predict_stashes(stash_ids, predict_items=batcher.predict_items,
+                                                          dbconn=dbconn)
+    return flask.Response(json.dumps(result), mimetype='application/json')
+
+
+@app.errorhandler(BatchTimeoutError)
+def batch_timeout(error):
+    return flask.Response(str(error), status=503, mimetype='text/plain')
+
+
+@app.route('/api/v1/ready')
+def ready():
+    """
+    Readiness check for the load balancer: the database is reachable and,
+    with PRELOAD_MODELS, the models are loaded.
+    """
+    try:
+        with get_pool(db_credentials, db_pool_size).connection() as dbconn:
+            db = dbconn.cursor()
+            db.execute('SELECT 1')
+        db_ok = True
+    except Exception:
+        db_ok = False
+    models_ok = predictor is not None or not preload_models
+    status = {
+        'ready': db_ok and models_ok,
+        'db': db_ok,
+        'models_loaded': len(predictor.loaded_models()) if predictor is not None else 0,
+    }
+    return flask.Response(json.dumps(status), status=200 if status['ready'] else 503, mimetype='application/json')
+
+
+def get_predictor():
+    """
+    Returns the Predictor and this process's MicroBatcher that runs it, creating them on first use.
+    The batcher's thread doesn't survive a fork, so each worker process starts its own.
+    """
+    global predictor, batcher, batcher_pid
+    with predictor_lock:
+        if predictor is None:
+            predictor = create_predictor()
+        if batcher is None or batcher_pid != os.getpid():
+            batcher = MicroBatcher(predictor.predict_items, max_batch_size=batch_max_size,
+                                   max_wait=batch_max_wait)
+            batcher_pid = os.getpid()
+        return predictor, batcher
+
+
+def create_predictor():
+    # Only import the predictor (and its model dependencies) when it is needed
+    from predict.predictor import Predictor
+    return Predictor(db_access_string=db_credentials)
+
+
+def preload():
+    """
+    Loads all models in this process, to be shared with worker processes forked from it.
+    """
+    global predictor
+    with predictor_lock:
+        predictor = create_predictor()
+        num_models = predictor.load_all_models()
+    print("Preloaded {} models".format(num_models))
+    # Move everything allocated so far out of the garbage collector's reach. Otherwise its
+    # bookkeeping writes to the pages of the models and the workers end up with private copies.
+    gc.freeze()
+
+
+def load_predictions(account_name, league_name, known_version=None):
+    """
+    Returns (version, predictions) of the player's GG tab that the indexer stored in Players,
+    or None if there are none. predictions is None if they are at known_version.
+    """
+    with get_pool(db_credentials, db_pool_size).connection() as dbconn:
+        db = dbconn.cursor()
+        db.execute("""
+            SELECT PredictionsVersion,
+                   CASE WHEN PredictionsVersion = %s THEN NULL ELSE Predictions END
+              FROM Players
+             WHERE AccountName = %s AND League = %s
+               AND Predictions IS NOT NULL
+        """, (known_version, account_name, league.get_id(league_name)))
+        return db.fetchone()
 
 
-def get_stash_id(account_name, league_name):
-    dbconn = psycopg2.connect("dbname='poeria' user='benjamin'")
-    db = dbconn.cursor()
-    db.execute('SELECT StashId FROM Players WHERE AccountName = %s AND League = %s',
-               (account_name, league.get_id(league_name)))
-    return db.fetchone()[0]
+if preload_models:
+    preload()
 
 
 if __name__ == '__main__':
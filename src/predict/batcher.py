@@ -0,0 +1,137 @@
+import threading
+import time
+import traceback
+from collections import defaultdict
+
+from util import metrics
+
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class BatchTimeoutError(Exception):
+    pass
+
+
+class BatchRequest(object):
+    def __init__(self, hashes, values, sockets):
+        self.hashes = hashes
+        self.values = values
+        self.sockets = sockets
+        self.time = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class MicroBatcher(object):
+    def __init__(self, predict_items, max_batch_size=4096, max_wait=0.005, timeout=30):
+        """
+        Collects the items of concurrent requests and predicts them in one batch per item type,
+        because models are much faster on one large matrix than on many small ones.
+
+        :param predict_items: Function with the signature of Predictor.predict_items. Only ever
+                              called from the batcher's thread.
+        :param max_batch_size: Run a batch as soon as it has this many items
+        :param max_wait:      Seconds the oldest request waits for more requests to join its batch
+        :param timeout:       Seconds a request waits for its batch before raising BatchTimeoutError
+        """
+        self.predict_items_fn = predict_items
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.queues = defaultdict(lambda: [])
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def predict_items(self, itype, hashes, values, sockets):
+        """
+        Same as Predictor.predict_items, but waits for the batch that includes these items.
+        """
+        request = BatchRequest(hashes, values, sockets)
+        with self.condition:
+            self.queues[itype].append(request)
+            self.condition.notify()
+        if not request.done.wait(self.timeout):
+            with self.condition:
+                # Don't predict it anymore if it's still queued
+                if request in self.queues[itype]:
+                    self.queues[itype].remove(request)
+            metrics.count('prediction_batch_timeouts')
+            raise BatchTimeoutError('Prediction batch not done after {} seconds'.format(self.timeout))
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def run(self):
+        while True:
+            batches = dict()
+            try:
+                with self.condition:
+                    self.condition.wait_for(lambda: any(len(x) > 0 for x in self.queues.values()))
+                    oldest = min(x[0].time for x in self.queues.values() if len(x) > 0)
+                    deadline = oldest + self.max_wait
+                    while not self.has_full_batch() and time.perf_counter() < deadline:
+                        self.condition.wait(deadline - time.perf_counter())
+                    batches = {itype: self.take_batch(queue) for itype, queue in self.queues.items() if len(queue) > 0}
+                for itype, requests in batches.items():
+                    self.run_batch(itype, requests)
+            except Exception as ex:
+                # Keep the thread alive, and don't leave anyone waiting for a batch that won't run
+                traceback.print_exc()
+                self.fail_all(batches, ex)
+
+    def fail_all(self, batches, error):
+        """
+        Fails the unfinished requests of the given batches and all queued requests.
+        """
+        with self.condition:
+            requests = [x for queue in self.queues.values() for x in queue]
+            self.queues.clear()
+        requests.extend(x for batch in batches.values() for x in batch)
+        for request in requests:
+            if not request.done.is_set():
+                request.error = error
+                request.done.set()
+
+    def has_full_batch(self):
+        return any(sum(len(x) for x in queue) >= self.max_batch_size for queue in self.queues.values())
+
+    def take_batch(self, queue):
+        """
+        Removes requests from the front of the queue until they add up to max_batch_size items.
+        Always takes at least one request, even if it is larger than that.
+        """
+        num_items = len(queue[0])
+        num_requests = 1
+        while num_requests < len(queue) and num_items + len(queue[num_requests]) <= self.max_batch_size:
+            num_items += len(queue[num_requests])
+            num_requests += 1
+        batch = queue[:num_requests]
+        del queue[:num_requests]
+        return batch
+
+    def run_batch(self, itype, requests):
+        hashes = [x for request in requests for x in request.hashes]
+        values = [x for request in requests for x in request.values]
+        sockets = [x for request in requests for x in request.sockets]
+        metrics.observe('prediction_batch_size', len(hashes), BATCH_SIZE_BUCKETS)
+        metrics.observe('prediction_batch_requests', len(requests), BATCH_SIZE_BUCKETS)
+        try:
+            with metrics.timer('prediction_batch'):
+                predictions = self.predict_items_fn(itype, hashes, values, sockets)
+        except Exception as ex:
+            traceback.print_exc()
+            for request in requests:
+                request.error = ex
+                request.done.set()
+            return
+
+        start = 0
+        for request in requests:
+            request.result = predictions[start:start + len(request)] if predictions is not None else None
+            start += len(request)
+            request.done.set()
@@ -1,95 +1,351 @@
+import hashlib
 import os
-import xgboost as xgb
+import threading
+import uuid
+from collections import defaultdict
+
 import joblib
+import numpy as np
 import psycopg2
+import psycopg2.extras
 import pandas as pd
 
 import constants.itemtype as itemtype
+from constants import rarity
+from indexer import itemstats
+from train.data_export import FEATURE_SPECS, featurize
+from train.feature_store import FeatureStore
+from util.collections import LRUCache
+
 
 class Predictor(object):
-    def __init__(self):
+    def __init__(self, feature_store_dir=None, db_access_string="dbname='poeria' user='benjamin'",
+                 batch_size=4096, cache_size=100000, persist_cache=False, feature_store_dataset='Standard.Both'):
+        """
+        :param feature_store_dir: Directory of FeatureStores written by data_export --format store.
+                                  Items found there aren't featurized again.
+        :param batch_size: Max number of items passed to a model at once
+        :param cache_size: Number of predictions kept in memory, by model version and item hash
+        :param persist_cache: Also store predictions in the PredictionCache table, so they
+                              outlive the process and are shared between api workers
+        :param feature_store_dataset: League and flavour of the stores to read, e.g. Standard.Both
+        """
         self.models = dict()
-        self.models[itemtype.RING] = joblib.load(model_filename('rings'))
-        self.dbconn = psycopg2.connect("dbname='poeria' user='benjamin'")
+        self.model_versions = dict()
+        # Models are loaded by whichever thread needs them first, e.g. a MicroBatcher
+        self.models_lock = threading.Lock()
+        self.db_access_string = db_access_string
+        self._dbconn = None
+        self._dbconn_pid = None
+        self.batch_size = batch_size
+        self.cache = LRUCache(cache_size)
+        self.persist_cache = persist_cache
+        self.feature_store_dir = feature_store_dir
+        self.feature_store_dataset = feature_store_dataset
+        self.feature_stores = dict()
+
+    @property
+    def dbconn(self):
+        """
+        Connects on first use, so creating a Predictor is cheap and a Predictor created before
+        forking (see load_all_models) doesn't share its connection with the child processes.
+        """
+        if self._dbconn is None or self._dbconn.closed or self._dbconn_pid != os.getpid():
+            self._dbconn = psycopg2.connect(self.db_access_string)
+            self._dbconn_pid = os.getpid()
+        return self._dbconn
+
+    def load_all_models(self):
+        """
+        Loads the models of all item types now instead of on first use.
+        :return: number of item types that have a model
+        """
+        return sum(1 for itype in itemtype.ALL_TYPES if self.get_model(itype) is not None)
 
-    def predict(self, stash_tab):
-        stash_items = self.load_stash_contents(stash_tab)
+    def get_model(self, itype):
+        """
+        Returns the model for the given item type, loading it from models/ on first use.
+        Returns None if there is no model for that type, or if the model wasn't trained
+        on the features that make_features computes (e.g. a model from before FeatureSpec).
+        """
+        if itype not in self.models:
+            filename = model_filename(itemtype.get_name(itype))
+            model, version = None, None
+            if os.path.exists(filename):
+                model, version = joblib.load(filename), model_version(filename)
+                if model_feature_names(model) != feature_names(itype):
+                    print("Not using {}, it wasn't trained on the current features of {}".format(
+                        filename, itemtype.get_name(itype)))
+                    model, version = None, None
+            with self.models_lock:
+                self.model_versions[itype] = version
+                self.models[itype] = model
+        return self.models[itype]
+
+    def loaded_models(self):
+        """
+        Returns the item types whose model is loaded. Safe to call while other threads load models.
+        """
+        with self.models_lock:
+            return [itype for itype, model in self.models.items() if model is not None]
+
+    def predict(self, stash_tab, predict_items=None, dbconn=None):
+        """
+        Returns the positions and sizes of the stash tab's items, grouped into valuable and worthless.
+        :param predict_items: Replaces self.predict_items, e.g. with MicroBatcher.predict_items
+        :param dbconn: Connection to load the stash tab with, instead of the predictor's own
+        """
+        predict_items = predict_items or self.predict_items
         result = {'worthless': [], 'valuable': []}
-        for itemtype, features, sizes in stash_items:
-            predictions = self.models[itemtype].predict(features)
+        for itype, rows in self.load_stash_contents(stash_tab, dbconn).items():
+            predictions = predict_items(itype, [row[5] for row in rows],
+                                        [row[7] for row in rows], [row[6] for row in rows])
+            if predictions is None:
+                continue
+            sizes = [{'x': row[1], 'y': row[2], 'w': row[3], 'h': row[4]} for row in rows]
             result['worthless'].extend(x for x, y in zip(sizes, predictions) if y == 0)
             result['valuable'].extend(x for x, y in zip(sizes, predictions) if y == 1)
         return result
 
-    def load_stash_contents(self, stash_tab):
+    def predict_stashes(self, stash_ids, predict_items=None, dbconn=None):
+        """
+        Same as predict, but for many stash tabs at once. Their items are loaded in one query
+        and each item type is predicted in one batch across all tabs.
+        Returns a dict of stash id -> result of predict.
+        """
+        predict_items = predict_items or self.predict_items
+        results = {x: {'worthless': [], 'valuable': []} for x in stash_ids}
+        for itype, rows in self.load_stash_contents(list(stash_ids), dbconn).items():
+            predictions = predict_items(itype, [row[5] for row in rows],
+                                        [row[7] for row in rows], [row[6] for row in rows])
+            if predictions is None:
+                continue
+            for row, prediction in zip(rows, predictions):
+                size = {'x': row[1], 'y': row[2], 'w': row[3], 'h': row[4]}
+                results[row[8]]['valuable' if prediction == 1 else 'worthless'].append(size)
+        return results
+
+    def predict_raw_items(self, items, predict_items=None):
+        """
+        Predicts items as found in the stash api json, without looking anything up in the db.
+        They are parsed like the indexer does, so items it already stored hit the same cache entries.
+        Returns one dict per item, in order, with the item's id, type and valuation
+        ('valuable' or 'worthless'). Items that can't be predicted have valuation None
+        and the reason in error.
+        """
+        predict_items = predict_items or self.predict_items
+        results = [{'id': item.get('id') if isinstance(item, dict) else None, 'type': None, 'valuation': None}
+                   for item in items]
+        groups = defaultdict(lambda: [])
+        for i, item in enumerate(items):
+            try:
+                if item['frameType'] != rarity.RARE:
+                    results[i]['error'] = 'not a rare item'
+                    continue
+                itype = itemtype.get_item_type(item)
+                if itype == itemtype.UNKNOWN:
+                    results[i]['error'] = 'unsupported item type'
+                    continue
+                results[i]['type'] = itemtype.get_name(itype)
+                stats = itemstats.parse_stats(item, itype)
+                stats['ItemId'] = item['id']
+            except itemstats.ItemParserException as ex:
+                results[i]['error'] = ex.msg
+                continue
+            except (KeyError, TypeError, ValueError):
+                results[i]['error'] = 'malformed item'
+                continue
+            except Exception as ex:
+                # Some affix rules raise plain exceptions, e.g. for a skill granted twice.
+                # One bad item must not fail the whole request.
+                results[i]['error'] = str(ex)
+                continue
+            groups[itype].append((i, stats))
+
+        for itype, group in groups.items():
+            spec = FEATURE_SPECS[itype]
+            # Formatted like the Hash uuid column, as selected by STASH_CONTENTS_QUERY
+            hashes = [str(uuid.UUID(itemstats.hash_item(stats))) for i, stats in group]
+            values = [[stats[x] for x in spec.numeric_columns] for i, stats in group]
+            sockets = [stats.get('Sockets', '') for i, stats in group]
+            predictions = predict_items(itype, hashes, values, sockets)
+            for n, (i, stats) in enumerate(group):
+                if predictions is None:
+                    results[i]['error'] = 'no model for item type'
+                else:
+                    results[i]['valuation'] = 'valuable' if predictions[n] == 1 else 'worthless'
+        return results
+
+    def predict_items(self, itype, hashes, values, sockets):
+        """
+        Returns the predictions for items of one type, as selected by STASH_CONTENTS_QUERY.
+        Only items whose hash isn't in the prediction cache for the current model are passed to the model.
+        Their features are read from the feature store if it has them, otherwise they are computed.
+        Returns None if there is no model for the item type.
+        """
+        if self.get_model(itype) is None:
+            return None
+        version = self.model_versions[itype]
+        predictions = np.zeros(len(hashes), dtype=np.int64)
+        missing = []
+        for i, item_hash in enumerate(hashes):
+            prediction = self.cache.get((version, item_hash))
+            if prediction is None:
+                missing.append(i)
+            else:
+                predictions[i] = prediction
+
+        if len(missing) > 0 and self.persist_cache:
+            stored = self.load_cached_predictions(version, [hashes[i] for i in missing])
+            for i in missing:
+                if hashes[i] in stored:
+                    predictions[i] = stored[hashes[i]]
+                    self.cache.put((version, hashes[i]), stored[hashes[i]])
+            missing = [i for i in missing if hashes[i] not in stored]
+
+        if len(missing) > 0:
+            stored = self.load_stored_features(itype, [hashes[i] for i in missing])
+            new_predictions = {item_hash: int(x) for item_hash, x in
+                               zip(stored.index, self.predict_features(itype, stored))} if len(stored) > 0 else {}
+            computed = [i for i in missing if hashes[i] not in new_predictions]
+            if len(computed) > 0:
+                features = self.make_features(itype, [values[i] for i in computed], [sockets[i] for i in computed])
+                new_predictions.update((hashes[i], int(x)) for i, x in
+                                       zip(computed, self.predict_features(itype, features)))
+            predictions[missing] = [new_predictions[hashes[i]] for i in missing]
+            for item_hash, prediction in new_predictions.items():
+                self.cache.put((version, item_hash), prediction)
+            if self.persist_cache:
+                self.store_cached_predictions(version, new_predictions)
+        return predictions
+
+    def load_cached_predictions(self, version, hashes):
+        """
+        Returns a dict of item hash -> prediction from the PredictionCache table.
+        """
         db = self.dbconn.cursor()
-        return [
-            self.load_rings(stash_tab, db)
-        ]
-
-    def load_rings(self, stash_tab, db):
-        db.execute("""
-        SELECT X, Y, W, H,   -- 4
-               Corrupted, Sockets, DoubledInBreach,  -- 7
-               Strength, Dexterity, Intelligence,    -- 10
-               Life, Mana, Evasion, EnergyShield,    -- 14
-               Accuracy, CritChance, AttackSpeed, CastSpeed,   -- 18
-               FireResist, ColdResist, LightningResist, ChaosResist,  -- 22
-               AddedPhysAttackDamage, AddedFireAttackDamage, AddedColdAttackDamage,  --25
-               AddedLightningAttackDamage, AddedChaosAttackDamage,  -- 27                                                  -- 32
-               IncreasedEleDamage, IncreasedWeaponEleDamage, IncreasedFireDamage, IncreasedColdDamage, IncreasedLightningDamage,
-               ItemRarity, LifeLeech, ManaLeech, LifeGainOnHit, LifeGainOnKill, LifeRegen, ManaGainOnKill, ManaRegen,   -- 40
-               AvoidFreeze, GrantedSkillId, ManaGainOnHit, DamageToMana, LightRadius  --45
-         WHERE r.ItemId = s.ItemId
-           AND s.StashId = %s
-           AND s.ItemType = %s
-           AND s.SoldTime :: date < date '2000-01-01'
-        """, (stash_tab, itemtype.RING))
-        features = []
-        sizes = []
+        db.execute('SELECT Hash, Prediction FROM PredictionCache WHERE ModelVersion = %s AND Hash = ANY(%s::uuid[])',
+                   (version, hashes))
+        return {str(item_hash): prediction for item_hash, prediction in db}
+
+    def store_cached_predictions(self, version, predictions):
+        """
+        :param predictions: dict of item hash -> prediction
+        """
+        db = self.dbconn.cursor()
+        psycopg2.extras.execute_values(
+            db, 'INSERT INTO PredictionCache (ModelVersion, Hash, Prediction) VALUES %s ON CONFLICT DO NOTHING',
+            [(version, k, v) for k, v in predictions.items()])
+        self.dbconn.commit()
+
+    def predict_features(self, itype, features):
+        """
+        Runs the item type's model on a feature frame, in batches of up to batch_size rows.
+        Returns None if there is no model for the item type.
+        """
+        model = self.get_model(itype)
+        if model is None:
+            return None
+        if len(features) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([model.predict(features.iloc[i:i + self.batch_size])
+                               for i in range(0, len(features), self.batch_size)])
+
+    def load_stash_contents(self, stash_tab, dbconn=None):
+        """
+        Loads all unsold items in the stash tab, of all item types, in a single query.
+        Returns a dict of item type -> rows of (item type, x, y, w, h, hash, sockets, stats, stash id).
+        :param stash_tab: Stash id, or a list of stash ids to load all of them
+        """
+        dbconn = dbconn or self.dbconn
+        db = dbconn.cursor()
+        if isinstance(stash_tab, list):
+            db.execute(MULTI_STASH_CONTENTS_QUERY, {'stash_ids': stash_tab})
+        else:
+            db.execute(STASH_CONTENTS_QUERY, {'stash_id': stash_tab})
+        groups = defaultdict(lambda: [])
         for row in db:
-            sizes.append({'x':row[0], 'y':row[1], 'w':row[2], 'h':row[3]})
-            features.append({
-                'Corrupted': row[3],
-                'HasSocket': len(row[6]),
-                'HasWhiteSocket': 1 if row[6] == 'W' else 0,
-                'DoubledInBreach': row[7],
-                'Strength': row[8],
-                'Dexterity': row[9],
-                'Intelligence': row[10],
-                'Life': row[11],
-                'Mana': row[12],
-                'Evasion': row[13],
-                'EnergyShield': row[14],
-                'Accuracy': row[15],
-                'CritChance': row[16],
-                'AttackSpeed': row[17],
-                'CastSpeed': row[18],
-                'TotalEleResist': row[19] + row[20] + row[21],
-                'ChaosResist': row[22],
-                'AddedPhysAttackDamage': row[23],
-                'AddedFireAttackDamage': row[24],
-                'AddedColdAttackDamage': row[25],
-                'AddedLightningAttackDamage': row[26],
-                'AddedChaosAttackDamage': row[27],
-                'IncreasedEleDamage': row[28],
-                'IncreasedWeaponEleDamage': row[29],
-                'IncreasedFireDamage': row[30],
-                'IncreasedColdDamage': row[31],
-                'IncreasedLightningDamage': row[32],
-                'ItemRarity': row[33],
-                'LifeLeech': row[34],
-                'ManaLeech': row[35],
-                'LifeGainOnHit': row[36],
-                'LifeGainOnKill': row[37],
-                'LifeRegen': row[38],
-                'ManaGainOnKill': row[39],
-                'ManaRegen': row[40],
-                'ManaGainOnHit': row[41],
-                'DamageToMana': row[42],
-                'LightRadius': row[43],
-            })
-        return itemtype.RING, pd.DataFrame(features, dtype=int), sizes
+            groups[row[0]].append(row)
+        db.close()
+        # Don't keep a transaction open between requests
+        dbconn.rollback()
+        return groups
+
+    def make_features(self, itype, values, sockets):
+        """
+        Turns stats as selected by FeatureSpec.sql_array into the features
+        the item type's model was trained on.
+        """
+        return featurize(itype, FEATURE_SPECS[itype].to_frame(values, sockets))
+
+    def load_stored_features(self, itype, hashes):
+        """
+        Returns the features of the given item versions from the item type's FeatureStore,
+        indexed by Hash. Items not in the store are left out.
+        The store is memory-mapped, so all predictors on this machine share one copy of it.
+        """
+        if self.feature_store_dir is None:
+            return pd.DataFrame()
+        store = self.feature_stores.get(itype)
+        if store is None:
+            store = self.feature_stores[itype] = FeatureStore(
+                self.feature_store_dir, '{}.{}'.format(self.feature_store_dataset, itemtype.get_name(itype)))
+        if not store.exists():
+            return pd.DataFrame()
+        return store.lookup_hashes(hashes)
+
+
+def build_stash_contents_query(stash_condition='s.StashId = %(stash_id)s'):
+    """
+    Returns a query for the unsold items of a stash tab across all item tables.
+    Each table's stats are selected as one array (see FeatureSpec.sql_array),
+    so that all tables fit into a single UNION.
+    """
+    return '\n UNION ALL \n'.join(
+        """
+        SELECT s.ItemType, s.X, s.Y, s.W, s.H, s.Hash::text, {sockets}, {stats}, s.StashId::text
+          FROM StashContents s, {table} x
+         WHERE x.ItemId = s.ItemId
+           AND {stash_condition}
+           AND s.ItemType = {itype}
+           AND s.SoldTime :: date < date '2000-01-01'
+        """.format(table=spec.table.name, itype=itype, stats=spec.sql_array(), stash_condition=stash_condition,
+                   sockets='x.Sockets' if spec.has_sockets else "''::text")
+        for itype, spec in sorted(FEATURE_SPECS.items()))
+
+
+STASH_CONTENTS_QUERY = build_stash_contents_query()
+MULTI_STASH_CONTENTS_QUERY = build_stash_contents_query('s.StashId = ANY(%(stash_ids)s)')
+
+
+def model_version(filename):
+    """
+    Identifies a model by the md5 of its file, so that cached predictions of
+    a model become invalid when it is retrained.
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def model_feature_names(model):
+    """
+    Returns the names of the features a model was fit on, or None if it doesn't know them
+    (it wasn't fit on a frame).
+    """
+    names = getattr(model, 'feature_names_in_', None)
+    if names is None and hasattr(model, 'get_booster'):
+        names = model.get_booster().feature_names
+    return list(names) if names is not None else None
+
+
+def feature_names(itype):
+    """
+    Returns the columns of make_features for the item type, in order.
+    """
+    return list(featurize(itype, FEATURE_SPECS[itype].to_frame([])).columns)
 
 
 def model_filename(itemtype):
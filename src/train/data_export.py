@@ -1,10 +1,11 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import partial
-from itertools import groupby
 import dateutil.parser
 import pytz
 import os
 import argparse
+import multiprocessing
+import time
 
 import psycopg2
 import pandas as pd
@@ -12,12 +13,15 @@ import numpy as np
 
 import constants
 from constants import itemtype, currency, league
-from indexer import itemdb
+from constants.exchange_rates import ExchangeRates, ExchangeRateService
+from indexer import schema
+from train.feature_store import FeatureStore
 
 
 class DataExporter(object):
     def __init__(self, db, league=league.STANDARD, flavour='Both', league_end=None,
-                 min_valuable_price=2, max_worthless_price=1, fresh_seconds=7*24*60*60):
+                 min_valuable_price=2, max_worthless_price=1, fresh_seconds=7*24*60*60,
+                 exchange_rates=None, sql_features=False):
         """
         :param db:      psycopg2 db instance
         :param league:  League ID for which to export data
@@ -26,6 +30,10 @@ class DataExporter(object):
         :param min_valuable_price: Items sold at this or more are valuable
         :param max_worthless_price: Unsold items listed at less than this are worthless
         :param fresh_seconds: Only items that were on offer for this long can be worthless
+        :param exchange_rates: ExchangeRates, or dict of currency id -> value in chaos
+                               (current rates are fetched if not given)
+        :param sql_features: Let postgres compute quality, resistance and attribute features
+                             (see feature_select_list) instead of doing it in pandas
         """
         self.db = db
         self.league = league
@@ -34,115 +42,352 @@ class DataExporter(object):
         self.min_valuable_price = min_valuable_price
         self.max_worthless_price = max_worthless_price
         self.fresh_seconds = fresh_seconds
-        self.exchange_rates = currency.get_exchange_rates(constants.league.get_name(league))
+        self.sql_features = sql_features
+        if exchange_rates is None:
+            exchange_rates = currency.get_exchange_rates(constants.league.get_name(league))
+        if isinstance(exchange_rates, dict):
+            exchange_rates = ExchangeRates.from_rates(exchange_rates)
+        self.exchange_rates = exchange_rates
+
+    def export(self, itype, filename, chunksize=None, output_format='csv'):
+        """
+        Exports all items of the given type to a file.
+        :param chunksize: If set, stream the items from the db in chunks of this many rows
+                          instead of loading all at once.
+        :param output_format: 'csv' or 'npz' (see write_npz)
+        :return: number of exported items
+        """
+        print()
+        print("Exporting ", filename)
+        writer = ItemWriter(filename, output_format)
+        num_rows = 0
+        for chunk in self.iter_chunks(itype, chunksize):
+            # Continue the index where the last chunk ended, so row ids stay unique in the file
+            chunk.index += num_rows
+            num_rows += len(chunk)
+            writer.write(self.transform(itype, chunk))
+        writer.close()
+        print("Exported {} of {} items".format(writer.num_items, num_rows))
+        return writer.num_items
+
+    def export_incremental(self, itype, outdir, chunksize=None, output_format='csv'):
+        """
+        Exports only the items that were seen or sold since the last incremental export
+        of this item type, league and flavour.
+        The first run exports everything to <League>.<Flavour>.<TYPE>.<format>, named like the
+        watermark, so exports of several leagues can share outdir. Later runs write the changes to
+        <League>.<Flavour>.<TYPE>.delta-<time of previous run>.<format>, plus a .removed file that
+        lists the ids of items which changed but are no longer valuable or worthless. Rows are
+        indexed by ItemId, so deltas can be applied to the snapshot with merge_delta.
+        :return: number of exported items
+        """
+        watermark_file = self.watermark_filename(itype, outdir)
+        since = load_watermark(watermark_file)
+        now = datetime.now(tz=pytz.UTC)
+        name = self.dataset_name(itype)
+        if since is None:
+            filename = os.path.join(outdir, name + '.' + output_format)
+        else:
+            filename = os.path.join(outdir, '{}.delta-{}.{}'.format(
+                name, since.strftime('%Y%m%dT%H%M%S'), output_format))
 
-    def export(self, itype, filename):
         print()
         print("Exporting ", filename)
-        items = self.get_data_from_db(itype)
-        self.categorize(items)
-        if is_weapon(itype):
-            normalize_weapon_quality(items)
-        if is_armour(itype):
-            normalize_armour_quality(items)
-        if can_have_six_sockets(itype):
-            featurize_sockets(items)
-        combine_resistances(items)
-        apply_attribute_boni(items)
-        remove_columns('ItemId', 'Hash', 'Sockets', 'GrantedSkillId', 'GrantedSkillLevel',
-                       'AddedTime', 'SoldTime', 'SeenTime', 'Price', 'Currency')
-        items.to_csv(filename)
+        writer = ItemWriter(filename, output_format)
+        removed = []
+        num_rows = 0
+        for chunk in self.iter_chunks(itype, chunksize, since=since, now=now):
+            chunk.index = chunk.ItemId.str.strip()
+            num_rows += len(chunk)
+            items = self.transform(itype, chunk, now=now)
+            removed.extend(chunk.index.difference(items.index))
+            writer.write(items)
+        writer.close()
+
+        if since is not None:
+            with open(filename + '.removed', 'w') as fp:
+                fp.writelines(x + '\n' for x in removed)
+        store_watermark(watermark_file, now - WATERMARK_SAFETY_MARGIN)
+        print("Exported {} of {} changed items".format(writer.num_items, num_rows))
+        return writer.num_items
+
+    def export_to_store(self, itype, outdir, chunksize=None):
+        """
+        Appends all items that were seen or sold since the last call to the item type's
+        FeatureStore in outdir, and their labels to a second store <name>.labels.
+        The features store has every item, including unsold and too fresh ones, so the predictor
+        can read the features of any listed item from it (see Predictor.load_stored_features).
+        The labels store only has the items that are valuable or worthless; the others are
+        marked as removed from it. The first call adds all items.
+        :return: number of appended items
+        """
+        store = FeatureStore(outdir, self.dataset_name(itype))
+        labels = FeatureStore(outdir, self.dataset_name(itype) + '.labels')
+        watermark_file = store.features_filename + '.watermark'
+        since = load_watermark(watermark_file)
+        now = datetime.now(tz=pytz.UTC)
+
+        print()
+        print("Appending to ", store.features_filename)
+        num_items = 0
+        num_labeled = 0
+        for chunk in self.iter_chunks(itype, chunksize, since=since, now=now):
+            if len(chunk) == 0:
+                continue
+            chunk.index = chunk.ItemId.str.strip()
+            categorized = self.categorize(chunk.copy(), now=now)
+            unlabeled = chunk.index.difference(categorized.index)
+            labels.remove([x for x in unlabeled if x in labels.index()] if labels.exists() else [])
+            labels.append(categorized[['valuable']])
+            num_labeled += len(categorized)
+
+            hashes = chunk.Hash.astype(str)
+            store.append(compact_dtypes(featurize(itype, chunk, self.sql_features)), hashes=hashes)
+            num_items += len(chunk)
+
+        store_watermark(watermark_file, now - WATERMARK_SAFETY_MARGIN)
+        print("Appended {} changed items ({} labeled), {} rows in store".format(num_items, num_labeled, len(store)))
+        return num_items
+
+    def dataset_name(self, itype):
+        return '{}.{}.{}'.format(constants.league.get_name(self.league), self.flavour, itemtype.get_name(itype))
+
+    def watermark_filename(self, itype, outdir):
+        return os.path.join(outdir, self.dataset_name(itype) + '.watermark')
+
+    def iter_chunks(self, itype, chunksize=None, since=None, now=None):
+        """
+        Yields the items from the db, either all in one frame or in chunks of chunksize rows.
+        """
+        if chunksize is None:
+            yield self.get_data_from_db(itype, since=since, now=now)
+        else:
+            yield from self.iter_data_from_db(itype, chunksize, since=since, now=now)
 
-    def get_data_from_db(self, itype):
+    def transform(self, itype, items, sql_features=None, now=None):
+        """
+        Turns raw items from the db into features for training.
+        Every row is transformed independently, so this can be applied to chunks of the data.
+        :param sql_features: Whether the items were queried with sql_features.
+                             Defaults to the exporter's setting.
+        :param now: Time of the export, see categorize
+        """
+        if sql_features is None:
+            sql_features = self.sql_features
+        items = self.categorize(items, now=now)
+        return featurize(itype, items, sql_features)
+
+    def build_query(self, itype, since=None, sql_features=None, now=None):
+        """
+        Returns the SQL query, its parameters and the names of the columns it selects.
+        :param since: If set, only select items that were seen or sold after this time,
+                      or that stopped being too fresh (see categorize) between since and now.
+        :param sql_features: Select features computed by postgres (see feature_select_list)
+                             instead of the raw columns. Defaults to the exporter's setting.
+        :param now: Time of the export, defaults to the current time
+        """
         tablename = (itemtype.get_name(itype) + 'Items').replace('_', '')
-        columns = ['s.Price', 's.Currency', 's.AddedTime', 's.SoldTime', 's.SeenTime'] + \
-                  ['x.' + x for x in DB_COLUMNS[itype]]
+        select = self.select_list(itype, sql_features)
         min_league = self.league + 1 if self.flavour == 'Hardcore' else self.league
         max_league = self.league if self.flavour == 'Softcore' else self.league + 1
-        sql = 'SELECT ' + ', '.join(columns) + \
+        sql = 'SELECT ' + ', '.join('{} AS {}'.format(*x) for x in select) + \
               '  FROM StashContents s, ' + tablename + ' x ' + \
               ' WHERE s.ItemId = x.ItemId ' + \
               '   AND s.League >= %(min_league)s ' + \
               '   AND s.League <= %(max_league)s '
-        items = pd.read_sql(
-            sql, self.db, params={'min_league': min_league, 'max_league': max_league})
+        params = {'min_league': min_league, 'max_league': max_league}
+        if since is not None:
+            # Unsold items become worthless once they are no longer fresh, without being seen again
+            if now is None:
+                now = datetime.now(tz=pytz.UTC)
+            fresh = timedelta(seconds=self.fresh_seconds)
+            sql += '   AND (GREATEST(s.SeenTime, s.SoldTime) > %(since)s ' + \
+                   '        OR (s.AddedTime > %(fresh_since)s AND s.AddedTime <= %(fresh_until)s)) '
+            params.update(since=since, fresh_since=since - fresh, fresh_until=now - fresh)
+        return sql, params, [x[1] for x in select]
+
+    def select_list(self, itype, sql_features=None):
+        """
+        Returns the (SQL expression, column name) pairs selected by build_query.
+        """
+        if sql_features is None:
+            sql_features = self.sql_features
+        select = [('s.' + x, x) for x in STASH_COLUMNS]
+        if sql_features:
+            select += feature_select_list(itype)
+        else:
+            select += [('x.' + x, x) for x in DB_COLUMNS[itype]]
+        return select
+
+    def query_dtypes(self, itype, sql_features=None):
+        """
+        Returns a dict of column name -> numpy dtype for the numeric and bool columns
+        selected by build_query, according to create_schema.sql and the casts in the query.
+        """
+        tables = {'s': schema.TABLES['stashcontents'], 'x': FEATURE_SPECS[itype].table}
+        dtypes = dict()
+        for expression, name in self.select_list(itype, sql_features):
+            if expression.endswith('.' + name):
+                sql_type = tables[expression[0]].column_type(name)
+            elif '::' in expression:
+                sql_type = expression.rsplit('::', 1)[1]
+            else:
+                continue
+            dtype = np.dtype(schema.get_dtype(sql_type))
+            if dtype.kind in 'biuf':
+                dtypes[name] = dtype
+        return dtypes
+
+    def validate_sql_features(self, itype, sample_size=1000):
+        """
+        Transforms the same sample of items once with pandas and once with sql_features
+        and compares the results.
+        :return: list of columns that differ (empty if everything matches)
+        """
+        result = dict()
+        for sql_features in (False, True):
+            sql, params, columns = self.build_query(itype, sql_features=sql_features)
+            sql += ' ORDER BY s.ItemId LIMIT %(sample_size)s'
+            params['sample_size'] = sample_size
+            items = pd.read_sql(sql, self.db, params=params)
+            items.columns = columns
+            items = apply_dtypes(items, self.query_dtypes(itype, sql_features))
+            result[sql_features] = self.transform(itype, items, sql_features=sql_features)
+
+        expected, actual = result[False], result[True]
+        if list(expected.columns) != list(actual.columns):
+            print("Columns differ:", list(expected.columns), list(actual.columns))
+            return sorted(set(expected.columns).symmetric_difference(actual.columns))
+        mismatches = [x for x in expected.columns
+                      if not np.allclose(expected[x].astype(float), actual[x].astype(float))]
+        print("Compared {} items, {} columns differ: {}".format(
+            len(expected), len(mismatches), ', '.join(mismatches)))
+        return mismatches
+
+    def get_data_from_db(self, itype, since=None, now=None):
+        sql, params, columns = self.build_query(itype, since=since, now=now)
+        items = pd.read_sql(sql, self.db, params=params)
 
         # Column names are all lowercase because postgres, so let's make them readable again.
-        # Our columns list has the correct spelling, but is prefixed by "x." and "s."
-        column_mapping = {x[2:].lower(): x[2:] for x in columns}
-        items.columns = [column_mapping[x] for x in items.columns]
+        # Our columns list has the correct spelling and is in the same order.
+        items.columns = columns
+        items = apply_dtypes(items, self.query_dtypes(itype))
 
         #print("Got data from db: ", items.columns)
         print("Got", items.shape[0], "x", items.shape[1], "values from the db")
         return items
 
-    def categorize(self, items):
+    def iter_data_from_db(self, itype, chunksize, since=None, now=None):
+        """
+        Same as get_data_from_db, but yields the items in DataFrames of up to chunksize rows.
+        Uses a server-side cursor, so only one chunk at a time is held in memory.
+        """
+        sql, params, column_names = self.build_query(itype, since=since, now=now)
+        dtypes = self.query_dtypes(itype)
+        cursor = self.db.cursor(name='export_' + itemtype.get_name(itype).lower())
+        cursor.itersize = chunksize
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if len(rows) == 0:
+                    break
+                print("Got", len(rows), "x", len(column_names), "values from the db")
+                yield apply_dtypes(pd.DataFrame(rows, columns=column_names), dtypes)
+        finally:
+            cursor.close()
+
+    def categorize(self, items, now=None):
+        """
+        Adds the valuable column and returns only the items that are either valuable or worthless.
+        :param now: Time that decides which items are too fresh, defaults to the current time
+        """
         print("categorizing...")
-        items['valuable'] = items.apply(self.is_item_valuable, axis=1)
-        items['worthless'] = items.apply(self.is_item_worthless, axis=1)
+        if now is None:
+            now = datetime.now(tz=pytz.UTC)
+        sold = is_item_sold(items)
+        # Convert sold items at the rate of the day they were sold, unsold ones at the rate
+        # of the day they were last seen.
+        price = self.convert_to_chaos(items.Price, items.Currency, items.SoldTime.where(sold, items.SeenTime))
+        fresh = (now - items.AddedTime).dt.total_seconds() < self.fresh_seconds
+
+        items['valuable'] = self.is_item_valuable(items, price, sold)
+        items['worthless'] = self.is_item_worthless(price, fresh)
 
         print("{} valuable / {} worthless".format(items.valuable.sum(), items.worthless.sum()))
         print("{} overpriced / {} at fringe / {} too fresh".format(
-            items.apply(self.is_item_overpriced, axis=1).sum(),
-            items.apply(self.is_fringe_priced, axis=1).sum(),
-            items.apply(self.is_item_too_fresh, axis=1).sum()
+            self.is_item_overpriced(price, sold).sum(),
+            self.is_fringe_priced(price).sum(),
+            self.is_item_too_fresh(price, fresh).sum()
         ))
 
         # Remove all items where we can't tell if they're valuable or worthless
-        items = items[items.valuable | items.worthless]
+        items = items[items.valuable | items.worthless].copy()
 
         # We don't need the worthless column anymore because an item can only be
         # valuable or worthless, never both, so it's implicitly covered by valuable now.
         del items['worthless']
+        return items
+
+    # The predicates below work on whole columns at once and return boolean Series.
+    # price is the item price in chaos, sold and fresh are the masks computed in categorize.
 
-    def is_item_valuable(self, item):
+    def is_item_valuable(self, items, price, sold):
         """
-        Checks if an item is valuable or not.
-        May also return None if we can't tell.
+        Items that were sold for at least the min price are valuable,
+        unless they were sold after the league ended.
         """
-        if self.league_end is not None and item.SoldTime > self.league_end:
-            return False
-
-        sold = is_item_sold(item)
-        price = self.convert_to_chaos(item.Price, item.Currency)
-
-        # If item was sold at min price or higher, it's valuable
-        if price >= self.min_valuable_price and sold:
-            return True
+        valuable = (price >= self.min_valuable_price) & sold
+        if self.league_end is not None:
+            valuable &= ~(items.SoldTime > self.league_end)
+        return valuable
 
-        return False
-
-    def is_item_worthless(self, item):
-        price = self.convert_to_chaos(item.Price, item.Currency)
-        fresh = (datetime.now(tz=pytz.UTC) - item.AddedTime).total_seconds() < self.fresh_seconds
-
-        # If item was offered for a low price for more than the fresh time, assume it's worthless
-        if price <= self.max_worthless_price and not fresh:
-            return True
-
-        # If item is offered for a low price but the offer is younger than a day, ignore it
+    def is_item_worthless(self, price, fresh):
+        """
+        Items that were offered for a low price for more than the fresh time are worthless.
+        Low priced offers younger than that are ignored, and so are items sold for less than
+        the min price, because we don't know if the buyer would have also bought it at a higher price.
+        """
+        return (price <= self.max_worthless_price) & ~fresh
 
-        # If item is sold for less than min price, ignore it
-        # because we don't know if the buyer would have also bought it at a higher price
+    def is_item_overpriced(self, price, sold):
+        return (price >= self.min_valuable_price) & ~sold
 
-        return False
+    def is_fringe_priced(self, price):
+        return (self.max_worthless_price < price) & (price < self.min_valuable_price)
 
-    def is_item_overpriced(self, item):
-        price = self.convert_to_chaos(item.Price, item.Currency)
-        sold = is_item_sold(item)
-        return price >= self.min_valuable_price and not sold
+    def is_item_too_fresh(self, price, fresh):
+        return (price <= self.max_worthless_price) & fresh
 
-    def is_fringe_priced(self, item):
-        price = self.convert_to_chaos(item.Price, item.Currency)
-        return self.max_worthless_price < price < self.min_valuable_price
+    def convert_to_chaos(self, price, currency, dates=None):
+        """
+        Converts prices to chaos. Works on single values as well as on whole columns.
+        Unknown currencies become NaN, so those items are neither valuable nor worthless.
+        :param dates: When the prices were paid. Uses the latest rates if not given.
+        """
+        return self.exchange_rates.convert(price, currency, dates)
 
-    def is_item_too_fresh(self, item):
-        price = self.convert_to_chaos(item.Price, item.Currency)
-        fresh = (datetime.now(tz=pytz.UTC) - item.AddedTime).total_seconds() < self.fresh_seconds
-        return price <= self.max_worthless_price and fresh
 
-    def convert_to_chaos(self, price, currency):
-        return price * self.exchange_rates[currency]
+def featurize(itype, items, sql_features=False):
+    """
+    Turns raw item stats into the features that models are trained on and predict from.
+    Shared by the exporter (after categorize) and the predictor.
+    :param sql_features: Whether the items were queried with feature_select_list
+    """
+    if not sql_features:
+        if is_weapon(itype):
+            normalize_weapon_quality(items)
+        if is_armour(itype):
+            normalize_armour_quality(items)
+    if can_have_six_sockets(itype):
+        featurize_sockets(items)
+    if sql_features:
+        # Keep the column order of the pandas transforms, which add this column last
+        items['TotalEleResist'] = items.pop('TotalEleResist')
+    else:
+        combine_resistances(items)
+        apply_attribute_boni(items)
+    return remove_columns(*NON_FEATURE_COLUMNS)(items)
 
 
 def is_weapon(itype):
@@ -236,11 +481,11 @@ def apply_attribute_boni(items):
     """
     print("applying attribute boni...")
     if 'Strength' in items.columns and 'Life' in items.columns:
-        items.Life += items.Strength / 2
+        items.Life = (items.Life + items.Strength / 2).astype(np.float32)
     if 'Mana' in items.columns and 'Intelligence' in items.columns:
-        items.Mana += items.Intelligence / 2
+        items.Mana = (items.Mana + items.Intelligence / 2).astype(np.float32)
     if 'Accuracy' in items.columns and 'Dexterity' in items.columns:
-        items.Accuracy += items.Dexterity * 2
+        items.Accuracy = (items.Accuracy + items.Dexterity * 2).astype(np.int16)
     return items
 
 
@@ -250,83 +495,411 @@ def featurize_sockets(items):
     NumOffColorSockets.
     """
     print("featurizing sockets...")
-
-    def count_links(sockets):
-        return max(len(x) for x in sockets.split(' '))
-
-    def count_off_color(sockets, str, dex, int):
-        counts = {x: len(list(y)) for x, y in groupby(sockets) if x != ' '}
-        return counts.get('S', 0) if str == 0 else 0 + \
-               counts.get('D', 0) if dex == 0 else 0 + \
-               counts.get('I', 0) if int == 0 else 0 + \
-               counts.get('G', 0)
-
-    link_count = items.Sockets.apply(count_links)
-    items['5Linked'] = link_count >= 5
-    items['6Linked'] = link_count >= 6
+    sockets = socket_features(items.Sockets)
+    items['5Linked'] = sockets.MaxLinks >= 5
+    items['6Linked'] = sockets.MaxLinks >= 6
     items['NumOffColorSockets'] = \
-        items.apply(lambda x: count_off_color(x.Sockets, x.ReqStr, x.ReqDex, x.ReqDex), axis=1)
+        sockets.S.where(items.ReqStr == 0, 0) + \
+        sockets.D.where(items.ReqDex == 0, 0) + \
+        sockets.I.where(items.ReqInt == 0, 0) + \
+        sockets.G
 
     del items['Sockets']
     return items
 
 
+SOCKET_COLORS = 'SDIGA'
+
+
+def socket_features(sockets):
+    """
+    Encodes socket strings as written by itemstats.parse_sockets (e.g. "SDD D I") into
+    fixed-width integer columns: the size of the largest link group and the number of
+    sockets of each color (S, D, I, G and A for abyss).
+    """
+    sockets = sockets.fillna('').astype(object)
+    features = pd.DataFrame(index=sockets.index)
+    # A link group of n sockets is n socket colors without a space in between
+    max_links = np.zeros(len(sockets), dtype=np.int8)
+    for num_links in range(1, 7):
+        max_links[sockets.str.contains('[^ ]{%d}' % num_links, regex=True).values] = num_links
+    features['MaxLinks'] = max_links
+    for color in SOCKET_COLORS:
+        features[color] = sockets.str.count(color).astype(np.int8)
+    return features
+
+
 def remove_columns(*columns):
+    """
+    Returns a function that removes the given columns from a frame, if it has them.
+    """
     print("removing redundant columns...")
     def _remove_columns(items, *columns):
         for column in columns:
-            del items[column]
+            if column in items.columns:
+                del items[column]
         return items
     return lambda x: _remove_columns(x, *columns)
 
 
-DB_COLUMNS = {
-    itemtype.BODY: itemdb.BODY_COLUMNS,
-    itemtype.HELMET: itemdb.HELMET_COLUMNS,
-    itemtype.GLOVES: itemdb.GLOVES_COLUMNS,
-    itemtype.BOOTS: itemdb.BOOTS_COLUMNS,
-    itemtype.BELT: itemdb.BELT_COLUMNS,
-    itemtype.QUIVER: itemdb.QUIVER_COLUMNS,
-    itemtype.RING: itemdb.RING_COLUMNS,
-    itemtype.AMULET: itemdb.AMULET_COLUMNS,
-    itemtype.WAND: itemdb.WAND_COLUMNS,
-    itemtype.STAFF: itemdb.STAFF_COLUMNS,
-    itemtype.DAGGER: itemdb.DAGGER_COLUMNS,
-    itemtype.ONE_HAND_SWORD: itemdb.ONE_HAND_SWORD_COLUMNS,
-    itemtype.TWO_HAND_SWORD: itemdb.TWO_HAND_SWORD_COLUMNS,
-    itemtype.ONE_HAND_AXE: itemdb.ONE_HAND_AXE_COLUMNS,
-    itemtype.TWO_HAND_AXE: itemdb.TWO_HAND_AXE_COLUMNS,
-    itemtype.ONE_HAND_MACE: itemdb.ONE_HAND_MACE_COLUMNS,
-    itemtype.TWO_HAND_MACE: itemdb.TWO_HAND_MACE_COLUMNS,
-    itemtype.BOW: itemdb.BOW_COLUMNS,
-    itemtype.CLAW: itemdb.CLAW_COLUMNS,
-    itemtype.SCEPTRE: itemdb.SCEPTRE_COLUMNS,
-}
+def feature_select_list(itype):
+    """
+    Returns a list of (SQL expression, column name) that makes postgres compute what
+    normalize_weapon_quality, normalize_armour_quality, combine_resistances and
+    apply_attribute_boni compute in pandas. Columns that those functions remove are
+    left out, all others are selected as they are, in table order.
+    Use DataExporter.validate_sql_features to compare both implementations.
+    Quality is normalized in float8 (double precision), like pandas does it. In numeric
+    arithmetic, values like 7.999999999999999 would come out exact and truncate differently.
+    """
+    columns = DB_COLUMNS[itype]
+    replaced = dict()
+    removed = {'FireResist', 'ColdResist', 'LightningResist'}
+
+    if is_weapon(itype):
+        replaced['PhysDamage'] = \
+            'trunc((x.PhysDamage - x.AddedPhysDamageLocal) ' \
+            '/ ((x.IncreasedPhysDamage + x.Quality + 100) / 100::float8) ' \
+            '* (x.IncreasedPhysDamage + 120) / 100::float8 + x.AddedPhysDamageLocal)::smallint'
+        removed |= {'IncreasedPhysDamage', 'AddedPhysDamageLocal'}
+
+    if is_armour(itype):
+        for stat in ('Armour', 'Evasion', 'EnergyShield'):
+            replaced[stat] = \
+                'trunc((x.{0} - x.Added{0}) / ((x.Increased{0} + x.Quality + 100) / 100::float8) ' \
+                '* (x.Increased{0} + 120) / 100::float8 + x.Added{0} + 0.5::float8)::smallint'.format(stat)
+            removed |= {'Increased' + stat, 'Added' + stat}
+        removed.add('Quality')
+
+    if 'Strength' in columns and 'Life' in columns:
+        replaced['Life'] = '(x.Life + x.Strength / 2.0)::real'
+    if 'Mana' in columns and 'Intelligence' in columns:
+        replaced['Mana'] = '(x.Mana + x.Intelligence / 2.0)::real'
+    if 'Accuracy' in columns and 'Dexterity' in columns:
+        replaced['Accuracy'] = '(x.Accuracy + x.Dexterity * 2)::smallint'
+
+    select = [(replaced.get(x, 'x.' + x), x) for x in columns if x not in removed]
+    select.append(('(x.FireResist + x.ColdResist + x.LightningResist)::smallint', 'TotalEleResist'))
+    return select
+
+
+def apply_dtypes(items, dtypes):
+    """
+    Casts the columns of a frame fresh from the db to the given dtypes.
+    Columns that the frame doesn't have are ignored.
+    """
+    return items.astype({k: v for k, v in dtypes.items() if k in items.columns})
+
+
+def compact_dtypes(items):
+    """
+    Converts numeric columns to compact types: int16 (or int32 if the values don't fit)
+    for integer stats and float32 for everything else. Flags are already bool.
+    """
+    for column in items.columns:
+        values = items[column]
+        if values.dtype == bool or not pd.api.types.is_numeric_dtype(values.dtype):
+            continue
+        if np.issubdtype(values.dtype, np.integer):
+            if len(values) == 0 or (values.min() >= np.iinfo(np.int16).min and values.max() <= np.iinfo(np.int16).max):
+                items[column] = values.astype(np.int16)
+            else:
+                items[column] = values.astype(np.int32)
+        elif np.issubdtype(values.dtype, np.floating):
+            items[column] = values.astype(np.float32)
+    return items
+
+
+class ItemWriter(object):
+    def __init__(self, filename, output_format='csv'):
+        """
+        Writes transformed items to a file, one chunk at a time.
+        CSV chunks are appended right away. npz files can't be appended to,
+        so their (compacted) chunks are collected and written on close.
+        An export without any items still creates an empty file.
+        """
+        if output_format not in ('csv', 'npz'):
+            raise ValueError('Unknown output format: ' + output_format)
+        self.filename = filename
+        self.output_format = output_format
+        self.chunks = []
+        self.num_items = 0
+
+    def write(self, items):
+        if self.output_format == 'csv':
+            items.to_csv(self.filename, mode='w' if len(self.chunks) == 0 else 'a',
+                         header=len(self.chunks) == 0)
+            self.chunks.append(None)
+        else:
+            self.chunks.append(compact_dtypes(items))
+        self.num_items += len(items)
+
+    def close(self):
+        if self.output_format == 'npz':
+            items = pd.concat(self.chunks) if len(self.chunks) > 0 else pd.DataFrame()
+            write_npz(items, self.filename)
+        elif len(self.chunks) == 0:
+            pd.DataFrame().to_csv(self.filename)
+        self.chunks = []
+
+
+def write_npz(items, filename):
+    """
+    Writes the items to an uncompressed NumPy .npz file with one typed array per column,
+    plus the column order and the index. Text columns are left out.
+    Use load_npz to read it back into a DataFrame.
+    """
+    items = compact_dtypes(items)
+    arrays = {column: np.asarray(items[column]) for column in items.columns}
+    arrays = {k: v for k, v in arrays.items() if v.dtype.kind in 'biuf'}
+    arrays['__columns__'] = np.array(list(arrays.keys()), dtype=str)
+    # Incremental exports are indexed by ItemId. Store those as fixed-width strings,
+    # so the file can be loaded without pickle.
+    index = np.asarray(items.index)
+    arrays['__index__'] = index.astype(str) if index.dtype == object else index
+    with open(filename, 'wb') as fp:
+        np.savez(fp, **arrays)
+
+
+def load_npz(filename):
+    """
+    Loads a file written by write_npz as a DataFrame.
+    """
+    with np.load(filename) as data:
+        return pd.DataFrame({column: data[column] for column in data['__columns__']},
+                            index=data['__index__'])
+
+
+def merge_delta(snapshot, delta, removed_ids=()):
+    """
+    Applies an incremental export to a previous export of the same item type.
+    Both must be indexed by ItemId. Rows in delta replace rows with the same id in the snapshot,
+    rows listed in removed_ids are dropped.
+    """
+    drop = delta.index.union(pd.Index(removed_ids))
+    return pd.concat([snapshot[~snapshot.index.isin(drop)], delta])
+
+
+def load_training_set(directory, name):
+    """
+    Returns the labeled items of a dataset written by export_to_store (e.g. Standard.Both.RING)
+    as features plus the valuable column, indexed by ItemId.
+    """
+    labels = FeatureStore(directory, name + '.labels').to_frame()
+    items = FeatureStore(directory, name).lookup(list(labels.index))
+    items['valuable'] = labels.valuable.loc[items.index].astype(bool)
+    return items
+
+
+# The indexer stamps rows with the start time of its transaction, so rows committed after an
+# export started can carry an earlier time. Incremental exports overlap the previous one by this much.
+WATERMARK_SAFETY_MARGIN = timedelta(minutes=15)
+
+
+def load_watermark(filename):
+    """
+    Returns the time stored by store_watermark, or None if there is no such file.
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as fp:
+        return dateutil.parser.parse(fp.read().strip())
+
+
+def store_watermark(filename, watermark):
+    with open(filename, 'w') as fp:
+        fp.write(watermark.isoformat())
+
+
+# Columns that identify or price an item, rather than describe it
+NON_FEATURE_COLUMNS = ['ItemId', 'Hash', 'Sockets', 'GrantedSkillId', 'GrantedSkillLevel',
+                       'AddedTime', 'SoldTime', 'SeenTime', 'Price', 'Currency']
+STASH_COLUMNS = ['Price', 'Currency', 'AddedTime', 'SoldTime', 'SeenTime']
+
+
+class FeatureSpec(object):
+    def __init__(self, table):
+        """
+        Declares the raw columns of an item table that featurize works on, in table order,
+        and their dtypes. The exporter and the predictor both read item stats through this,
+        so training and serving see the same columns in the same order.
+
+        :param table: schema.Table of the item type
+        """
+        self.table = table
+        self.columns = table.column_names()
+        self.dtypes = {k: np.dtype(v) for k, v in table.dtypes().items()}
+        self.numeric_columns = [x for x in self.columns if self.dtypes[x].kind in 'biuf']
+        self.has_sockets = 'Sockets' in self.columns
+
+    def numeric_dtypes(self):
+        return {x: self.dtypes[x] for x in self.numeric_columns}
+
+    def sql_array(self, alias='x'):
+        """
+        Returns an SQL expression that selects all numeric columns as a single real[],
+        so rows of every item table fit into the same result column.
+        """
+        values = ['{}.{}{}'.format(alias, x, '::int' if self.dtypes[x].kind == 'b' else '')
+                  for x in self.numeric_columns]
+        return 'ARRAY[{}]::real[]'.format(', '.join(values))
+
+    def to_frame(self, values, sockets=None):
+        """
+        Builds a frame of raw item stats from rows of numeric values (as selected by sql_array).
+        The rows are copied into one preallocated matrix, then each column is cast to its dtype.
+        Fractional values of integer columns (e.g. AttacksPerSecond of raw parsed stats) are rounded
+        half away from zero, like postgres does when the indexer inserts them, not truncated.
+        :param sockets: Socket strings of the rows, for item types that have sockets
+        """
+        matrix = np.empty((len(values), len(self.numeric_columns)), dtype=np.float32)
+        for i, row in enumerate(values):
+            matrix[i] = row
+        numeric = {x: i for i, x in enumerate(self.numeric_columns)}
+        items = dict()
+        for column in self.columns:
+            if column in numeric:
+                column_values = matrix[:, numeric[column]]
+                if self.dtypes[column].kind in 'iu':
+                    column_values = column_values.astype(np.float64)
+                    column_values = np.trunc(column_values + np.copysign(0.5, column_values))
+                items[column] = column_values.astype(self.dtypes[column])
+            elif column == 'Sockets':
+                items[column] = np.array(sockets if sockets is not None else [''] * len(values), dtype=object)
+        return pd.DataFrame(items)
+
+
+FEATURE_SPECS = {itype: FeatureSpec(schema.get_table(itype)) for itype in itemtype.ALL_TYPES}
+DB_COLUMNS = {itype: spec.columns for itype, spec in FEATURE_SPECS.items()}
+
+
+# Each export worker process has its own exporter with its own db connection
+_worker_exporter = None
+_worker_args = None
+_worker_exchange_rates = None
+
+
+def init_export_worker(args, exchange_rates):
+    """
+    Only remembers the arguments. The worker connects on its first export, so that a db that can't
+    be reached fails each item type with an error instead of killing the worker in the initializer,
+    which the pool would restart forever.
+    """
+    global _worker_exporter, _worker_args, _worker_exchange_rates
+    _worker_exporter = None
+    _worker_args = args
+    _worker_exchange_rates = exchange_rates
+
+
+def get_worker_exporter():
+    global _worker_exporter
+    if _worker_exporter is None:
+        args = _worker_args
+        db = psycopg2.connect(args.db)
+        _worker_exporter = DataExporter(db, league=args.league, flavour=args.flavour, league_end=args.league_end,
+                                        exchange_rates=_worker_exchange_rates, sql_features=args.sql_features)
+    return _worker_exporter
+
+
+def export_worker(itype, outdir, chunksize, output_format, incremental):
+    """
+    Exports one item type in a worker process.
+    :return: tuple (item type, number of exported items, seconds, error message or None)
+    """
+    start_time = time.time()
+    try:
+        num_items = export_item_type(get_worker_exporter(), itype, outdir, chunksize, output_format, incremental)
+        return itype, num_items, time.time() - start_time, None
+    except Exception as ex:
+        error = '{}: {}'.format(type(ex).__name__, ex)
+        reset_worker_connection()
+        return itype, 0, time.time() - start_time, error
+
+
+def reset_worker_connection():
+    """
+    Rolls back the worker's connection after a failed export, so the next item type doesn't start
+    in an aborted transaction. A connection that is broken is replaced by a new one.
+    Never raises, so that one item type can't take down the pool and the summary with it.
+    """
+    if _worker_exporter is None:
+        # Not connected yet, the next item type tries again
+        return
+    try:
+        _worker_exporter.db.rollback()
+        return
+    except psycopg2.Error:
+        pass
+    try:
+        _worker_exporter.db.close()
+    except psycopg2.Error:
+        pass
+    try:
+        _worker_exporter.db = psycopg2.connect(_worker_args.db)
+    except psycopg2.Error as ex:
+        # The next item type will fail with its own error message
+        print("Could not reconnect to the db:", ex)
+
+
+def export_item_type(exporter, itype, outdir, chunksize, output_format, incremental):
+    if output_format == 'store':
+        return exporter.export_to_store(itype, outdir, chunksize=chunksize)
+    if incremental:
+        return exporter.export_incremental(itype, outdir, chunksize=chunksize, output_format=output_format)
+    outfile = os.path.join(outdir, itemtype.get_name(itype) + '.' + output_format)
+    return exporter.export(itype, outfile, chunksize=chunksize, output_format=output_format)
+
+
+def export_all(args, itypes):
+    """
+    Exports the given item types in parallel, using up to args.jobs worker processes.
+    :return: list of export_worker results, in the order of itypes
+    """
+    exchange_rates = get_exchange_rates(args)
+    tasks = [(itype, args.outdir, args.chunksize, args.format, args.incremental) for itype in itypes]
+    with multiprocessing.Pool(args.jobs, initializer=init_export_worker,
+                              initargs=(args, exchange_rates)) as pool:
+        return pool.starmap(export_worker, tasks, chunksize=1)
+
+
+def get_exchange_rates(args):
+    """
+    Returns the daily exchange rates since args.rates_since, or only the current ones if that isn't set.
+    """
+    league_name = constants.league.get_name(args.league)
+    if args.rates_since is None:
+        return ExchangeRates.from_rates(currency.get_exchange_rates(league_name))
+    return ExchangeRateService(league_name).history(args.rates_since.date())
+
+
+def print_export_summary(results):
+    print()
+    print("{:<16} {:>9} {:>9}  {}".format('item type', 'items', 'seconds', 'error'))
+    for itype, num_items, seconds, error in results:
+        print("{:<16} {:>9} {:>9.1f}  {}".format(itemtype.get_name(itype), num_items, seconds, error or ''))
+
+    failed = [itemtype.get_name(x[0]) for x in results if x[3] is not None]
+    if len(failed) > 0:
+        print("Some Item Types could not be exported:", ", ".join(failed))
 
 
 def main(args):
     print("args: ", args)
 
-    db = psycopg2.connect(args.db)
-    exporter = DataExporter(db, league=args.league, flavour=args.flavour, league_end=args.league_end)
-
     args.itemtype = args.itemtype.upper()
     if args.itemtype == 'ALL':
-        failed = []
-        for itype in [x for x in itemtype.ALL_TYPES]:
-            outfile = os.path.join(args.outdir, itemtype.get_name(itype) + '.csv')
-            try:
-                exporter.export(itype, outfile)
-            except Exception as ex:
-                failed.append(itype)
-        if len(failed) > 0:
-            failed = [itemtype.get_name(x) for x in failed]
-            print("Some Item Types could not be exported:", ", ".join(failed))
+        results = export_all(args, list(itemtype.ALL_TYPES))
+        print_export_summary(results)
 
     else:
+        db = psycopg2.connect(args.db)
+        exporter = DataExporter(db, league=args.league, flavour=args.flavour, league_end=args.league_end,
+                                exchange_rates=get_exchange_rates(args), sql_features=args.sql_features)
         itype = itemtype.from_name(args.itemtype)
-        outfile = os.path.join(args.outdir, itemtype.get_name(itype) + '.csv')
-        exporter.export(itype, outfile)
+        if args.validate_sql_features:
+            exporter.validate_sql_features(itype)
+            return
+        export_item_type(exporter, itype, args.outdir, args.chunksize, args.format, args.incremental)
 
 
 def parse_args():
@@ -353,7 +926,24 @@ def parse_args():
     ap.add_argument('--flavour', choices=['Softcore', 'Hardcore', 'Both'], default='Both')
     ap.add_argument('--league-end', default=None, help='Date when the league ended',
                     action=CustomParser, parser=dateutil.parser.parse)
+    ap.add_argument('--rates-since', default=None,
+                    help='Convert prices at the exchange rate of the day they were paid, using daily rates '
+                         'since this date. Without this, all prices are converted at the current rates.',
+                    action=CustomParser, parser=dateutil.parser.parse)
     ap.add_argument('--outdir', default=os.getcwd())
+    ap.add_argument('--format', choices=['csv', 'npz', 'store'], default='csv',
+                    help='npz writes typed binary columns that load much faster than csv, '
+                         'store appends changed items to memory-mapped FeatureStores of features and labels')
+    ap.add_argument('--sql-features', default=False, action='store_true',
+                    help='Compute quality, resistance and attribute features in postgres')
+    ap.add_argument('--validate-sql-features', default=False, action='store_true',
+                    help='Compare --sql-features against the pandas transforms on a sample instead of exporting')
+    ap.add_argument('--incremental', default=False, action='store_true',
+                    help='Only export items that changed since the last incremental export')
+    ap.add_argument('--jobs', type=int, default=4,
+                    help='Number of item types to export in parallel when exporting ALL')
+    ap.add_argument('--chunksize', type=int, default=None,
+                    help='Stream rows from the db in chunks of this size to keep memory flat')
     return ap.parse_args()
 
 
@@ -0,0 +1,182 @@
+"""
+Append-only store of transformed feature rows, one per item type and league.
+Each store consists of four files:
+    <name>.json      column names
+    <name>.features  float32 rows of len(columns) values each
+    <name>.hashes    Hash of the item version each row was computed from (empty for removed rows)
+    <name>.ids       64 byte ItemId of each row
+The data files are opened as read-only memory maps, so any number of training runs and
+api workers share the same page-cached copy. features() hands out the map itself, lookups
+copy only the rows they return.
+An item that is updated is appended again; the last row of an id wins.
+Removed items are appended as rows of NaN.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+DTYPE = np.float32
+ID_DTYPE = np.dtype('S64')
+# Item hashes as postgres formats uuids, e.g. 0b6e2a4c-...
+HASH_DTYPE = np.dtype('S36')
+
+
+class FeatureStore(object):
+    def __init__(self, directory, name):
+        """
+        :param directory: Directory that holds the store files
+        :param name:      Name of this store, e.g. Standard.Both.RING
+        """
+        self.prefix = os.path.join(directory, name)
+        self._columns = None
+        self._index = dict()
+        self._hash_index = dict()
+        self._index_size = 0
+
+    @property
+    def header_filename(self):
+        return self.prefix + '.json'
+
+    @property
+    def features_filename(self):
+        return self.prefix + '.features'
+
+    @property
+    def hashes_filename(self):
+        return self.prefix + '.hashes'
+
+    @property
+    def ids_filename(self):
+        return self.prefix + '.ids'
+
+    def exists(self):
+        return os.path.exists(self.header_filename)
+
+    def columns(self):
+        if self._columns is None:
+            with open(self.header_filename, 'r') as fp:
+                self._columns = json.load(fp)['columns']
+        return self._columns
+
+    def __len__(self):
+        if not self.exists():
+            return 0
+        # The ids are written last, so they tell how many rows are complete
+        return os.path.getsize(self.ids_filename) // ID_DTYPE.itemsize
+
+    def append(self, items, hashes=None):
+        """
+        Appends the rows of a frame indexed by ItemId.
+        The first append fixes the columns; later frames must have the same ones.
+        :param hashes: Hash of each row's item, to look rows up by item version (see lookup_hashes)
+        """
+        if not self.exists():
+            with open(self.header_filename, 'w') as fp:
+                json.dump({'columns': list(items.columns)}, fp)
+            for filename in (self.features_filename, self.hashes_filename, self.ids_filename):
+                open(filename, 'wb').close()
+        elif list(items.columns) != self.columns():
+            raise ValueError('Columns of {} do not match the feature store'.format(self.prefix))
+
+        features = np.ascontiguousarray(items.to_numpy(dtype=DTYPE, na_value=np.nan))
+        ids = np.asarray(items.index.astype(str), dtype=ID_DTYPE)
+        if hashes is None:
+            hashes = np.zeros(len(items), dtype=HASH_DTYPE)
+        self._write(features, np.asarray([str(x) for x in hashes], dtype=HASH_DTYPE), ids)
+
+    def remove(self, item_ids):
+        """
+        Marks the given items as removed by appending rows of NaN for them.
+        """
+        if not self.exists() or len(item_ids) == 0:
+            return
+        features = np.full((len(item_ids), len(self.columns())), np.nan, dtype=DTYPE)
+        self._write(features, np.zeros(len(item_ids), dtype=HASH_DTYPE), np.asarray(item_ids, dtype=ID_DTYPE))
+
+    def _write(self, features, hashes, ids):
+        # Readers may see a partial row at the end of the other files, but never an id without its row
+        with open(self.features_filename, 'ab') as fp:
+            fp.write(features.tobytes())
+        with open(self.hashes_filename, 'ab') as fp:
+            fp.write(hashes.tobytes())
+        with open(self.ids_filename, 'ab') as fp:
+            fp.write(ids.tobytes())
+
+    def features(self):
+        """
+        Returns all rows, including outdated and removed ones, as a read-only memory map.
+        """
+        num_rows = len(self)
+        if num_rows == 0:
+            return np.zeros((0, len(self.columns()) if self.exists() else 0), dtype=DTYPE)
+        return np.memmap(self.features_filename, dtype=DTYPE, mode='r', shape=(num_rows, len(self.columns())))
+
+    def ids(self):
+        return self._map(self.ids_filename, ID_DTYPE)
+
+    def hashes(self):
+        return self._map(self.hashes_filename, HASH_DTYPE)
+
+    def _map(self, filename, dtype):
+        num_rows = len(self)
+        if num_rows == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', shape=(num_rows,))
+
+    def index(self):
+        """
+        Returns a dict of ItemId -> row of its latest version.
+        """
+        self._update_indexes()
+        return self._index
+
+    def hash_index(self):
+        """
+        Returns a dict of item hash -> row. Removed rows have no hash.
+        """
+        self._update_indexes()
+        return self._hash_index
+
+    def _update_indexes(self):
+        # Only rows appended since the last call are read
+        num_rows = len(self)
+        if num_rows <= self._index_size:
+            return
+        ids = self.ids()[self._index_size:num_rows]
+        hashes = self.hashes()[self._index_size:num_rows]
+        for row, (item_id, item_hash) in enumerate(zip(ids, hashes), self._index_size):
+            self._index[item_id.decode('ascii')] = row
+            if len(item_hash) > 0:
+                self._hash_index[item_hash.decode('ascii')] = row
+        self._index_size = num_rows
+
+    def lookup(self, item_ids):
+        """
+        Returns the latest features of the given items, as a frame indexed by ItemId.
+        Unknown and removed items are left out.
+        """
+        index = self.index()
+        rows = np.array([index[x] for x in item_ids if x in index], dtype=np.int64)
+        features = self.features()[rows]
+        found = ~np.isnan(features).all(axis=1) if features.shape[1] > 0 else np.ones(len(rows), dtype=bool)
+        ids = [x.decode('ascii') for x in self.ids()[rows[found]]]
+        return pd.DataFrame(features[found], columns=self.columns(), index=ids)
+
+    def lookup_hashes(self, hashes):
+        """
+        Returns the features of the given item versions, as a frame indexed by Hash.
+        Unlike lookup, this never returns features of an outdated version of an item.
+        Unknown hashes are left out.
+        """
+        index = self.hash_index()
+        found = [x for x in hashes if x in index]
+        rows = np.array([index[x] for x in found], dtype=np.int64)
+        return pd.DataFrame(self.features()[rows], columns=self.columns(), index=found)
+
+    def to_frame(self):
+        """
+        Returns the latest version of every item that wasn't removed.
+        """
+        return self.lookup(list(self.index().keys()))
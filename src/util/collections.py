@@ -1,4 +1,6 @@
-from collections import Counter
+from collections import Counter, OrderedDict
+import threading
+import time
 
 
 class CaseInsensitiveCounter(dict):
@@ -28,4 +30,68 @@ class CaseInsensitiveCounter(dict):
         return super().__contains__(key.lower())
 
     def items(self):
-        return (x[1] for x in super().items())
\ No newline at end of file
+        return (x[1] for x in super().items())
+
+
+class LRUCache(object):
+    """
+    Dict-like cache that evicts the least recently used entry once it holds maxsize entries.
+    Safe to use from several threads, e.g. the request threads of the prediction api.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            except KeyError:
+                return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class TTLCache(object):
+    """
+    Dict-like cache whose entries expire ttl seconds after they were stored.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = dict()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            return default
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.time() + self.ttl, value)
+
+    def expires(self, key):
+        """
+        Returns the time (as returned by time.time) when the entry expires, or None if there is none.
+        """
+        entry = self.entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def clear(self):
+        self.entries.clear()
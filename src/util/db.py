@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+
+from util import metrics
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    def __init__(self, db_access_string, maxconn=10, timeout=5, check_after=30):
+        """
+        Thread-safe pool of at most maxconn connections. Callers that find all connections
+        checked out wait up to timeout seconds for one to be returned, instead of opening more.
+
+        :param db_access_string: psycopg2 connection string
+        :param maxconn:     Max number of open connections
+        :param timeout:     Seconds to wait for a free connection before raising PoolExhaustedError
+        :param check_after: Connections that were idle for this many seconds are checked
+                            with SELECT 1 before they are handed out again
+        """
+        self.db_access_string = db_access_string
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+        self.check_after = check_after
+        self.last_used = dict()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of a with block.
+        The transaction is committed if the block succeeds and rolled back if it raises.
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            metrics.count('db_pool_exhausted')
+            raise PoolExhaustedError('No database connection available after {} seconds'.format(self.timeout))
+        try:
+            dbconn = self.checkout()
+            try:
+                yield dbconn
+                dbconn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # The connection itself is broken, don't hand it out again
+                self.discard(dbconn)
+                raise
+            except Exception:
+                dbconn.rollback()
+                self.checkin(dbconn)
+                raise
+            else:
+                self.checkin(dbconn)
+        finally:
+            self.slots.release()
+
+    def checkout(self):
+        """
+        Returns an idle connection, or opens a new one. Only call this while holding a slot.
+        """
+        while True:
+            with self.lock:
+                dbconn = self.idle.pop() if len(self.idle) > 0 else None
+            if dbconn is None:
+                return psycopg2.connect(self.db_access_string)
+            if self.is_healthy(dbconn):
+                return dbconn
+            metrics.count('db_pool_reconnects')
+            self.discard(dbconn)
+
+    def checkin(self, dbconn):
+        with self.lock:
+            self.last_used[id(dbconn)] = time.time()
+            self.idle.append(dbconn)
+
+    def discard(self, dbconn):
+        with self.lock:
+            self.last_used.pop(id(dbconn), None)
+        if not dbconn.closed:
+            dbconn.close()
+
+    def is_healthy(self, dbconn):
+        if dbconn.closed:
+            return False
+        last_used = self.last_used.get(id(dbconn))
+        if last_used is None or time.time() - last_used < self.check_after:
+            return True
+        try:
+            db = dbconn.cursor()
+            db.execute('SELECT 1')
+            db.close()
+            dbconn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for dbconn in idle:
+            self.discard(dbconn)
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_access_string, maxconn=10):
+    """
+    Returns this process's pool for the given database.
+    Pools are created on first use, so worker processes forked by the web server
+    each open their own connections instead of sharing the parent's.
+    """
+    key = (os.getpid(), db_access_string)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_access_string, maxconn=maxconn)
+        return pool
@@ -0,0 +1,226 @@
+import os
+import threading
+import time
+from collections import deque
+
+
+class LogFollower(object):
+    def __init__(self, path, backlog=64 * 1024, poll_interval=0.5, block_size=64 * 1024):
+        """
+        Follows a growing text file from a background thread with a single open handle,
+        like tail -f, and hands new text to any number of readers.
+        The file is only read once, no matter how many readers there are.
+        If the file is truncated or replaced (log rotation), it is reopened from the start.
+
+        Readers keep track of where they are by position, 'inode:offset' of the end of the text
+        they got. Positions refer to the file, not to this object, so a reader can continue
+        with the LogFollower of another process.
+
+        :param path:          File to follow
+        :param backlog:       Max number of bytes kept for readers that start or fall behind
+        :param poll_interval: Seconds between checks for new data
+        """
+        self.path = path
+        self.backlog = backlog
+        self.poll_interval = poll_interval
+        self.block_size = block_size
+        # (inode, offset, data) of the most recent chunks of the file, oldest first.
+        # Every chunk starts and ends at a UTF-8 character boundary.
+        self.chunks = deque()
+        self.num_bytes = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='log-follower', daemon=True)
+        self.thread.start()
+        return self
+
+    def read(self, after=None, timeout=None):
+        """
+        Returns (position, text) of everything after position after,
+        or the whole backlog if after is None or from a file that is no longer followed.
+        If after is older than the backlog, the missing text is read from the file, up to backlog bytes.
+        Waits up to timeout seconds for new text if there is none yet.
+        The returned text is empty if the timeout expired.
+        """
+        inode, offset = parse_position(after)
+
+        def is_restart(last_inode, last_end):
+            # A position past what was read is either from a follower that is further ahead,
+            # or from before the file was truncated
+            return inode != last_inode or (offset > last_end and self.is_truncated(inode, offset))
+
+        def has_news():
+            if len(self.chunks) == 0:
+                return False
+            last_inode, last_offset, last_data = self.chunks[-1]
+            last_end = last_offset + len(last_data)
+            return offset < last_end or is_restart(last_inode, last_end)
+
+        with self.condition:
+            if after is not None or timeout is not None:
+                self.condition.wait_for(has_news, timeout)
+            if not has_news():
+                return after, ''
+            chunks = list(self.chunks)
+
+        first_offset = chunks[0][1]
+        last_inode, last_offset, last_data = chunks[-1]
+        if is_restart(last_inode, last_offset + len(last_data)):
+            offset = first_offset
+        data = b''.join(x[2][max(0, offset - x[1]):] for x in chunks if x[1] + len(x[2]) > offset)
+        if offset < first_offset:
+            data = self.read_file(last_inode, offset, first_offset) + data
+        return format_position(last_inode, last_offset + len(last_data)), data.decode('utf-8', errors='replace')
+
+    def read_file(self, inode, start, end):
+        """
+        Returns the bytes between start and end of the file, if it is still the one with that inode.
+        Returns at most backlog bytes, the last ones.
+        """
+        if end - start > self.backlog:
+            start = end - self.backlog
+        try:
+            with open(self.path, 'rb') as fp:
+                if os.fstat(fp.fileno()).st_ino != inode:
+                    return b''
+                fp.seek(start)
+                data = fp.read(end - start)
+        except OSError:
+            return b''
+        return data[skip_continuation_bytes(data[:3]):]
+
+    def append(self, data, inode=0, offset=None):
+        """
+        Adds bytes that were read from the file with the given inode, starting at offset.
+        Data from another file, or that doesn't continue the last chunk, replaces the backlog.
+        """
+        with self.condition:
+            if len(self.chunks) > 0:
+                last_inode, last_offset, last_data = self.chunks[-1]
+                if offset is None:
+                    offset = last_offset + len(last_data)
+                if last_inode != inode or last_offset + len(last_data) != offset:
+                    self.chunks.clear()
+                    self.num_bytes = 0
+            self.chunks.append((inode, offset or 0, data))
+            self.num_bytes += len(data)
+            while self.num_bytes > self.backlog and len(self.chunks) > 1:
+                self.num_bytes -= len(self.chunks.popleft()[2])
+            self.condition.notify_all()
+
+    def run(self):
+        fp = None
+        while True:
+            try:
+                if fp is None:
+                    fp, inode, offset = self.open()
+                    pending = b''
+                data = fp.read(self.block_size)
+                if len(data) > 0:
+                    # Keep a character that is split across reads for the next one
+                    data = pending + data
+                    complete = len(data) - incomplete_character_bytes(data)
+                    data, pending = data[:complete], data[complete:]
+                    if len(data) > 0:
+                        self.append(data, inode, offset)
+                        offset += len(data)
+                    continue
+                if self.is_rotated(fp):
+                    fp.close()
+                    fp = None
+                    continue
+            except OSError:
+                # The file doesn't exist (yet), try again later
+                if fp is not None:
+                    fp.close()
+                fp = None
+            time.sleep(self.poll_interval)
+
+    def open(self):
+        """
+        Opens the file and positions it where reading should continue: at the end of the last chunk
+        if it is still the same file, otherwise at the start, or so that the first read fills
+        the backlog if nothing was read yet.
+        :return: (file, inode, offset)
+        """
+        fp = open(self.path, 'rb')
+        stat = os.fstat(fp.fileno())
+        with self.condition:
+            last = self.chunks[-1] if len(self.chunks) > 0 else None
+        if last is None:
+            start = max(0, stat.st_size - self.backlog)
+            fp.seek(start)
+            start += skip_continuation_bytes(fp.read(3))
+        elif last[0] == stat.st_ino and last[1] + len(last[2]) <= stat.st_size:
+            start = last[1] + len(last[2])
+        else:
+            start = 0
+        fp.seek(start)
+        return fp, stat.st_ino, start
+
+    def is_truncated(self, inode, offset):
+        """
+        Returns True if the file with the given inode is now shorter than offset.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return stat.st_ino == inode and stat.st_size < offset
+
+    def is_rotated(self, fp):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        current = os.fstat(fp.fileno())
+        return stat.st_ino != current.st_ino or stat.st_size < fp.tell()
+
+
+def format_position(inode, offset):
+    return '{}:{}'.format(inode, offset)
+
+
+def parse_position(position):
+    """
+    Returns (inode, offset) of a position from format_position, or (None, 0) if it isn't one.
+    """
+    try:
+        inode, offset = position.split(':')
+        return int(inode), int(offset)
+    except (AttributeError, ValueError):
+        return None, 0
+
+
+def skip_continuation_bytes(data):
+    """
+    Returns the number of bytes at the start of data that continue a UTF-8 character
+    which started before it.
+    """
+    num_bytes = 0
+    while num_bytes < len(data) and data[num_bytes] & 0xC0 == 0x80:
+        num_bytes += 1
+    return num_bytes
+
+
+def incomplete_character_bytes(data):
+    """
+    Returns the number of bytes at the end of data that belong to a UTF-8 character
+    that continues after it.
+    """
+    for i in range(1, min(4, len(data)) + 1):
+        byte = data[-i]
+        if byte & 0xC0 == 0x80:
+            continue
+        if byte & 0xE0 == 0xC0:
+            length = 2
+        elif byte & 0xF0 == 0xE0:
+            length = 3
+        elif byte & 0xF8 == 0xF0:
+            length = 4
+        else:
+            length = 1
+        return i if length > i else 0
+    return 0
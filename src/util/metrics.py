@@ -0,0 +1,202 @@
+"""
+Process-wide timers, counters and histograms.
+Timers and counters only ever go up. To see what happened during a period of time
+(e.g. one stash update), take a snapshot before and after and compare them with delta().
+Timers and counters are also kept per thread, so that work done by background threads
+in the meantime can be left out of such a snapshot.
+"""
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_counters = defaultdict(lambda: 0)
+_timers = defaultdict(lambda: 0.0)
+_histograms = dict()
+# {'counters': ..., 'timers': ...} of what the current thread recorded since the last reset
+_thread_local = threading.local()
+_generation = 0
+_enabled = True
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for x in self.counts:
+            total += x
+            yield total
+
+
+class Timer(object):
+    """
+    Context manager that adds the time spent inside of it to a named timer.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if not _enabled:
+            return
+        elapsed = time.perf_counter() - self.start_time
+        with _lock:
+            _timers[self.name] += elapsed
+            _thread_values()['timers'][self.name] += elapsed
+
+
+def timer(name):
+    return Timer(name)
+
+
+def count(name, value=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += value
+        _thread_values()['counters'][name] += value
+
+
+def _thread_values():
+    # Only call this while holding _lock
+    if getattr(_thread_local, 'generation', None) != _generation:
+        _thread_local.generation = _generation
+        _thread_local.values = {
+            'counters': defaultdict(lambda: 0),
+            'timers': defaultdict(lambda: 0.0),
+        }
+    return _thread_local.values
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS):
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+
+@contextmanager
+def disabled():
+    """
+    Nothing is recorded, by any thread, until the block ends.
+    Meant for benchmarks that shouldn't measure the cost of the metrics themselves.
+    """
+    global _enabled
+    _enabled = False
+    try:
+        yield
+    finally:
+        _enabled = True
+
+
+def snapshot(current_thread=False):
+    """
+    Returns the current counter and timer values (in seconds) as plain dicts.
+    :param current_thread: Only include what the calling thread recorded
+    """
+    with _lock:
+        if current_thread:
+            values = _thread_values()
+            return {
+                'counters': dict(values['counters']),
+                'timers': dict(values['timers']),
+            }
+        return {
+            'counters': dict(_counters),
+            'timers': dict(_timers),
+        }
+
+
+def delta(before, after):
+    """
+    Returns the difference between two snapshots, leaving out anything that didn't change.
+    """
+    return {
+        group: {k: v - before[group].get(k, 0) for k, v in values.items()
+                if v != before[group].get(k, 0)}
+        for group, values in after.items()
+    }
+
+
+def reset():
+    global _generation
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+        _histograms.clear()
+        # Other threads drop their values the next time they record something
+        _generation += 1
+
+
+def prometheus_text(prefix='poeria'):
+    """
+    Returns all metrics in the Prometheus text exposition format.
+    Timers are exported as counters of seconds.
+    """
+    lines = []
+    with _lock:
+        for name, value in sorted(_counters.items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        for name, value in sorted(_timers.items()):
+            lines.append('# TYPE {}_{}_seconds_total counter'.format(prefix, name))
+            lines.append('{}_{}_seconds_total {}'.format(prefix, name, value))
+        for name, histogram in sorted(_histograms.items()):
+            metric = '{}_{}'.format(prefix, name)
+            lines.append('# TYPE {} histogram'.format(metric))
+            for upper_bound, value in zip(histogram.buckets, histogram.cumulative_counts()):
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, upper_bound, value))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, histogram.count))
+            lines.append('{}_sum {}'.format(metric, histogram.sum))
+            lines.append('{}_count {}'.format(metric, histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't spam the indexer log with every scrape
+        pass
+
+
+def serve(port, host='0.0.0.0'):
+    """
+    Serves the metrics at http://host:port/metrics from a background thread.
+    """
+    server = HTTPServer((host, port), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,115 @@
+from contextlib import contextmanager
+import os
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+os.environ.setdefault('DB_CREDENTIALS', 'test')
+
+from api import main as stats_api
+from predict import api as predict_api
+from predict.batcher import BatchTimeoutError
+
+
+class FakeConnection(object):
+    def cursor(self):
+        return None
+
+
+class FakePool(object):
+    def __init__(self, dbconn=None):
+        self.dbconn = dbconn or FakeConnection()
+
+    @contextmanager
+    def connection(self):
+        yield self.dbconn
+
+
+class StatsTest(TestCase):
+    def setUp(self):
+        stats_api.stats_cache.clear()
+        self.client = stats_api.app.test_client()
+
+    @patch('api.main.get_pool', lambda *args: FakePool())
+    def test_caches_stats_and_supports_etags(self):
+        with patch('api.main.ItemDB.get_stats', return_value={'total': {'RING': 3}}) as get_stats:
+            response = self.client.get('/api/v1/stats')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual({'total': {'RING': 3}}, response.get_json())
+            etag = response.headers['ETag']
+
+            response = self.client.get('/api/v1/stats', headers={'If-None-Match': etag})
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(1, get_stats.call_count)
+
+
+class PredictionsTest(TestCase):
+    def setUp(self):
+        self.client = predict_api.app.test_client()
+
+    def test_etag_is_predictions_version(self):
+        def load_predictions(account_name, league_name, known_version=None):
+            return 7, None if known_version == 7 else {'valuable': [], 'worthless': []}
+
+        with patch('predict.api.load_predictions', load_predictions):
+            response = self.client.get('/api/v1/someone/Standard')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('"7"', response.headers['ETag'])
+            self.assertEqual({'valuable': [], 'worthless': []}, response.get_json())
+
+            response = self.client.get('/api/v1/someone/Standard', headers={'If-None-Match': '"7"'})
+            self.assertEqual(304, response.status_code)
+
+    def test_unknown_player(self):
+        with patch('predict.api.load_predictions', return_value=None):
+            self.assertEqual(404, self.client.get('/api/v1/nobody/Standard').status_code)
+
+
+class ReadyTest(TestCase):
+    def setUp(self):
+        self.client = predict_api.app.test_client()
+
+    def test_ready_if_db_is_reachable(self):
+        with patch('predict.api.get_pool', lambda *args: FakePool(MagicMock())):
+            response = self.client.get('/api/v1/ready')
+            self.assertEqual(200, response.status_code)
+            self.assertTrue(response.get_json()['db'])
+
+    def test_not_ready_without_db(self):
+        with patch('predict.api.get_pool', lambda *args: FakePool()):
+            response = self.client.get('/api/v1/ready')
+            self.assertEqual(503, response.status_code)
+            self.assertFalse(response.get_json()['db'])
+
+    def test_not_ready_before_models_are_preloaded(self):
+        with patch('predict.api.get_pool', lambda *args: FakePool(MagicMock())), \
+                patch('predict.api.preload_models', True), patch('predict.api.predictor', None):
+            self.assertEqual(503, self.client.get('/api/v1/ready').status_code)
+
+
+class BulkPredictionsTest(TestCase):
+    def setUp(self):
+        self.client = predict_api.app.test_client()
+
+    def test_predicts_items_and_stashes(self):
+        predictor = MagicMock()
+        predictor.predict_raw_items.return_value = [{'id': 'a', 'type': 'RING', 'valuation': 'valuable'}]
+        predictor.predict_stashes.return_value = {'tab': {'valuable': [], 'worthless': []}}
+        with patch('predict.api.get_predictor', return_value=(predictor, MagicMock())), \
+                patch('predict.api.get_pool', lambda *args: FakePool()):
+            response = self.client.post('/api/v1/predictions', json={'items': [{'id': 'a'}], 'stashes': ['tab']})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual({'items': predictor.predict_raw_items.return_value,
+                              'stashes': predictor.predict_stashes.return_value}, response.get_json())
+
+    def test_batch_timeout_is_unavailable(self):
+        predictor = MagicMock()
+        predictor.predict_raw_items.side_effect = BatchTimeoutError('too slow')
+        with patch('predict.api.get_predictor', return_value=(predictor, MagicMock())):
+            self.assertEqual(503, self.client.post('/api/v1/predictions', json={'items': [{}]}).status_code)
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(400, self.client.post('/api/v1/predictions', data='nope').status_code)
+        self.assertEqual(400, self.client.post('/api/v1/predictions', json={'stashes': [1]}).status_code)
+        with patch('predict.api.bulk_max_items', 1):
+            response = self.client.post('/api/v1/predictions', json={'items': [{}, {}]})
+            self.assertEqual(413, response.status_code)
@@ -0,0 +1,86 @@
+import threading
+from unittest import TestCase
+
+import numpy as np
+
+from predict.batcher import BatchTimeoutError, MicroBatcher
+
+
+class RecordingModel(object):
+    """
+    Stands in for Predictor.predict_items, predicting the hash of each item.
+    """
+    def __init__(self):
+        self.batches = []
+
+    def predict_items(self, itype, hashes, values, sockets):
+        self.batches.append((itype, len(hashes)))
+        if itype == 99:
+            raise ValueError('no model')
+        return np.array(hashes)
+
+
+def predict_concurrently(batcher, requests):
+    results = [None] * len(requests)
+
+    def predict(i, itype, hashes):
+        try:
+            results[i] = list(batcher.predict_items(itype, hashes, [None] * len(hashes), [''] * len(hashes)))
+        except (ValueError, RuntimeError, BatchTimeoutError) as ex:
+            results[i] = ex
+
+    threads = [threading.Thread(target=predict, args=(i,) + x) for i, x in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class MicroBatcherTest(TestCase):
+    def test_coalesces_concurrent_requests(self):
+        model = RecordingModel()
+        batcher = MicroBatcher(model.predict_items, max_wait=0.2)
+        results = predict_concurrently(batcher, [(1, [1, 2]), (1, [3]), (2, [4])])
+        self.assertEqual([[1, 2], [3], [4]], results)
+        self.assertEqual([(1, 3), (2, 1)], sorted(model.batches))
+
+    def test_max_batch_size(self):
+        model = RecordingModel()
+        batcher = MicroBatcher(model.predict_items, max_batch_size=2, max_wait=0.2)
+        results = predict_concurrently(batcher, [(1, [1, 2]), (1, [3, 4]), (1, [5, 6, 7])])
+        self.assertEqual([[1, 2], [3, 4], [5, 6, 7]], results)
+        self.assertEqual([2, 2, 3], sorted(x[1] for x in model.batches))
+
+    def test_errors_reach_every_request_of_the_batch(self):
+        batcher = MicroBatcher(RecordingModel().predict_items, max_wait=0.2)
+        results = predict_concurrently(batcher, [(99, [1]), (99, [2])])
+        self.assertTrue(all(isinstance(x, ValueError) for x in results))
+
+    def test_errors_outside_of_a_batch_fail_the_waiting_requests(self):
+        model = RecordingModel()
+        batcher = MicroBatcher(model.predict_items, max_wait=0.2)
+        take_batch = batcher.take_batch
+        calls = []
+
+        def take_batch_once(queue):
+            calls.append(len(queue))
+            if len(calls) == 1:
+                raise RuntimeError('bug')
+            return take_batch(queue)
+
+        batcher.take_batch = take_batch_once
+        self.assertIsInstance(predict_concurrently(batcher, [(1, [1])])[0], RuntimeError)
+        # The batcher thread survived
+        self.assertEqual([[2]], predict_concurrently(batcher, [(1, [2])]))
+
+    def test_timeout(self):
+        release = threading.Event()
+
+        def predict_items(itype, hashes, values, sockets):
+            release.wait()
+            return np.array(hashes)
+
+        batcher = MicroBatcher(predict_items, max_wait=0, timeout=0.1)
+        self.assertIsInstance(predict_concurrently(batcher, [(1, [1])])[0], BatchTimeoutError)
+        release.set()
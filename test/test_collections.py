@@ -1,7 +1,8 @@
 from unittest import TestCase
 import json
+import threading
 
-from util.collections import CaseInsensitiveCounter
+from util.collections import CaseInsensitiveCounter, LRUCache
 
 
 class CaseInsensitiveCounterTest(TestCase):
@@ -58,3 +59,38 @@ class CaseInsensitiveCounterTest(TestCase):
         other = {'A': 3, 'b': 1}
         self.assertEqual(self.counter, other)
         self.assertEqual(other, self.counter)
+
+
+class LRUCacheTest(TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(2, len(cache))
+
+    def test_concurrent_use(self):
+        cache = LRUCache(10)
+        errors = []
+
+        def use_cache(offset):
+            try:
+                for i in range(20000):
+                    key = (i + offset) % 30
+                    if cache.get(key) is None:
+                        cache.put(key, i)
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=use_cache, args=(x,)) for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(10, len(cache))
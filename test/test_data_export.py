@@ -0,0 +1,524 @@
+from argparse import Namespace
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+import io
+import math
+import os
+import re
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import psycopg2
+import pytz
+
+from constants import currency, itemtype, league
+from train import data_export
+from train.data_export import DB_COLUMNS, FEATURE_SPECS, DataExporter, apply_attribute_boni, apply_dtypes, \
+    STASH_COLUMNS, WATERMARK_SAFETY_MARGIN, combine_resistances, feature_select_list, featurize_sockets, load_npz, \
+    load_training_set, load_watermark, merge_delta, normalize_armour_quality, normalize_weapon_quality, store_watermark, write_npz
+from train.feature_store import FeatureStore
+
+
+class CategorizeTest(TestCase):
+    def setUp(self):
+        self.exporter = DataExporter(None, exchange_rates={currency.CHAOS: 1, currency.EXA: 50})
+        now = datetime.now(tz=pytz.UTC)
+        unsold = datetime(1999, 1, 1, tzinfo=pytz.UTC)
+        old = now - timedelta(days=30)
+        self.items = pd.DataFrame([
+            # Sold for an exa
+            {'Price': 1, 'Currency': currency.EXA, 'AddedTime': old, 'SeenTime': old, 'SoldTime': now},
+            # Unsold at 1 chaos for a month
+            {'Price': 1, 'Currency': currency.CHAOS, 'AddedTime': old, 'SeenTime': old, 'SoldTime': unsold},
+            # Unsold at 1 chaos, but only listed just now
+            {'Price': 1, 'Currency': currency.CHAOS, 'AddedTime': now, 'SeenTime': now, 'SoldTime': unsold},
+            # Unsold at an exa
+            {'Price': 1, 'Currency': currency.EXA, 'AddedTime': old, 'SeenTime': old, 'SoldTime': unsold},
+            # Unknown currency
+            {'Price': 1, 'Currency': currency.VAAL, 'AddedTime': old, 'SeenTime': old, 'SoldTime': now},
+        ])
+
+    def test_keeps_only_valuable_and_worthless(self):
+        items = self.exporter.categorize(self.items)
+        self.assertEqual([0, 1], list(items.index))
+        self.assertEqual([True, False], list(items.valuable))
+        self.assertNotIn('worthless', items.columns)
+
+    def test_league_end(self):
+        self.exporter.league_end = datetime.now(tz=pytz.UTC) - timedelta(days=1)
+        items = self.exporter.categorize(self.items)
+        self.assertFalse(items.valuable.any())
+
+    def test_convert_to_chaos(self):
+        self.assertEqual(100, self.exporter.convert_to_chaos(2, currency.EXA))
+        prices = self.exporter.convert_to_chaos(self.items.Price, self.items.Currency)
+        self.assertEqual([50, 1, 1, 50], list(prices[:4]))
+
+
+class NpzTest(TestCase):
+    def test_roundtrip(self):
+        items = pd.DataFrame({
+            'Life': [10, 70, 0],
+            'Mana': [1.5, 0, 22],
+            'Corrupted': [True, False, False],
+            'valuable': [False, True, False],
+        }, index=[3, 8, 9])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'RING.npz')
+            write_npz(items.copy(), filename)
+            loaded = load_npz(filename)
+        self.assertEqual(list(items.columns), list(loaded.columns))
+        self.assertEqual([3, 8, 9], list(loaded.index))
+        self.assertEqual(np.int16, loaded.Life.dtype)
+        self.assertEqual(np.float32, loaded.Mana.dtype)
+        self.assertEqual(bool, loaded.Corrupted.dtype)
+        self.assertEqual([10, 70, 0], list(loaded.Life))
+
+
+class MergeDeltaTest(TestCase):
+    def test_merge_delta(self):
+        snapshot = pd.DataFrame({'Life': [10, 20, 30]}, index=['a', 'b', 'c'])
+        delta = pd.DataFrame({'Life': [25, 40]}, index=['b', 'd'])
+        merged = merge_delta(snapshot, delta, removed_ids=['c'])
+        self.assertEqual({'a': 10, 'b': 25, 'd': 40}, merged.Life.to_dict())
+
+
+class IncrementalExportTest(TestCase):
+    def setUp(self):
+        self.exporter = DataExporter(None, exchange_rates={currency.CHAOS: 1}, fresh_seconds=24 * 60 * 60)
+
+    def test_query_selects_items_that_stopped_being_fresh(self):
+        since = datetime(2017, 5, 1, tzinfo=pytz.UTC)
+        now = datetime(2017, 5, 3, tzinfo=pytz.UTC)
+        sql, params, columns = self.exporter.build_query(itemtype.RING, since=since, now=now)
+        self.assertIn('s.AddedTime > %(fresh_since)s AND s.AddedTime <= %(fresh_until)s', sql)
+        self.assertEqual(datetime(2017, 4, 30, tzinfo=pytz.UTC), params['fresh_since'])
+        self.assertEqual(datetime(2017, 5, 2, tzinfo=pytz.UTC), params['fresh_until'])
+
+    def test_watermark_is_export_start_minus_margin(self):
+        seen = datetime(2030, 1, 1, tzinfo=pytz.UTC)
+        chunk = pd.DataFrame({'ItemId': ['a '], 'SeenTime': [seen], 'SoldTime': [seen]})
+        calls = []
+
+        def iter_chunks(itype, chunksize=None, since=None, now=None):
+            calls.append((since, now))
+            yield chunk.copy()
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                patch.object(self.exporter, 'iter_chunks', iter_chunks), \
+                patch.object(self.exporter, 'transform', lambda itype, items, now=None: items):
+            watermark_file = self.exporter.watermark_filename(itemtype.RING, tmpdir)
+            store_watermark(watermark_file, datetime(2017, 5, 1, tzinfo=pytz.UTC))
+            self.exporter.export_incremental(itemtype.RING, tmpdir)
+            since, now = calls[0]
+            self.assertEqual(datetime(2017, 5, 1, tzinfo=pytz.UTC), since)
+            # Not the latest time in the data, which may be ahead of rows that are still being committed
+            self.assertEqual(now - WATERMARK_SAFETY_MARGIN, load_watermark(watermark_file))
+
+    def test_leagues_have_their_own_files(self):
+        hardcore = DataExporter(None, league=league.HARDCORE, exchange_rates={currency.CHAOS: 1})
+        chunk = pd.DataFrame({'ItemId': ['a ']})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for exporter in [self.exporter, hardcore, self.exporter]:
+                with patch.object(exporter, 'iter_chunks', lambda *args, **kwargs: iter([chunk.copy()])), \
+                        patch.object(exporter, 'transform', lambda itype, items, now=None: items):
+                    exporter.export_incremental(itemtype.RING, tmpdir)
+            filenames = sorted(os.listdir(tmpdir))
+            self.assertIn('Standard.Both.RING.csv', filenames)
+            self.assertIn('Hardcore.Both.RING.csv', filenames)
+            self.assertEqual(1, len([x for x in filenames if x.startswith('Standard.Both.RING.delta-')
+                                     and x.endswith('.csv')]))
+            self.assertFalse(any(x.startswith('Hardcore.Both.RING.delta-') for x in filenames))
+
+
+def evaluate_sql(expression, row):
+    """
+    Evaluates an expression of feature_select_list for one row, typed the way postgres does it:
+    columns and integer literals are integers, decimal literals are numeric (Decimal),
+    ::float8 and ::real make floats. Mixing numeric and float8 without a cast raises a TypeError.
+    """
+    while '::' in expression:
+        cast = re.search(r'::(\w+)', expression)
+        end = cast.start()
+        if expression[end - 1] == ')':
+            depth, start = 0, end - 1
+            while True:
+                depth += {')': 1, '(': -1}.get(expression[start], 0)
+                if depth == 0:
+                    break
+                start -= 1
+            start -= len(re.search(r'\w*$', expression[:start]).group(0))
+        else:
+            start = end - len(re.search(r'[\w.]+$', expression[:end]).group(0))
+        expression = '{}sql_cast({!r}, {}){}'.format(
+            expression[:start], cast.group(1), expression[start:end], expression[cast.end():])
+    expression = re.sub(r'\bx\.(\w+)', r"row['\1']", expression)
+    expression = re.sub(r'\b(\d+\.\d+)\b', r"Decimal('\1')", expression)
+    return eval(expression, {'sql_cast': sql_cast, 'trunc': math.trunc, 'Decimal': Decimal, 'row': row})
+
+
+def sql_cast(sql_type, value):
+    if sql_type == 'smallint':
+        if isinstance(value, Decimal):
+            return int(value.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+        return int(round(value))
+    if sql_type == 'real':
+        return np.float32(value)
+    return float(value)
+
+
+class SqlFeaturesTest(TestCase):
+    def sample_items(self, itype, num_items, fixed_rows=()):
+        """
+        Random raw items of the item type, plus the given rows (dicts of column -> value).
+        Flat boni never exceed the stat they are added to.
+        """
+        random = np.random.RandomState(0)
+        dtypes = DataExporter(None, exchange_rates={currency.CHAOS: 1}).query_dtypes(itype, sql_features=False)
+        columns = [x for x in DB_COLUMNS[itype] if x in dtypes]
+        rows = []
+        for i in range(num_items):
+            row = {x: int(random.randint(0, 2 if dtypes[x] == np.bool_ else 100)) for x in columns}
+            row['Quality'] = int(random.randint(0, 21))
+            for stat, added in (('Armour', 'AddedArmour'), ('Evasion', 'AddedEvasion'),
+                                ('EnergyShield', 'AddedEnergyShield'), ('PhysDamage', 'AddedPhysDamageLocal')):
+                if stat in row:
+                    row['Increased' + stat if stat != 'PhysDamage' else 'IncreasedPhysDamage'] = \
+                        int(random.randint(0, 300))
+                    row[stat] = row[added] + int(random.randint(0, 1000))
+            rows.append(row)
+        for fixed in fixed_rows:
+            rows.append(dict(rows[0], **fixed))
+        return rows, dtypes
+
+    def assert_values_match_pandas(self, itype, normalize, fixed_rows):
+        rows, dtypes = self.sample_items(itype, 300, fixed_rows)
+        items = apply_dtypes(pd.DataFrame(rows), dtypes)
+        normalize(items)
+        items = combine_resistances(items)
+        apply_attribute_boni(items)
+
+        computed = [(expression, name) for expression, name in feature_select_list(itype)
+                    if expression != 'x.' + name]
+        self.assertIn('TotalEleResist', [x[1] for x in computed])
+        for expression, name in computed:
+            expected = list(items[name])
+            actual = [evaluate_sql(expression, row) for row in rows]
+            mismatches = [(rows[i], expected[i], actual[i]) for i in range(len(rows)) if expected[i] != actual[i]]
+            self.assertEqual([], mismatches[:3], name)
+
+    def test_armour_values_match_pandas(self):
+        # In numeric arithmetic, 7 armour at 12% quality would become 8 instead of 7.999999999999999 + 0.5
+        self.assert_values_match_pandas(itemtype.BODY, normalize_armour_quality, [
+            {'Armour': 7, 'AddedArmour': 0, 'IncreasedArmour': 0, 'Quality': 12},
+            {'Armour': 21, 'AddedArmour': 0, 'IncreasedArmour': 0, 'Quality': 12},
+        ])
+
+    def test_weapon_values_match_pandas(self):
+        # Truncating 7.999999999999999 physical damage, which is 8 in numeric arithmetic
+        self.assert_values_match_pandas(itemtype.ONE_HAND_SWORD, normalize_weapon_quality, [
+            {'PhysDamage': 7, 'AddedPhysDamageLocal': 0, 'IncreasedPhysDamage': 0, 'Quality': 5},
+            {'PhysDamage': 35, 'AddedPhysDamageLocal': 0, 'IncreasedPhysDamage': 0, 'Quality': 5},
+        ])
+
+    def test_evaluate_sql_types_like_postgres(self):
+        row = {'Armour': 7, 'Quality': 12}
+        # numeric arithmetic is exact, float8 arithmetic isn't
+        self.assertEqual(8, evaluate_sql('trunc(x.Armour / ((x.Quality + 100) / 100.0) * 1.2 + 0.5)::smallint', row))
+        self.assertEqual(7, evaluate_sql(
+            'trunc(x.Armour / ((x.Quality + 100) / 100::float8) * 120 / 100::float8 + 0.5::float8)::smallint', row))
+
+    def pandas_columns(self, itype, normalize):
+        items = pd.DataFrame({x: [1] for x in DB_COLUMNS[itype]})
+        normalize(items)
+        combine_resistances(items)
+        apply_attribute_boni(items)
+        return list(items.columns)
+
+    def test_armour_columns_match_pandas(self):
+        columns = [x[1] for x in feature_select_list(itemtype.BODY)]
+        self.assertEqual(self.pandas_columns(itemtype.BODY, normalize_armour_quality), columns)
+
+    def test_weapon_columns_match_pandas(self):
+        columns = [x[1] for x in feature_select_list(itemtype.ONE_HAND_SWORD)]
+        self.assertEqual(self.pandas_columns(itemtype.ONE_HAND_SWORD, normalize_weapon_quality), columns)
+
+
+class SocketsTest(TestCase):
+    def test_featurize_sockets(self):
+        items = pd.DataFrame({
+            'Sockets': ['SSSSSS', 'SDD D I', 'GGGGG I', ''],
+            'ReqStr': [100, 50, 0, 0],
+            'ReqDex': [0, 0, 100, 0],
+            'ReqInt': [0, 0, 0, 0],
+        })
+        featurize_sockets(items)
+        self.assertEqual([True, False, True, False], list(items['5Linked']))
+        self.assertEqual([True, False, False, False], list(items['6Linked']))
+        self.assertEqual([0, 4, 6, 0], list(items.NumOffColorSockets))
+        self.assertNotIn('Sockets', items.columns)
+
+
+class FeatureStoreTest(TestCase):
+    def test_append_and_lookup(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = FeatureStore(tmpdir, 'Standard.Both.RING')
+            self.assertEqual(0, len(store))
+            store.append(pd.DataFrame({'Life': [10, 20], 'Corrupted': [True, False]}, index=['a', 'b']))
+            store.append(pd.DataFrame({'Life': [25, 40], 'Corrupted': [True, True]}, index=['b', 'c']))
+            store.remove(['a'])
+            self.assertEqual(5, len(store))
+
+            reopened = FeatureStore(tmpdir, 'Standard.Both.RING')
+            items = reopened.lookup(['a', 'b', 'c', 'unknown'])
+            self.assertEqual(['b', 'c'], list(items.index))
+            self.assertEqual(['Life', 'Corrupted'], list(items.columns))
+            self.assertEqual([25, 40], list(items.Life))
+            self.assertEqual({'b', 'c'}, set(reopened.to_frame().index))
+
+            with self.assertRaises(ValueError):
+                store.append(pd.DataFrame({'Mana': [1]}, index=['d']))
+
+    def test_lookup_hashes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = FeatureStore(tmpdir, 'Standard.Both.RING')
+            store.append(pd.DataFrame({'Life': [10, 20]}, index=['a', 'b']), hashes=['a-1', 'b-1'])
+            store.append(pd.DataFrame({'Life': [25]}, index=['b']), hashes=['b-2'])
+            store.remove(['a'])
+            items = FeatureStore(tmpdir, 'Standard.Both.RING').lookup_hashes(['b-2', 'b-1', 'a-1', 'c-1'])
+            # Each version keeps its own features, removing an item doesn't drop its versions
+            self.assertEqual(['b-2', 'b-1', 'a-1'], list(items.index))
+            self.assertEqual([25, 20, 10], list(items.Life))
+
+
+class ExportToStoreTest(TestCase):
+    def make_chunk(self):
+        spec = FEATURE_SPECS[itemtype.RING]
+        items = spec.to_frame([[0] * len(spec.numeric_columns)] * 3)
+        now = datetime.now(tz=pytz.UTC)
+        old = now - timedelta(days=30)
+        unsold = datetime(1999, 1, 1, tzinfo=pytz.UTC)
+        items['ItemId'] = ['a ', 'b ', 'c ']
+        items['Hash'] = ['a-1', 'b-1', 'c-1']
+        items['Life'] = np.array([10, 20, 30], dtype=np.int16)
+        # Sold for 5 chaos, unsold at 1 chaos for a month, and unsold but only listed just now
+        stash = pd.DataFrame({'Price': [5, 1, 1], 'Currency': [currency.CHAOS] * 3, 'AddedTime': [old, old, now],
+                              'SeenTime': [old, old, now], 'SoldTime': [now, unsold, unsold]})
+        return pd.concat([stash, items], axis=1)[STASH_COLUMNS + DB_COLUMNS[itemtype.RING]]
+
+    def test_stores_features_of_all_items_and_labels_separately(self):
+        exporter = DataExporter(None, exchange_rates={currency.CHAOS: 1})
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                patch.object(exporter, 'iter_chunks', lambda *args, **kwargs: iter([self.make_chunk()])):
+            self.assertEqual(3, exporter.export_to_store(itemtype.RING, tmpdir))
+            store = FeatureStore(tmpdir, 'Standard.Both.RING')
+            self.assertNotIn('valuable', store.columns())
+            self.assertEqual([10, 20, 30], list(store.lookup_hashes(['a-1', 'b-1', 'c-1']).Life))
+
+            items = load_training_set(tmpdir, 'Standard.Both.RING')
+            self.assertEqual(['a', 'b'], list(items.index))
+            self.assertEqual([True, False], list(items.valuable))
+            self.assertEqual(list(store.columns()) + ['valuable'], list(items.columns))
+            self.assertIsNotNone(load_watermark(store.features_filename + '.watermark'))
+
+
+class DtypesTest(TestCase):
+    def test_query_dtypes_follow_schema(self):
+        exporter = DataExporter(None, exchange_rates={currency.CHAOS: 1})
+        dtypes = exporter.query_dtypes(itemtype.BODY)
+        self.assertEqual(np.float32, dtypes['Price'])
+        self.assertEqual(np.int16, dtypes['Armour'])
+        self.assertEqual(np.bool_, dtypes['Corrupted'])
+        self.assertNotIn('Sockets', dtypes)
+
+        items = apply_dtypes(pd.DataFrame({'Armour': [100], 'Corrupted': [1], 'Sockets': ['S']}), dtypes)
+        self.assertEqual(np.int16, items.Armour.dtype)
+        self.assertEqual(bool, items.Corrupted.dtype)
+
+    def test_sql_feature_dtypes_match_pandas(self):
+        exporter = DataExporter(None, exchange_rates={currency.CHAOS: 1})
+        dtypes = exporter.query_dtypes(itemtype.AMULET, sql_features=False)
+        items = apply_dtypes(pd.DataFrame({x: [1] for x in DB_COLUMNS[itemtype.AMULET]}), dtypes)
+        combine_resistances(items)
+        apply_attribute_boni(items)
+        sql_dtypes = exporter.query_dtypes(itemtype.AMULET, sql_features=True)
+        for column in ('Life', 'Mana', 'Accuracy', 'TotalEleResist'):
+            self.assertEqual(items[column].dtype, sql_dtypes[column], column)
+
+
+class FeatureSpecTest(TestCase):
+    def test_to_frame(self):
+        spec = FEATURE_SPECS[itemtype.BODY]
+        values = [[1] * len(spec.numeric_columns), [0] * len(spec.numeric_columns)]
+        items = spec.to_frame(values, ['SS', 'I'])
+        self.assertEqual([x for x in DB_COLUMNS[itemtype.BODY] if x not in ('ItemId', 'Hash')], list(items.columns))
+        self.assertEqual(['SS', 'I'], list(items.Sockets))
+        self.assertEqual([True, False], list(items.Corrupted))
+        self.assertEqual(np.int16, items.Armour.dtype)
+
+    def test_sql_array(self):
+        sql = FEATURE_SPECS[itemtype.BODY].sql_array()
+        self.assertIn('x.Corrupted::int, ', sql)
+        self.assertNotIn('Sockets', sql)
+
+
+class FakeConnection(object):
+    def __init__(self, broken=False):
+        self.broken = broken
+        self.rollbacks = 0
+
+    def rollback(self):
+        if self.broken:
+            raise psycopg2.InterfaceError('connection already closed')
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+class FakeExporter(object):
+    """
+    Stands in for DataExporter in the worker processes. Fails for amulets.
+    """
+    def __init__(self, db, **kwargs):
+        self.db = db
+
+    def export(self, itype, filename, chunksize=None, output_format='csv'):
+        if itype == itemtype.AMULET:
+            raise ValueError('no amulets today')
+        return 10
+
+
+class InProcessPool(object):
+    """
+    Stands in for multiprocessing.Pool, running the tasks in this process.
+    """
+    def __init__(self, processes, initializer, initargs):
+        initializer(*initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def starmap(self, fn, tasks, chunksize=None):
+        return [fn(*x) for x in tasks]
+
+
+class ExportAllTest(TestCase):
+    def setUp(self):
+        self.args = Namespace(db='test', league=0, flavour='Both', league_end=None, sql_features=False,
+                              outdir='/tmp', chunksize=None, format='csv', incremental=False, jobs=2)
+
+    def export_all(self, itypes, connect=lambda db: FakeConnection()):
+        with patch('train.data_export.multiprocessing.Pool', InProcessPool), \
+                patch('train.data_export.DataExporter', FakeExporter), \
+                patch('train.data_export.psycopg2.connect', connect), \
+                patch('train.data_export.get_exchange_rates', lambda args: {}):
+            return data_export.export_all(self.args, itypes)
+
+    def test_failed_item_types_dont_stop_the_others(self):
+        results = self.export_all([itemtype.RING, itemtype.AMULET, itemtype.BELT])
+        self.assertEqual([itemtype.RING, itemtype.AMULET, itemtype.BELT], [x[0] for x in results])
+        self.assertEqual([10, 0, 10], [x[1] for x in results])
+        self.assertEqual([None, 'ValueError: no amulets today', None], [x[3] for x in results])
+        self.assertEqual(1, data_export._worker_exporter.db.rollbacks)
+
+    def test_reconnects_if_rollback_fails(self):
+        connections = []
+
+        def connect(db):
+            connections.append(FakeConnection(broken=len(connections) == 0))
+            return connections[-1]
+
+        results = self.export_all([itemtype.AMULET, itemtype.RING], connect=connect)
+        self.assertEqual([0, 10], [x[1] for x in results])
+        self.assertEqual(2, len(connections))
+        self.assertIs(connections[1], data_export._worker_exporter.db)
+
+    def test_unreachable_db_fails_each_item_type(self):
+        def connect(db):
+            raise psycopg2.OperationalError('could not connect to server')
+
+        results = self.export_all([itemtype.RING, itemtype.BELT], connect=connect)
+        self.assertEqual([itemtype.RING, itemtype.BELT], [x[0] for x in results])
+        self.assertEqual(['OperationalError: could not connect to server'] * 2, [x[3] for x in results])
+
+    def test_print_export_summary(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            data_export.print_export_summary([(itemtype.RING, 10, 1.5, None),
+                                              (itemtype.AMULET, 0, 0.2, 'ValueError: no amulets today')])
+        lines = output.getvalue().strip().split('\n')
+        self.assertTrue(lines[1].startswith('RING') and '10' in lines[1])
+        self.assertIn('ValueError: no amulets today', lines[2])
+        self.assertEqual('Some Item Types could not be exported: AMULET', lines[3])
+
+
+class FakeNamedCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.fetch_sizes = []
+        self.closed = False
+
+    def execute(self, sql, params):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def fetchmany(self, size):
+        self.fetch_sizes.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+class FakeStreamingDb(object):
+    def __init__(self, rows):
+        self.cursors = []
+        self.rows = rows
+
+    def cursor(self, name=None):
+        self.cursors.append((name, FakeNamedCursor(self.rows)))
+        return self.cursors[-1][1]
+
+
+class ChunkedExportTest(TestCase):
+    def make_rows(self, num_items):
+        spec = FEATURE_SPECS[itemtype.RING]
+        items = spec.to_frame([[0] * len(spec.numeric_columns)] * num_items)
+        now = datetime.now(tz=pytz.UTC)
+        old = now - timedelta(days=30)
+        items['ItemId'] = [str(i) for i in range(num_items)]
+        items['Hash'] = ['h' + str(i) for i in range(num_items)]
+        items['Life'] = np.arange(num_items, dtype=np.int16)
+        # All sold for 5 chaos, so all of them are valuable
+        stash = pd.DataFrame({'Price': [5] * num_items, 'Currency': [currency.CHAOS] * num_items,
+                              'AddedTime': [old] * num_items, 'SeenTime': [old] * num_items,
+                              'SoldTime': [now] * num_items})
+        items = pd.concat([stash, items], axis=1)[STASH_COLUMNS + DB_COLUMNS[itemtype.RING]]
+        return list(items.itertuples(index=False, name=None))
+
+    def test_streams_chunks_into_one_csv(self):
+        db = FakeStreamingDb(self.make_rows(5))
+        exporter = DataExporter(db, exchange_rates={currency.CHAOS: 1})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'RING.csv')
+            self.assertEqual(5, exporter.export(itemtype.RING, filename, chunksize=2))
+            items = pd.read_csv(filename, index_col=0)
+
+        # A server-side cursor, read in chunks until it is exhausted
+        name, cursor = db.cursors[0]
+        self.assertEqual('export_ring', name)
+        self.assertEqual(2, cursor.itersize)
+        self.assertEqual([2, 2, 2, 2], cursor.fetch_sizes)
+        self.assertTrue(cursor.closed)
+        # The header is only written once and the index continues across chunks
+        self.assertEqual([0, 1, 2, 3, 4], list(items.index))
+        self.assertEqual([0, 1, 2, 3, 4], list(items.Life))
+        self.assertTrue(items.valuable.all())
@@ -0,0 +1,74 @@
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+import psycopg2
+
+from util.db import ConnectionPool, PoolExhaustedError
+
+
+class FakeConnection(object):
+    def __init__(self, *args):
+        self.closed = 0
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+@patch('psycopg2.connect', FakeConnection)
+class ConnectionPoolTest(TestCase):
+    def test_reuses_connections(self):
+        pool = ConnectionPool('test', maxconn=2)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(2, second.commits)
+
+    def test_rolls_back_on_error(self):
+        pool = ConnectionPool('test', maxconn=1)
+        with self.assertRaises(ValueError):
+            with pool.connection() as dbconn:
+                raise ValueError()
+        self.assertEqual(1, dbconn.rollbacks)
+        with pool.connection() as again:
+            self.assertIs(dbconn, again)
+
+    def test_discards_broken_connections(self):
+        pool = ConnectionPool('test', maxconn=1)
+        with self.assertRaises(psycopg2.OperationalError):
+            with pool.connection() as dbconn:
+                raise psycopg2.OperationalError()
+        self.assertTrue(dbconn.closed)
+        with pool.connection() as again:
+            self.assertIsNot(dbconn, again)
+
+    def test_waits_for_free_connection(self):
+        pool = ConnectionPool('test', maxconn=1, timeout=0.05)
+        with pool.connection():
+            with self.assertRaises(PoolExhaustedError):
+                with pool.connection():
+                    pass
+
+        released = threading.Event()
+
+        def hold_connection():
+            with pool.connection():
+                released.wait()
+
+        pool.timeout = 5
+        thread = threading.Thread(target=hold_connection)
+        thread.start()
+        released.set()
+        with pool.connection():
+            pass
+        thread.join()
@@ -0,0 +1,75 @@
+from datetime import date, datetime, timedelta
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pytz
+
+from constants import currency
+from constants.exchange_rates import ExchangeRates, ExchangeRateService, load_history
+
+FIXTURE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures', 'poe_ninja_currency_overview.json')
+
+
+class FixtureApi(object):
+    """
+    Stands in for poe.ninja, serving the overviews in the fixture file.
+    """
+    def __init__(self):
+        with open(FIXTURE, 'r') as fp:
+            self.overviews = json.load(fp)
+        self.requests = []
+
+    def fetch(self, league, day):
+        self.requests.append(day)
+        key = 'current' if day is None else day.strftime('%Y-%m-%d')
+        return currency.parse_currency_overview(self.overviews[key])
+
+
+class ExchangeRatesTest(TestCase):
+    def setUp(self):
+        self.rates = ExchangeRates.from_daily_rates({
+            date(2017, 8, 1): {currency.CHAOS: 1, currency.EXA: 40},
+            date(2017, 8, 3): {currency.CHAOS: 1, currency.EXA: 50},
+        })
+
+    def test_convert_at_date(self):
+        dates = [datetime(2017, 7, 1, tzinfo=pytz.UTC), datetime(2017, 8, 2, 23, tzinfo=pytz.UTC),
+                 datetime(2017, 8, 3, tzinfo=pytz.UTC), datetime(2017, 9, 1, tzinfo=pytz.UTC)]
+        prices = self.rates.convert(np.array([2, 2, 2, 2]), [currency.EXA] * 4, dates)
+        self.assertEqual([80, 80, 100, 100], list(prices))
+
+    def test_convert_latest(self):
+        self.assertEqual(100, self.rates.convert(2, currency.EXA))
+
+    def test_unknown_currency_is_nan(self):
+        prices = self.rates.convert(np.array([1, 1, 1]), [currency.VAAL, currency.UNKNOWN, 999])
+        self.assertTrue(np.isnan(prices).all())
+
+
+class ExchangeRateServiceTest(TestCase):
+    def test_history_fetches_missing_days_once(self):
+        api = FixtureApi()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, 'Standard.daily.csv')
+            service = ExchangeRateService('Standard', fetch=api.fetch, cache_file=cache_file)
+            service.daily_rates[date(2017, 8, 1)] = api.fetch('Standard', date(2017, 8, 1))
+            # Pretend every day after the fixture's last one is cached already
+            day = date(2017, 8, 4)
+            while day < date.today():
+                service.daily_rates[day] = {currency.CHAOS: 1}
+                day += timedelta(days=1)
+            api.requests = []
+
+            rates = service.history(since=date(2017, 8, 1))
+            self.assertEqual([date(2017, 8, 2), date(2017, 8, 3), None], api.requests)
+            self.assertEqual(45, rates.on(date(2017, 8, 2))[currency.EXA])
+            self.assertEqual(12, rates.on()[currency.DIVINE])
+
+            reloaded = load_history(cache_file)
+            self.assertEqual(0.3, reloaded[date(2017, 8, 3)][currency.ALCH])
+
+            service.history(since=date(2017, 8, 1))
+            self.assertEqual(3, len(api.requests))
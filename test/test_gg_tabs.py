@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+from indexer.gg_tabs import GGTabWorker, is_gg_tab
+
+
+class FakeItemDB(object):
+    def __init__(self):
+        self.gg_tabs = []
+        self.commits = 0
+
+    def update_gg_tab(self, stash, predictions):
+        self.gg_tabs.append((stash['id'], predictions))
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakePredictor(object):
+    def predict(self, stash_id):
+        return {'valuable': [stash_id], 'worthless': []}
+
+
+def make_stash(stash_id, name='GG'):
+    return {'id': stash_id, 'stash': name, 'accountName': 'someone', 'items': [{'league': 'Standard'}]}
+
+
+class GGTabTest(TestCase):
+    def test_is_gg_tab(self):
+        self.assertTrue(is_gg_tab(make_stash('a')))
+        self.assertFalse(is_gg_tab(make_stash('a', name='~price 1 chaos')))
+        self.assertFalse(is_gg_tab(dict(make_stash('a'), items=[])))
+
+    def test_worker_scores_latest_version_of_each_tab(self):
+        item_db = FakeItemDB()
+        worker = GGTabWorker(item_db, FakePredictor())
+        # Submit before starting, so both versions of tab a are pending at the same time
+        worker.submit(make_stash('a'))
+        worker.submit(make_stash('b'))
+        worker.submit(dict(make_stash('a'), accountName='someone else'))
+        worker.start()
+        worker.stop()
+        self.assertEqual([('a', {'valuable': ['a'], 'worthless': []}),
+                          ('b', {'valuable': ['b'], 'worthless': []})], item_db.gg_tabs)
+        self.assertEqual(2, item_db.commits)
@@ -0,0 +1,95 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from util.log_tail import LogFollower, incomplete_character_bytes, parse_position, skip_continuation_bytes
+
+
+class LogFollowerTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'log')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, data, mode='ab'):
+        with open(self.path, mode) as fp:
+            fp.write(data)
+
+    def test_follows_file(self):
+        self.write('first\n'.encode('utf-8'))
+        follower = LogFollower(self.path, poll_interval=0.01).start()
+        seq, text = follower.read(timeout=5)
+        self.assertEqual('first\n', text)
+        self.assertEqual((os.stat(self.path).st_ino, 6), parse_position(seq))
+
+        # A character split across two writes arrives in one piece
+        euro = '€'.encode('utf-8')
+        self.write(b'price: 5' + euro[:1])
+        seq, text = follower.read(seq, timeout=5)
+        self.write(euro[1:] + b'\n')
+        while not text.endswith('\n'):
+            seq, more = follower.read(seq, timeout=5)
+            text += more
+        self.assertEqual('price: 5€\n', text)
+        self.assertEqual('first\nprice: 5€\n', follower.read()[1])
+
+    def test_reopens_truncated_file(self):
+        self.write(b'a long first line\n')
+        follower = LogFollower(self.path, poll_interval=0.01).start()
+        seq, text = follower.read(timeout=5)
+        self.write(b'new\n', mode='wb')
+        seq, text = follower.read(seq, timeout=5)
+        self.assertEqual('new\n', text)
+
+    def test_bounded_backlog(self):
+        follower = LogFollower(self.path, backlog=10)
+        for i in range(5):
+            follower.append('line {}\n'.format(i).encode('utf-8'))
+        seq, text = follower.read()
+        self.assertEqual('0:35', seq)
+        self.assertEqual('line 4\n', text)
+
+    def read_all(self, follower, after, expected_length):
+        text = ''
+        while len(text) < expected_length:
+            after, more = follower.read(after, timeout=5)
+            text += more
+        return after, text
+
+    def test_positions_work_across_followers(self):
+        # Like two api worker processes, which chunk the file differently
+        self.write('one\ntwo €\n'.encode('utf-8'))
+        first = LogFollower(self.path, poll_interval=0.01, block_size=3).start()
+        second = LogFollower(self.path, poll_interval=0.01, block_size=5).start()
+        position, text = self.read_all(first, None, len('one\ntwo €\n'))
+
+        self.write(b'three\n')
+        self.assertEqual((position, ''), second.read(position, timeout=0))
+        self.assertEqual('three\n', self.read_all(second, position, len('three\n'))[1])
+        self.assertEqual('three\n', self.read_all(first, position, len('three\n'))[1])
+
+    def test_position_older_than_backlog_is_read_from_file(self):
+        self.write(b'0123456789\n')
+        first = LogFollower(self.path, poll_interval=0.01).start()
+        position, text = self.read_all(first, None, 11)
+        self.write(b'abcdefghij\n')
+        # Started later, with a backlog that doesn't go back far enough
+        second = LogFollower(self.path, backlog=8, poll_interval=0.01).start()
+        self.assertEqual('abcdefghij\n', self.read_all(second, position, 11)[1])
+
+
+class Utf8BoundaryTest(TestCase):
+    def test_skip_continuation_bytes(self):
+        data = 'ä€'.encode('utf-8')
+        self.assertEqual(0, skip_continuation_bytes(data))
+        self.assertEqual(1, skip_continuation_bytes(data[1:]))
+        self.assertEqual(2, skip_continuation_bytes(data[3:]))
+
+    def test_incomplete_character_bytes(self):
+        data = 'a€'.encode('utf-8')
+        self.assertEqual(0, incomplete_character_bytes(data))
+        self.assertEqual(2, incomplete_character_bytes(data[:-1]))
+        self.assertEqual(1, incomplete_character_bytes(data[:-2]))
+        self.assertEqual(0, incomplete_character_bytes(b''))
@@ -0,0 +1,54 @@
+import threading
+from unittest import TestCase
+
+from util import metrics
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_count(self):
+        metrics.count('items')
+        metrics.count('items', 4)
+        self.assertEqual(metrics.snapshot()['counters']['items'], 5)
+
+    def test_timer(self):
+        with metrics.timer('parse'):
+            pass
+        self.assertIn('parse', metrics.snapshot()['timers'])
+
+    def test_delta_leaves_out_unchanged(self):
+        metrics.count('a')
+        metrics.count('b')
+        before = metrics.snapshot()
+        metrics.count('b', 2)
+        metrics.count('c')
+        self.assertEqual(metrics.delta(before, metrics.snapshot())['counters'], {'b': 2, 'c': 1})
+
+    def test_thread_snapshot_leaves_out_other_threads(self):
+        before = metrics.snapshot(current_thread=True)
+        metrics.count('pages')
+        thread = threading.Thread(target=lambda: metrics.count('pages', 5))
+        thread.start()
+        thread.join()
+        self.assertEqual({'pages': 1}, metrics.delta(before, metrics.snapshot(current_thread=True))['counters'])
+        self.assertEqual(6, metrics.snapshot()['counters']['pages'])
+
+    def test_disabled(self):
+        with metrics.disabled():
+            metrics.count('items')
+            with metrics.timer('parse'):
+                pass
+            metrics.observe('page_seconds', 0.2)
+        metrics.count('pages')
+        self.assertEqual({'counters': {'pages': 1}, 'timers': {}}, metrics.snapshot())
+
+    def test_prometheus_text(self):
+        metrics.count('pages')
+        metrics.observe('page_seconds', 0.2, buckets=(0.1, 1))
+        text = metrics.prometheus_text()
+        self.assertIn('poeria_pages_total 1\n', text)
+        self.assertIn('poeria_page_seconds_bucket{le="0.1"} 0\n', text)
+        self.assertIn('poeria_page_seconds_bucket{le="1"} 1\n', text)
+        self.assertIn('poeria_page_seconds_count 1\n', text)
@@ -0,0 +1,75 @@
+import io
+import json
+import os
+import tempfile
+from contextlib import redirect_stdout
+from unittest import TestCase
+
+from bench.corpus import generate_pages, load_or_generate_pages
+from indexer import itemdb
+from bench.parse_bench import run_benchmark
+from util import metrics
+
+
+class RecordingCursor(object):
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, query):
+        self.queries.append(query)
+
+
+class FakeConnection(object):
+    def __init__(self, cursor):
+        self.db = cursor
+
+    def cursor(self):
+        return self.db
+
+
+class GeneratePagesTest(TestCase):
+    def test_deterministic(self):
+        self.assertEqual(generate_pages(1, stashes_per_page=3, seed=5), generate_pages(1, stashes_per_page=3, seed=5))
+        self.assertNotEqual(generate_pages(1, stashes_per_page=3, seed=5), generate_pages(1, stashes_per_page=3))
+
+    def test_items_are_mostly_parsed(self):
+        results = run_benchmark(generate_pages(1, stashes_per_page=10))
+        num_parsed = sum(x['count'] - x['rejected'] for x in results['types'].values())
+        self.assertGreater(num_parsed, 0.7 * results['items'])
+        self.assertGreater(sum(x['rejected'] for x in results['types'].values()), 0)
+
+
+    def test_items_can_be_added_to_stash(self):
+        # Everything ItemDB.add_to_stash needs, as the indexer benchmark replays them into the db
+        cursor = RecordingCursor()
+        item_db = itemdb.ItemDB(dbconn=FakeConnection(cursor))
+        stash = generate_pages(1, stashes_per_page=1)[0]['stashes'][0]
+        with redirect_stdout(io.StringIO()):
+            items = [itemdb.preprocess_item(x, stash['id']) for x in stash['items']]
+        item_db.add_to_stash([x for x in items if itemdb.is_priced_rare_item(x)])
+        self.assertEqual(1, len(cursor.queries))
+        self.assertIn('INSERT INTO StashContents', cursor.queries[0])
+
+
+class LoadOrGeneratePagesTest(TestCase):
+    def test_generates_pages_without_recorded_ones(self):
+        with tempfile.TemporaryDirectory() as tmpdir, redirect_stdout(io.StringIO()):
+            self.assertEqual(generate_pages(2, seed=3), load_or_generate_pages(tmpdir, 2, seed=3))
+            self.assertEqual(generate_pages(1), load_or_generate_pages(None, 1))
+
+    def test_loads_recorded_pages(self):
+        page = {'next_change_id': '1-2', 'stashes': []}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, '00000.json'), 'w') as fp:
+                json.dump(page, fp)
+            self.assertEqual([page], load_or_generate_pages(tmpdir, 2))
+
+
+class RunBenchmarkTest(TestCase):
+    def test_silent_while_timing(self):
+        metrics.reset()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            run_benchmark(generate_pages(1, stashes_per_page=10))
+        self.assertEqual('', out.getvalue())
+        self.assertEqual({}, metrics.snapshot()['counters'])
@@ -0,0 +1,243 @@
+import bz2
+import os
+import tempfile
+from decimal import Decimal, ROUND_HALF_UP
+from unittest import TestCase
+from unittest.mock import patch
+
+import joblib
+import numpy as np
+
+from constants import itemtype
+from indexer import itemstats
+from predict.predictor import FEATURE_SPECS, MULTI_STASH_CONTENTS_QUERY, Predictor, STASH_CONTENTS_QUERY, \
+    feature_names
+from train.feature_store import FeatureStore
+
+
+class ConstantModel(object):
+    def __init__(self, value):
+        self.value = value
+        self.batches = []
+
+    def predict(self, features):
+        self.batches.append(len(features))
+        return np.full(len(features), self.value)
+
+
+class FittedModel(object):
+    """
+    Stands in for a model that was fit on a frame, like an XGBClassifier, and checks that it
+    predicts on the same columns.
+    """
+    def __init__(self, feature_names):
+        self.feature_names_in_ = np.array(feature_names, dtype=object)
+
+    def predict(self, features):
+        if list(features.columns) != list(self.feature_names_in_):
+            raise ValueError('feature_names mismatch')
+        return np.ones(len(features), dtype=np.int64)
+
+
+class FakeCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.query = None
+
+    def execute(self, query, params):
+        self.query = query
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, rows):
+        self.db = FakeCursor(rows)
+
+    def cursor(self):
+        return self.db
+
+    def rollback(self):
+        pass
+
+
+def make_ring(item_id, mods, frame_type=2):
+    return {
+        'id': item_id,
+        'frameType': frame_type,
+        'typeLine': 'Coral Ring',
+        'corrupted': False,
+        'sockets': [],
+        'explicitMods': mods,
+    }
+
+
+def make_wand(item_id, attacks_per_second):
+    return {
+        'id': item_id,
+        'frameType': 2,
+        'typeLine': 'Driftwood Wand',
+        'corrupted': False,
+        'sockets': [],
+        'properties': [{'name': 'Attacks per Second', 'values': [[attacks_per_second, 0]]}],
+        'explicitMods': ['+20% to Fire Resistance'],
+    }
+
+
+class PredictorTest(TestCase):
+    def setUp(self):
+        self.predictor = Predictor(batch_size=3, cache_size=100)
+
+    def body_armour_stats(self):
+        spec = FEATURE_SPECS[itemtype.BODY]
+        return [300 if x == 'Armour' else 0 for x in spec.numeric_columns]
+
+    def make_features(self, num_items):
+        return self.predictor.make_features(itemtype.BODY, [self.body_armour_stats()] * num_items,
+                                            ['SSS I'] * num_items)
+
+    def test_make_features(self):
+        features = self.make_features(2)
+        self.assertEqual(2, len(features))
+        self.assertNotIn('Sockets', features.columns)
+        self.assertNotIn('ItemId', features.columns)
+        self.assertIn('TotalEleResist', features.columns)
+        self.assertEqual(np.int16, features.Armour.dtype)
+        self.assertEqual(np.bool_, features.Corrupted.dtype)
+
+    def test_predicts_in_batches(self):
+        model = self.predictor.models[itemtype.BODY] = ConstantModel(1)
+        features = self.make_features(7)
+        self.assertEqual([1] * 7, list(self.predictor.predict_features(itemtype.BODY, features)))
+        self.assertEqual([3, 3, 1], model.batches)
+
+    def test_no_model(self):
+        self.predictor.models[itemtype.RING] = None
+        self.assertIsNone(self.predictor.predict_features(itemtype.RING, None))
+
+    def test_query_covers_all_types(self):
+        self.assertEqual(len(itemtype.ALL_TYPES), STASH_CONTENTS_QUERY.count('::real[]'))
+
+    def test_caches_predictions_by_model_version_and_hash(self):
+        model = self.predictor.models[itemtype.BODY] = ConstantModel(1)
+        self.predictor.model_versions[itemtype.BODY] = 'v1'
+        stats = self.body_armour_stats()
+
+        predictions = self.predictor.predict_items(itemtype.BODY, ['a', 'b'], [stats] * 2, ['S'] * 2)
+        self.assertEqual([1, 1], list(predictions))
+        predictions = self.predictor.predict_items(itemtype.BODY, ['b', 'c', 'a'], [stats] * 3, ['S'] * 3)
+        self.assertEqual([1, 1, 1], list(predictions))
+        self.assertEqual([2, 1], model.batches)
+
+        # A new model doesn't reuse the predictions of the old one
+        self.predictor.model_versions[itemtype.BODY] = 'v2'
+        self.predictor.predict_items(itemtype.BODY, ['a'], [stats], ['S'])
+        self.assertEqual([2, 1, 1], model.batches)
+
+    def test_connects_on_first_use(self):
+        self.assertIsNone(self.predictor._dbconn)
+
+    def test_predict_raw_items(self):
+        model = self.predictor.models[itemtype.RING] = ConstantModel(1)
+        self.predictor.model_versions[itemtype.RING] = 'v1'
+        items = [
+            make_ring('a', ['+13 to maximum Life']),
+            make_ring('b', ['+13 to maximum Life'], frame_type=3),
+            make_ring('c', ['Something nobody has ever seen']),
+            {'id': 'd'},
+            make_ring('e', ['+40 to Strength']),
+            make_ring('f', ['Grants level 10 Clarity Skill']),
+        ]
+        parse_stats = itemstats.parse_stats
+
+        def parse_stats_or_fail(item, item_type):
+            if item['id'] == 'f':
+                # Like AffixCombine.restrict_to_one, which raises a plain Exception
+                raise Exception('Cannot have more than one GrantedSkill on the same item')
+            return parse_stats(item, item_type)
+
+        with patch('indexer.itemstats.parse_stats', parse_stats_or_fail):
+            results = self.predictor.predict_raw_items(items)
+        self.assertEqual(['a', 'b', 'c', 'd', 'e', 'f'], [x['id'] for x in results])
+        self.assertEqual(['valuable', None, None, None, 'valuable', None], [x['valuation'] for x in results])
+        self.assertEqual('RING', results[0]['type'])
+        self.assertNotIn('error', results[0])
+        self.assertEqual('not a rare item', results[1]['error'])
+        self.assertEqual('malformed item', results[3]['error'])
+        self.assertIn('GrantedSkill', results[5]['error'])
+        # All rings are predicted in one batch
+        self.assertEqual([2], model.batches)
+
+    def test_predict_stashes(self):
+        self.predictor.models[itemtype.BODY] = ConstantModel(1)
+        self.predictor.model_versions[itemtype.BODY] = 'v1'
+        stats = self.body_armour_stats()
+        rows = [
+            (itemtype.BODY, 0, 0, 2, 3, 'a', 'S', stats, 'tab1'),
+            (itemtype.BODY, 2, 0, 2, 3, 'b', 'S', stats, 'tab2'),
+        ]
+        dbconn = FakeConnection(rows)
+        results = self.predictor.predict_stashes(['tab1', 'tab2', 'tab3'], dbconn=dbconn)
+        self.assertEqual(MULTI_STASH_CONTENTS_QUERY, dbconn.db.query)
+        self.assertEqual([{'x': 0, 'y': 0, 'w': 2, 'h': 3}], results['tab1']['valuable'])
+        self.assertEqual([{'x': 2, 'y': 0, 'w': 2, 'h': 3}], results['tab2']['valuable'])
+        self.assertEqual({'valuable': [], 'worthless': []}, results['tab3'])
+
+    def test_reads_features_from_store(self):
+        model = self.predictor.models[itemtype.BODY] = ConstantModel(1)
+        self.predictor.model_versions[itemtype.BODY] = 'v1'
+        stats = self.body_armour_stats()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.predictor.feature_store_dir = tmpdir
+            features = self.make_features(1)
+            features.index = ['a']
+            FeatureStore(tmpdir, 'Standard.Both.BODY').append(features, hashes=['hash-a'])
+
+            with patch.object(self.predictor, 'make_features', wraps=self.predictor.make_features) as make_features:
+                predictions = self.predictor.predict_items(itemtype.BODY, ['hash-a', 'hash-b'], [stats] * 2, ['S'] * 2)
+                self.assertEqual([1, 1], list(predictions))
+                # Only the item that isn't in the store is featurized
+                self.assertEqual(1, len(make_features.call_args[0][1]))
+            self.assertEqual([1, 1], model.batches)
+
+    def save_model(self, tmpdir, itype, model):
+        filename = os.path.join(tmpdir, itemtype.get_name(itype) + '.model')
+        joblib.dump(model, filename)
+        return patch('predict.predictor.model_filename', lambda name: os.path.join(tmpdir, name + '.model'))
+
+    def test_loads_model_trained_on_current_features(self):
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                self.save_model(tmpdir, itemtype.BODY, FittedModel(feature_names(itemtype.BODY))):
+            self.assertIsNotNone(self.predictor.get_model(itemtype.BODY))
+            features = self.make_features(2)
+            self.assertEqual([1, 1], list(self.predictor.predict_features(itemtype.BODY, features)))
+
+    def test_refuses_model_trained_on_other_features(self):
+        # The columns of the ring model trained in notebooks/Train.ipynb, from before FeatureSpec
+        notebooks = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'notebooks')
+        with bz2.open(os.path.join(notebooks, 'ring_features.csv.bz2'), 'rt') as fp:
+            legacy_columns = fp.readline().strip().split(',')[1:]
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                self.save_model(tmpdir, itemtype.RING, FittedModel(legacy_columns)):
+            self.assertIsNone(self.predictor.get_model(itemtype.RING))
+            self.assertEqual(0, self.predictor.load_all_models())
+
+    def test_raw_items_have_the_features_of_stored_items(self):
+        items = [make_wand('a', '1.55'), make_wand('b', '2.50'), make_wand('c', '1.20')]
+        calls = []
+        self.predictor.predict_raw_items(items, predict_items=lambda *args: calls.append(args))
+        itype, hashes, values, sockets = calls[0]
+        self.assertEqual(itemtype.WAND, itype)
+
+        # The indexer inserts the parsed stats as SQL literals into smallint columns, which postgres
+        # rounds half away from zero. The stash contents query then selects them as real[].
+        stored_values = [[float(Decimal(repr(float(x))).quantize(Decimal(1), ROUND_HALF_UP)) for x in row]
+                         for row in values]
+        raw_features = self.predictor.make_features(itype, values, sockets)
+        stored_features = self.predictor.make_features(itype, stored_values, sockets)
+        self.assertEqual([2, 3, 1], list(raw_features.AttacksPerSecond))
+        self.assertTrue(raw_features.equals(stored_features))